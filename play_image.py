@@ -7,10 +7,13 @@ Play a png file line by line
 import time
 import socket
 import argparse
+import itertools
 
 from PIL import Image
 
 from treppe import protocol
+from treppe import shm
+from treppe import clock as frame_clock
 
 
 def parse_args():
@@ -20,6 +23,24 @@ def parse_args():
     parser.add_argument("-p", "--port", type=int, default=3123)
     parser.add_argument("-f", "--fps", type=int, default=30)
     parser.add_argument("-l", "--leds", type=int, default=16)
+    parser.add_argument("-b", "--batch", type=float, default=0,
+                        help="send BATCH seconds of frames per batch")
+    parser.add_argument("-S", "--sequence", default=False,
+                        action="store_true",
+                        help="send sequence numbers and send times")
+    parser.add_argument("--shm", default=None, metavar="PATH",
+                        help="write frames to a shared memory ring "
+                             "instead of sending them")
+    parser.add_argument("--policy", default=frame_clock.SKIP,
+                        choices=frame_clock.POLICIES,
+                        help="what to do with late frames, skipping "
+                             "drops columns (default: skip)")
+    parser.add_argument("--spin", default=0.0005, type=float,
+                        help="busy wait the last SPIN seconds before "
+                             "a frame is due (default: 0.0005)")
+    parser.add_argument("--stats", default=0, type=float,
+                        metavar="SECONDS",
+                        help="print frame stats every SECONDS")
     parser.add_argument("filename", nargs=1)
 
     return parser.parse_args()
@@ -43,19 +64,94 @@ def _get_col(image, row, max_width):
     return data
 
 
-def play_image(conn, filename, fps, crap, leds):
+def play_image_batched(sock, conn, image, fps, leds, batch, sequencer=None):
+    """
+    Send the image in batches of frames with presentation times.
+    Each batch is sent while the previous one is being played.
+
+    The batch time is the send time, the frame times lead it by
+    the time until the batch is due. The receiver estimates the
+    clock offset from the batch time, so it must not depend on
+    how early a batch is sent.
+    """
+    columns = (_get_col(image, x, leds)
+               for x in itertools.cycle(range(image.width)))
+
+    n = max(1, round(batch * fps))
+
+    t_batch = time.monotonic()
+    while True:
+        frames = list(itertools.islice(columns, n))
+
+        t_send = time.monotonic()
+        lead = max(0.0, t_batch - t_send)
+        times = [lead + i / fps for i in range(n)]
+
+        for packet in protocol.cmd_frame_batches_rgbw16(frames, times,
+                                                        t0=t_send):
+            if sequencer:
+                packet = sequencer.wrap(packet)
+            sock.sendto(packet, conn)
+
+        time.sleep(max(0.0, t_batch - time.monotonic()))
+        t_batch += n / fps
+
+
+def play_columns(image, leds, clock, stats=0):
+    """
+    Yield the columns of the image, one per frame.
+    Columns of frames dropped by the clock are skipped.
+    """
+    t_stats = time.monotonic()
+
+    x = 0
+    while True:
+        yield _get_col(image, x, leds)
+
+        dropped = clock.wait()
+        x = (x + 1 + dropped) % image.width
+
+        if stats and time.monotonic() - t_stats >= stats:
+            print(clock.report())
+            t_stats = time.monotonic()
+
+
+def play_image_shm(columns, shm_path):
+    """Write the image to a shared memory ring"""
+    writer = shm.Writer(shm_path)
+
+    for frame in columns:
+        writer.write(frame)
+
+
+def play_image(conn, filename, fps, crap, leds, batch=0, sequence=False,
+               shm_path=None, policy=frame_clock.SKIP, spin=0.0, stats=0):
     image = Image.open(filename)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-    while True:
-        for x in range(image.width):
-            frame = _get_col(image, x, leds)
-            if crap:
-                sock.sendto(protocol.encode_frame_crap8(frame), conn)
-            else:
-                sock.sendto(protocol.cmd_frame_rgbw16(frame), conn)
+    clock = frame_clock.FrameClock(fps, policy, spin)
+    columns = play_columns(image, leds, clock, stats)
+
+    if shm_path:
+        play_image_shm(columns, shm_path)
+        return
+
+    sequencer = None
+    if sequence:
+        sequencer = protocol.Sequencer()
+
+    if batch and not crap:
+        play_image_batched(sock, conn, image, fps, leds, batch, sequencer)
+        return
 
-            time.sleep(1.0 / fps)
+    for frame in columns:
+        if crap:
+            sock.sendto(protocol.encode_frame_crap8(frame), conn)
+        else:
+            packet = protocol.cmd_frame_rgbw16(frame)
+            if sequencer:
+                packet = sequencer.wrap(packet)
+            sock.sendto(packet, conn)
 
 
 
@@ -65,7 +161,13 @@ def main(args):
                args.filename[0],
                args.fps,
                args.crap,
-               args.leds)
+               args.leds,
+               args.batch,
+               args.sequence,
+               args.shm,
+               args.policy,
+               args.spin,
+               args.stats)
 
 
 if __name__ == "__main__":
@@ -7,11 +7,14 @@ import argparse
 import inspect
 import random
 import socket
+import struct
 import selectors
 
 import pygame
+import numpy as np
 
 from treppe import protocol
+from treppe import quantize
 
 DEFAULT_PORT = 3123
 
@@ -46,24 +49,50 @@ def draw_strip(ctx, i, color):
     pygame.draw.rect(ctx, color, rect_dn)
 
 
-def _map_rgbw(rgbw):
-    rgb = (min(rgbw[0] + 0.5*rgbw[3], 1.0),
-           min(rgbw[1] + 0.5*rgbw[3], 1.0),
-           min(rgbw[2] + 0.5*rgbw[3], 1.0))
+def _map_rgbw(values):
+    """
+    Map 16 bit rgbw values of all channels to 8 bit rgb colors.
+    White is added to rgb at half intensity.
+    """
+    white = values[:, 3:4] // 2
+    rgb = np.minimum(values[:, :3].astype(np.uint32) + white, 65535)
 
-    return (round(rgb[0] * 255.0),
-            round(rgb[1] * 255.0),
-            round(rgb[2] * 255.0))
+    return quantize.reduce_16(rgb)
 
 
 def render(ctx, frame):
+    colors = _map_rgbw(frame[:CHANNELS_ACTIVE]).tolist()
 
-    for i in range(0, CHANNELS_ACTIVE):
-        color = _map_rgbw(frame[i])
-
+    for i, color in enumerate(colors):
         draw_strip(ctx, i, color)
 
 
+def decode_packet_into(data, frame):
+    """
+    Decode a packet into frame. A batch is shown by
+    its last frame, the preview does not schedule them.
+
+    :returns: The decoded command
+    :rtype: int
+    """
+    if protocol.packet_cmd(data) != protocol.CMD_FRAME_BATCH:
+        return protocol.decode_packet_into(data, frame)
+
+    try:
+        _, batch, _ = protocol.split_header(data)
+        frames = list(protocol.iter_frame_batch(batch))
+    except (ValueError, struct.error):
+        return protocol.CMD_INVALID
+
+    if frames:
+        _, offset, size = frames[-1]
+        if not protocol.decode_frame_into(batch, frame, batch[1],
+                                          offset, size):
+            return protocol.CMD_INVALID
+
+    return protocol.CMD_FRAME_BATCH
+
+
 def main(args):
 
     pygame.init()
@@ -78,14 +107,13 @@ def main(args):
     t0 = time.time()
     i = 0
 
-    framebuffer = [(0, 0, 0, 0)
-                   for _ in range(0, protocol.CHANNELS_AVAILABLE)]
+    frame = protocol.Frame()
 
-    render(display, framebuffer)
+    render(display, frame.values)
     pygame.display.update()
 
     source = protocol.demultiplex_sockets(
-        protocol.receive_sockets(sock_a, sock_b),
+        protocol.receive_sockets(sock_a, sock_b, latest_only=True),
         1.5)
 
     for data in source:
@@ -97,16 +125,11 @@ def main(args):
 
 
         # Read from socket
-        packet = protocol.decode_packet(data)
-        if packet.cmd == protocol.CMD_SET_DIRECT:
-            framebuffer[packet.flags] = protocol.decode_rgbw16(
-                packet.payload[:8])
-        elif packet.cmd == protocol.CMD_FRAME:
-            framebuffer = packet.payload
-        elif packet.cmd == protocol.CMD_INVALID:
+        cmd = decode_packet_into(data, frame)
+        if cmd == protocol.CMD_INVALID:
             print("ERROR: Received invalid data.")
 
-        render(display, framebuffer)
+        render(display, frame.values)
         pygame.display.update()
 
 
@@ -10,8 +10,12 @@ import inspect
 import argparse
 import binascii
 
+import numpy as np
+
 from shaders import procs, state
 from treppe import protocol
+from treppe import shm
+from treppe import clock as frame_clock
 from prtcl import space
 from prtcl import programs as prtcl_programs
 
@@ -20,6 +24,8 @@ CHANNELS_ACTIVE = 16
 
 SYNTH = state.SynthState(CHANNELS_ACTIVE)
 
+FRAME = state.FrameContext()
+
 SPACE = space.Space(fps=60)
 
 def open_socket(host="localhost", port=2334):
@@ -37,6 +43,25 @@ def parse_args():
     parser.add_argument("-f", "--fps", default=60)
     parser.add_argument("-c", "--crap", default=False, action="store_true")
     parser.add_argument("-l", "--leds", default=16, type=int)
+    parser.add_argument("-k", "--keyframes", default=0, type=int,
+                        help="send delta frames with a keyframe every "
+                             "KEYFRAMES frames")
+    parser.add_argument("-S", "--sequence", default=False,
+                        action="store_true",
+                        help="send sequence numbers and send times")
+    parser.add_argument("--shm", default=None, metavar="PATH",
+                        help="write frames to a shared memory ring "
+                             "instead of sending them")
+    parser.add_argument("--policy", default=frame_clock.SKIP,
+                        choices=frame_clock.POLICIES,
+                        help="what to do with late frames "
+                             "(default: skip)")
+    parser.add_argument("--spin", default=0.0005, type=float,
+                        help="busy wait the last SPIN seconds before "
+                             "a frame is due (default: 0.0005)")
+    parser.add_argument("--stats", default=0, type=float,
+                        metavar="SECONDS",
+                        help="print frame stats every SECONDS")
 
     return parser.parse_args()
 
@@ -44,7 +69,8 @@ def parse_args():
 def get_shaders():
     return {name: proc
             for name, proc in inspect.getmembers(procs, inspect.isfunction)
-            if not name.startswith("_")}
+            if not name.startswith("_")
+            and proc.__module__ == procs.__name__}
 
 
 def list_shaders(shaders_available):
@@ -53,52 +79,113 @@ def list_shaders(shaders_available):
         print("    {}".format(name))
 
 
-def render_loop(conn, crap, leds, shader, fps):
+def simulate_particles(prtcl_samples):
+    """
+    Step the particle simulation and use the particles as synth input.
+    Returns the particles sampled in this step.
+    """
+    prtcl_programs.random_push(SPACE)
+
+    p_on = set(SPACE.sample1d()) - prtcl_samples
+    p_off = prtcl_samples - p_on
+
+    for p in p_on:
+        SYNTH.on(p)
+
+    for p in p_off:
+        SYNTH.off(p)
+
+    return p_on
+
+
+def render_frame(shader, t, leds):
     """
-    Rendering loop for a shader
+    Evaluate a shader for all LEDs at time t.
+
+    Vectorized shaders are called once with state.v as an
+    array of LED indices and return an (leds, 4) array,
+    all others are called once per LED and return a list.
+    LED invariant values are shared through the frame context.
+    """
+    FRAME.reset(t)
+
+    if getattr(shader, "vectorized", False):
+        s = state.ShaderState(t=t,
+                              u=0,
+                              v=np.arange(leds),
+                              h_res=1,
+                              v_res=leds,
+                              synth=SYNTH,
+                              frame=FRAME)
+        return shader(s)
+
+    frame = []
+    for i in range(0, leds):
+        s = state.ShaderState(t=t,
+                              u=0,
+                              v=i,
+                              h_res=1,
+                              v_res=leds,
+                              synth=SYNTH,
+                              frame=FRAME)
+        frame.append(shader(s))
+
+    return frame
+
+
+def render_loop(conn, crap, leds, shader, fps, keyframes=0, sequence=False,
+                shm_path=None, policy=frame_clock.SKIP, spin=0.0, stats=0):
+    """
+    Rendering loop for a shader.
+    Frames are rendered for the time they are due on the clock,
+    so catching up renders the missed frames, not the same one.
     """
-    t0 = time.time()
-    fps = float(fps)
+    clock = frame_clock.FrameClock(fps, policy, spin)
+    t_stats = time.monotonic()
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+    delta = None
+    if keyframes:
+        delta = protocol.DeltaEncoder(keyframe_interval=keyframes)
+
+    sequencer = None
+    if sequence:
+        sequencer = protocol.Sequencer()
+
+    writer = None
+    if shm_path:
+        writer = shm.Writer(shm_path)
+
     prtcl_samples = set()
 
     while True:
-        t = time.time() - t0
-        # Make shader state
-        frame = []
-        for i in range(0, leds):
-            s = state.ShaderState(t=t,
-                                  u=0,
-                                  v=i,
-                                  h_res=1,
-                                  v_res=leds,
-                                  synth=SYNTH)
-
-            # Simulate particles
-            prtcl_programs.random_push(SPACE)
-
-            # Use particles as synth input
-            p_on = set(SPACE.sample1d()) - prtcl_samples
-            p_off = prtcl_samples - p_on
-            prtcl_samples = p_on
-
-            for p in p_on:
-                SYNTH.on(p)
-
-            for p in p_off:
-                SYNTH.off(p)
-
-            # Draw strip
-            frame.append(shader(s))
-
-        if crap:
+        t = clock.t
+
+        # Simulate particles, once per frame
+        prtcl_samples = simulate_particles(prtcl_samples)
+
+        # Draw strip
+        frame = render_frame(shader, t, leds)
+
+        if writer:
+            writer.write(frame)
+        elif crap:
             sock.sendto(protocol.encode_frame_crap8(frame), conn)
         else:
-            sock.sendto(protocol.cmd_frame_rgbw16(frame), conn)
+            if delta:
+                packet = delta.encode(frame)
+            else:
+                packet = protocol.cmd_frame_rgbw16(frame)
+            if sequencer:
+                packet = sequencer.wrap(packet)
+            sock.sendto(packet, conn)
+
+        clock.wait()
 
-        time.sleep(1.0/fps)
+        if stats and time.monotonic() - t_stats >= stats:
+            print(clock.report())
+            t_stats = time.monotonic()
 
 
 
@@ -110,12 +197,21 @@ def main(args):
         list_shaders(shaders_available)
         return
 
-    print("Sending data to {}:{}".format(args.host, args.port))
+    if args.shm:
+        print("Writing frames to {}".format(args.shm))
+    else:
+        print("Sending data to {}:{}".format(args.host, args.port))
     render_loop((args.host, int(args.port)),
                 args.crap,
                 args.leds,
                 shader,
-                args.fps)
+                args.fps,
+                args.keyframes,
+                args.sequence,
+                args.shm,
+                args.policy,
+                args.spin,
+                args.stats)
 
 
 if __name__ == "__main__":
@@ -3,13 +3,18 @@
 import math
 
 from shaders import functions as fn
+from shaders import vfunctions as vfn
 from shaders import oscillators as osc
 
 def waber(freq, shift, state):
+    """
+    Waves bouncing around the lower stairs,
+    state.v can be a single LED or an array of LEDs
+    """
 
     # source 1: spatial parabola
-    g0 = fn.linear_window(0, 5, state.v)
-    s0 = fn.parabola(1, g0)
+    g0 = vfn.linear_window(0, 5, state.v)
+    s0 = vfn.parabola(1, g0)
 
     f0 = fn.parabola(2, osc.saw(4.5, state.t + shift))
 
@@ -17,8 +22,8 @@ def waber(freq, shift, state):
 
 
     # source 2: spatial parabola
-    g1 = fn.linear_window(6, 14, state.v)
-    s1 = fn.parabola(4, g1)
+    g1 = vfn.linear_window(6, 14, state.v)
+    s1 = vfn.parabola(4, g1)
 
     f1 = 0.5 + 0.5 * math.sin(1 * freq * state.t + math.pi + shift)
 
@@ -26,8 +31,8 @@ def waber(freq, shift, state):
 
 
     # source 3: same
-    g2 = fn.linear_window(4, 10, state.v)
-    s2 = fn.parabola(1, g2)
+    g2 = vfn.linear_window(4, 10, state.v)
+    s2 = vfn.parabola(1, g2)
 
     f2 = 0.5 + 0.5 * math.cos(0.5 * freq * state.t + math.pi * 2 + shift)
 
@@ -35,8 +40,8 @@ def waber(freq, shift, state):
 
 
     # source 4: spatial pulse
-    g3 = fn.linear_window(-0.5, 4, state.v)
-    s3 = fn.impulse(10, g3)
+    g3 = vfn.linear_window(-0.5, 4, state.v)
+    s3 = vfn.impulse(10, g3)
 
     f3 = fn.parabola(2, osc.saw(4.5, state.t + 2.5 + shift))
 
@@ -48,14 +53,12 @@ def waber(freq, shift, state):
 
 def gauge(perc, state):
     """
-    Render a gauge, filled from the bottom
+    Render a gauge, filled from the bottom,
+    state.v can be a single LED or an array of LEDs
     """
     v_perc = 1.0 - (state.v / state.v_res)
 
-    if v_perc <= perc:
-        return 1.0
-
-    return 0.0
+    return vfn.step(v_perc, perc)
 
 
 def synth_adsr(a, d, s, r, t_on, t_off, v, t):
@@ -1,18 +1,27 @@
 import math
 
+import numpy as np
+
 from shaders import oscillators as osc
 from shaders import generators as gen
 from shaders import functions as fn
+from shaders import vfunctions as vfn
+from shaders.state import precompute
+
+
+# Base colors of the flows
+FLOW_PALETTE = [(0.5,0.5,0.5,0.0),
+                (0.5,0.5,0.5,0.0),
+                (2.0,1.0,0.0,0.0),
+                (0.5,0.20,0.25,0.0)]
 
+@vfn.vectorized
 def smooth_white(state):
     offset = (state.v / 6.5) * math.pi
 
-    r = 0.5 + 0.5 * math.cos(2.0 * state.t + offset)
-    g = 0.5 + 0.5 * math.cos(2.0 * state.t + offset)
-    b = 0.5 + 0.5 * math.cos(2.0 * state.t + offset)
-    w = 0.1
+    r = 0.5 + 0.5 * np.cos(2.0 * state.t + offset)
 
-    return (r, r, r, r)
+    return vfn.rgbw(r, r, r, r)
 
 
 def const_step(state):
@@ -25,50 +34,46 @@ def const_step(state):
 
 
 
+@vfn.vectorized
 def const_colors(state):
-    c = [(1.0,0,0,0), (0.0,1.0,0,0), (0.0,0.0,1.0,0), (0.0,0.0,0,1.0),
-         (0.0,0,0,0), (0.0,1.0,0,0), (0.0,0,0.0,0), (0.0,0,0,0.0),
-         (0.0,0,0,0), (0.0,0.0,0,0), (1.0,0,0.0,0), (0,0,0,0.0),
-         (0.0,0,0,0), (0.0,0.0,0,0), (0.0,0,0.0,0), (0,0,0,1.0)]
+    c = np.array([(1.0,0,0,0), (0.0,1.0,0,0), (0.0,0.0,1.0,0), (0.0,0.0,0,1.0),
+                  (0.0,0,0,0), (0.0,1.0,0,0), (0.0,0,0.0,0), (0.0,0,0,0.0),
+                  (0.0,0,0,0), (0.0,0.0,0,0), (1.0,0,0.0,0), (0,0,0,0.0),
+                  (0.0,0,0,0), (0.0,0.0,0,0), (0.0,0,0.0,0), (0,0,0,1.0)])
 
     return c[state.v % 16]
 
 
+@vfn.vectorized
 def smooth_colors_old(state):
     offset = (state.v / 6.5) * math.pi
 
-    r = 0.5 + 0.5 * math.cos(2.0 * state.t + 2 + offset)
-    g = 0.5 + 0.5 * math.cos(2.0 * state.t + 3 + offset)
-    b = 0.5 + 0.5 * math.cos(2.0 * state.t + 4 + offset)
-    w = 0.1
+    r = 0.5 + 0.5 * np.cos(2.0 * state.t + 2 + offset)
+    g = 0.5 + 0.5 * np.cos(2.0 * state.t + 3 + offset)
+    b = 0.5 + 0.5 * np.cos(2.0 * state.t + 4 + offset)
 
-    return (0, r, g, b)
+    return vfn.rgbw(0, r, g, b)
 
+@vfn.vectorized
 def smooth_colors(state):
     offset = (state.v / 6.5) * math.pi
     slow = 1.0 - 0.3333333333333333333
-    r = 0.5 + 0.5 * math.cos(2.0 * -state.t*slow + 2 + offset)
-    g = 0.5 + 0.5 * math.cos(2.0 * -state.t*slow + 3 + offset)
-    b = 0.5 + 0.5 * math.cos(2.0 * -state.t*slow + 4 + offset)
+    r = 0.5 + 0.5 * np.cos(2.0 * -state.t*slow + 2 + offset)
+    g = 0.5 + 0.5 * np.cos(2.0 * -state.t*slow + 3 + offset)
+    b = 0.5 + 0.5 * np.cos(2.0 * -state.t*slow + 4 + offset)
     w = 0.1
-    return (r*0.071, g*0.071, b*0.071, w*0.071)
-
-
-
-def color_flow(state):
-    dimm = 0.5 # Be kind to our retinas
+    return vfn.rgbw(r*0.071, g*0.071, b*0.071, w*0.071)
 
-    pulse_len = 12.5
 
-    # Get base color from palette
-    p1 = [(0.5,0.5,0.5,0.0),
-          (0.5,0.5,0.5,0.0),
-          (2.0,1.0,0.0,0.0),
-          (0.5,0.20,0.25,0.0)]
 
+def _flow_base(state):
     # Cycle through the palette
     cycle_period = 15 * 60 # 15 minutes
-    base = fn.palette(*p1, osc.saw(cycle_period, state.t))
+    return fn.palette(*FLOW_PALETTE, osc.saw(cycle_period, state.t))
+
+
+def _color_flow_frame(state):
+    pulse_len = 12.5
 
     # flowing pulse
     v_pos = fn.linear_window_duration(1,
@@ -76,29 +81,27 @@ def color_flow(state):
                                       state.t % (pulse_len * 1.1)) \
                 * (state.v_res + 8)
 
-    f_pulse = fn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
-    pulse = 1.0 - fn.parabola(1.95, f_pulse)
-
-    return (base[0] * pulse * dimm,
-            base[1] * pulse * dimm,
-            base[2] * pulse * dimm,
-            0.04)
+    return _flow_base(state), v_pos
 
 
-def color_flow_flow(state):
+@vfn.vectorized
+@precompute(_color_flow_frame)
+def color_flow(state, frame):
     dimm = 0.5 # Be kind to our retinas
 
-    pulse_len = 18.5
+    base, v_pos = frame
 
-    # Get base color from palette
-    p1 = [(0.5,0.5,0.5,0.0),
-          (0.5,0.5,0.5,0.0),
-          (2.0,1.0,0.0,0.0),
-          (0.5,0.20,0.25,0.0)]
+    f_pulse = vfn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
+    pulse = 1.0 - vfn.parabola(1.95, f_pulse)
 
-    # Cycle through the palette
-    cycle_period = 15 * 60 # 15 minutes
-    base = fn.palette(*p1, osc.saw(cycle_period, state.t))
+    return vfn.rgbw(base[0] * pulse * dimm,
+                    base[1] * pulse * dimm,
+                    base[2] * pulse * dimm,
+                    0.04)
+
+
+def _color_flow_flow_frame(state):
+    pulse_len = 18.5
 
     # flowing pulse
     v_pos = fn.linear_window_duration(1,
@@ -106,9 +109,6 @@ def color_flow_flow(state):
                                       state.t % (pulse_len * 1.1)) \
                 * (state.v_res + 8)
 
-    f_pulse = fn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
-    pulse = 1.0 - fn.parabola(5.95, f_pulse)
-
     # flowing pulse up
     v_pos_up = fn.linear_window_duration(1,
                                         pulse_len,
@@ -116,19 +116,36 @@ def color_flow_flow(state):
                   * (state.v_res + 8)
     # v_pos_up = 1.0 - v_pos_up
 
-    f_pulse_up = fn.linear_window(-8 + v_pos_up, 0 + v_pos_up, state.v)
-    pulse_up = 1.0 - fn.parabola(5.95, f_pulse_up)
+    return _flow_base(state), v_pos, v_pos_up
+
+
+@vfn.vectorized
+@precompute(_color_flow_flow_frame)
+def color_flow_flow(state, frame):
+    dimm = 0.5 # Be kind to our retinas
+
+    base, v_pos, v_pos_up = frame
+
+    f_pulse = vfn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
+    pulse = 1.0 - vfn.parabola(5.95, f_pulse)
+
+    f_pulse_up = vfn.linear_window(-8 + v_pos_up, 0 + v_pos_up, state.v)
+    pulse_up = 1.0 - vfn.parabola(5.95, f_pulse_up)
+
+    return vfn.rgbw(base[0] * pulse_up * dimm * pulse,
+                    base[1] * pulse_up * dimm * pulse,
+                    base[2] * pulse_up * dimm * pulse,
+                    0.04)
 
-    return (base[0] * pulse_up * dimm * pulse,
-            base[1] * pulse_up * dimm * pulse,
-            base[2] * pulse_up * dimm * pulse,
-            0.04)
 
 
+def _pulse_frame(state):
+    return osc.linear(0, 13, 2, state.t)
 
-def pulse(state):
 
-    pulse_up = osc.linear(0, 13, 2, state.t)
+@precompute(_pulse_frame)
+def pulse(state, pulse_up):
+
     if state.v == pulse_up:
         return (1,0,0,0)
 
@@ -147,47 +164,53 @@ def pulse(state):
     return (pulse_up, 0,0,0)
 
 
-def gauge_pulse(state):
-
-    base = 0.2 * gen.waber(1, 0, state)
-    base2 = 0.08 * gen.waber(1, 5, state)
-
+def _gauge_pulse_frame(state):
     f0 = fn.impulse(12, fn.linear_window_duration(5, 2, state.t % 10))
     f1 = osc.cosine(8, state.t)
 
     f1p = fn.mix(0.1, 0.3, f1)
 
-    f3 = fn.clamp(0, 1, f1p + f0)
+    return fn.clamp(0, 1, f1p + f0)
+
+
+@vfn.vectorized
+@precompute(_gauge_pulse_frame)
+def gauge_pulse(state, f3):
+
+    base = 0.2 * gen.waber(1, 0, state)
+    base2 = 0.08 * gen.waber(1, 5, state)
 
     # Render gauge
     gauge = gen.gauge(f3, state)
 
 
     # return (0.3 * gauge, 0, 0.2 * gauge + base, base2)
-    return (0, 0.4 * gauge,  0.2 * gauge + base, base2)
+    return vfn.rgbw(0, 0.4 * gauge,  0.2 * gauge + base, base2)
 
 
+@vfn.vectorized
 def flow_pulse(state):
     pulse_len = 4.5
     blue_base = 0.2 * gen.waber(1, 0, state)
 
     # hull parabola / outer fade
-    f_hull = fn.linear_window(-2, state.v_res + 1, state.v)
-    hull = fn.mix(0.1, 1.0, fn.parabola(8, f_hull))
+    f_hull = vfn.linear_window(-2, state.v_res + 1, state.v)
+    hull = vfn.mix(0.1, 1.0, vfn.parabola(8, f_hull))
 
     # flowing pulse
     v_pos = fn.linear_window_duration(1, pulse_len, state.t % (pulse_len * 1.5)) * (state.v_res + 8)
-    f_pulse = fn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
-    pulse = fn.parabola(4, f_pulse) * hull
+    f_pulse = vfn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
+    pulse = vfn.parabola(4, f_pulse) * hull
 
     # flowing pulse
     v_pos2 = fn.linear_window_duration(1.4, pulse_len, state.t % (pulse_len * 1.5)) * (state.v_res + 8)
-    f_pulse2 = fn.linear_window(-8 + v_pos2, 0 + v_pos2, state.v)
-    pulse2 = fn.parabola(4, f_pulse2) * hull
+    f_pulse2 = vfn.linear_window(-8 + v_pos2, 0 + v_pos2, state.v)
+    pulse2 = vfn.parabola(4, f_pulse2) * hull
 
-    return (0, pulse2, blue_base, pulse)
+    return vfn.rgbw(0, pulse2, blue_base, pulse)
 
 
+@vfn.vectorized
 def pulse_wob(state):
     blue_base = 0.2 * gen.waber(1, 0, state)
 
@@ -196,13 +219,14 @@ def pulse_wob(state):
                                     4, 1, state.t % 10.0))
 
 
-    pulse_up = fn.impulse(8, fn.linear_window(pulse_base * state.v_res - 1,
-                                               pulse_base * state.v_res + 8,
-                                               state.v))
+    pulse_up = vfn.impulse(8, vfn.linear_window(pulse_base * state.v_res - 1,
+                                                 pulse_base * state.v_res + 8,
+                                                 state.v))
 
-    return (0, 0, blue_base, pulse_up * 0.7)
+    return vfn.rgbw(0, 0, blue_base, pulse_up * 0.7)
 
 
+@vfn.vectorized
 def random_glow(state):
     randomize = [(9, 2, 4, 8), (0, 2, 5), (3, 10, 12), (0, 3, 5, 12),
                  (4, 9), (2, 9, 11), (4, 8), (1, 5, 10, 12, 7),
@@ -221,18 +245,18 @@ def random_glow(state):
 
     pulse_t = fn.mix(0, 1, state.t % duration)
 
-    if state.v in selected:
-        pulse = fn.impulse(12, pulse_t)
-        return (0, 0, 0, pulse)
+    pulse = fn.impulse(12, pulse_t) * np.isin(state.v, selected)
 
-    return (0,0,0,0)
+    return vfn.rgbw(0, 0, 0, pulse)
 
 
+@vfn.vectorized
 def random_color_glow(state):
     colors = smooth_colors(state)
     glows = random_glow(state)
 
-    return (0.5 * colors[0], 0.5 * colors[1], 0.5* colors[2], glows[3])
+    return vfn.rgbw(0.5 * colors[..., 0], 0.5 * colors[..., 1],
+                    0.5 * colors[..., 2], glows[..., 3])
 
 
 
@@ -275,34 +299,35 @@ def synth_color_glow(state):
 
 def foo_pulse(state, pulse_len):
     # hull parabola / outer fade
-    f_hull = fn.linear_window(-2, state.v_res + 1, state.v)
-    hull = fn.mix(0.1, 1.0, fn.parabola(8, f_hull))
+    f_hull = vfn.linear_window(-2, state.v_res + 1, state.v)
+    hull = vfn.mix(0.1, 1.0, vfn.parabola(8, f_hull))
 
     # flowing pulse
     v_pos = fn.linear_window_duration(1, pulse_len, state.t % (pulse_len * 1.5)) * (state.v_res + 8)
-    f_pulse = fn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
-    pulse = fn.parabola(4, f_pulse) * hull
+    f_pulse = vfn.linear_window(-8 + v_pos, 0 + v_pos, state.v)
+    pulse = vfn.parabola(4, f_pulse) * hull
     return pulse
 
 
 def foo_v(state, width, phase, speed):
-    h = float(state.v) / float(state.v_res)
+    h = state.v / float(state.v_res)
     osc = 0.5 * (1.0 + math.sin(state.t * speed))
     osc2 = width * (0.5 + (osc*0.5))
-    v = 0.5*(1.0 + math.sin(math.pi * osc2 * h))
+    v = 0.5*(1.0 + np.sin(math.pi * osc2 * h))
     return v
 
 
+@vfn.vectorized
 def foo1(state):
     offset = 1.0/state.v_res
     v1 = foo_v(state, 8.0, 0.0, 0.2)
     v2 = foo_v(state, 10.0, offset, 0.3)
     v3 = foo_v(state, 8.0, offset * 2.0, 0.3)
     v4 = foo_pulse(state, 16.0)
-    return (0.5 * v1, 0.2 * v2, 0.22 * v3, v4)
+    return vfn.rgbw(0.5 * v1, 0.2 * v2, 0.22 * v3, v4)
 
 
-def krrr(state):
+def _krrr_frame(state):
     randomize = [(0, 1, 2), (1, 2, 3), (2,3,4), (3,5,6), (4,5,6), (5,6,7),
                  (6,7,8),
                  (7,8,9), (8,9,10), (9,10,11), (10,11,12), (11,12,13),
@@ -318,17 +343,18 @@ def krrr(state):
     total_win_size = len(randomize) * duration
 
     select = math.floor((state.t % total_win_size) / duration)
-    selected = randomize[select]
+    return randomize[select]
 
-    pulse_t = fn.mix(0, 1, state.t % duration)
 
+@precompute(_krrr_frame)
+def krrr(state, selected):
     if state.v in selected:
-        pulse = fn.impulse(12, pulse_t)
         return (1, 0, 0,0)
 
     return (0,0,0,0)
 
 
+@vfn.vectorized
 def palette2(state):
     pal = [
         [0.500, 0.500, 0.500, 0.0],
@@ -338,15 +364,10 @@ def palette2(state):
     ]
 
     # Background palette
-    pal_x = 1.0 - osc.linear(0.0, 1.0, state.v_res + 2, state.v)
-    rgb = fn.palette(*pal, pal_x)
-
-    rgb[0] *= 0.1
-    rgb[1] *= 0.1
-    rgb[2] *= 0.1
-    rgb[3] = 0
+    pal_x = 1.0 - vfn.oscillate_linear(0.0, 1.0, state.v_res + 2, state.v)
+    rgb = vfn.palette(*pal, pal_x)
 
-    return rgb
+    return rgb * (0.1, 0.1, 0.1, 0)
 
 
 def palette_test(state):
@@ -427,6 +448,7 @@ def trans_pride(state):
     return rgb
 
 
+@vfn.vectorized
 def palette_test(state):
     p1 = [(0.5,0.5,0.5,0.0),
           (0.5,0.5,0.5,0.0),
@@ -443,21 +465,21 @@ def palette_test(state):
           (1.0,1.0,1.0,0.0),
           (0.3,0.20,0.20,0.0)]
 
-    win = fn.linear_window(0, state.v_res, state.v)
+    win = vfn.linear_window(0, state.v_res, state.v)
 
     t_win = state.t % 30
     if t_win < 10:
-        return fn.palette(*p1, win - state.t)
+        return vfn.palette(*p1, win - state.t)
 
     if t_win < 20:
-        return fn.palette(*p2, win - state.t)
+        return vfn.palette(*p2, win - state.t)
 
-    if t_win < 30:
-        return fn.palette(*p3, win - state.t)
+    return vfn.palette(*p3, win - state.t)
 
 
+@vfn.vectorized
 def tr(state):
-    colors = [
+    colors = np.array([
         (1.0, 0.0, 0.0, 0.0),
         (0.0, 1.0, 0.0, 0.0),
         (0.0, 0.0, 1.0, 0.0),
@@ -471,16 +493,17 @@ def tr(state):
         (0.0, 0.0, 1.0, 0.0),
         (0.0, 1.0, 0.0, 0.0),
         (1.0, 1.0, 1.0, 0.0),
-    ]
+    ])
     return colors[state.v % len(colors)]
 
 
+@vfn.vectorized
 def trans_pride(state):
     blue = [0.13, 0.4, 0.98, 0.03]
     pink = [0.99, 0.15, 0.22, 0.1]
     white = [0, 0.5, 0.5, 0.4]
 
-    colors = [
+    colors = np.array([
         blue,
         blue,
         pink,
@@ -494,17 +517,13 @@ def trans_pride(state):
         blue,
         blue,
         blue,
-    ]
+    ])
     rgb = colors[state.v % len(colors)]
 
-    rgb[0] *= 0.08
-    rgb[1] *= 0.08
-    rgb[2] *= 0.08
-    rgb[3] *= 0.3
-
-    return rgb
+    return rgb * (0.08, 0.08, 0.08, 0.3)
 
 
+@vfn.vectorized
 def tflow(state):
     """fade between two shaders"""
     flow = smooth_colors(state)
@@ -529,10 +548,6 @@ def tflow(state):
     elif seg > 5:
         hull = 0.0
 
-    rgb = [
-        (flow[i] * (1 - hull) + pride[i] * hull)
-        for i in range(4)
-    ]
-    return rgb
+    return flow * (1 - hull) + pride * hull
 
 
@@ -1,12 +1,70 @@
 
 import time
+import functools
 from collections import namedtuple
 
 
 ShaderState = namedtuple("ShaderState", [
     "t", "u", "v", "h_res", "v_res",
-    "synth"
-])
+    "synth", "frame"
+], defaults=(None,))
+
+
+class FrameContext:
+    """
+    Values shared by all LEDs of a frame.
+
+    Precomputed values are kept until the
+    next frame starts.
+    """
+
+    def __init__(self):
+        """Initialize an empty context"""
+        self.t = None
+        self._values = {}
+
+
+    def reset(self, t):
+        """Start the frame at time t"""
+        if t != self.t:
+            self._values.clear()
+            self.t = t
+
+
+    def precomputed(self, frame_fn, state):
+        """Call frame_fn(state) once per frame"""
+        key = (frame_fn, state.h_res, state.v_res)
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = frame_fn(state)
+            return value
+
+
+def precompute(frame_fn):
+    """
+    Declare the per frame precomputation of a shader.
+
+    frame_fn(state) is called once per frame and must only use the
+    LED invariant parts of the state (t, h_res, v_res, synth). Its
+    result is passed to the shader as second argument:
+
+        @precompute(_pulse_frame)
+        def pulse(state, pulse_up):
+            ...
+
+    Without a frame context in the state, frame_fn is called
+    for every call of the shader.
+    """
+    def decorate(shader):
+        @functools.wraps(shader)
+        def wrapper(state):
+            if state.frame is None:
+                return shader(state, frame_fn(state))
+            return shader(state, state.frame.precomputed(frame_fn, state))
+        return wrapper
+
+    return decorate
 
 
 class SynthState:
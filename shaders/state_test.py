@@ -0,0 +1,35 @@
+from shaders import state
+
+
+def test_precompute():
+    """The precomputation runs once per frame"""
+    calls = []
+
+    def frame_fn(s):
+        calls.append(s.t)
+        return s.t * 10
+
+    @state.precompute(frame_fn)
+    def shader(s, scale):
+        return s.v * scale
+
+    frame = state.FrameContext()
+    for t in (1.0, 2.0):
+        frame.reset(t)
+        leds = [shader(state.ShaderState(t=t, u=0, v=i, h_res=1, v_res=4,
+                                         synth=None, frame=frame))
+                for i in range(4)]
+
+    assert leds == [0.0, 20.0, 40.0, 60.0]
+    assert calls == [1.0, 2.0]
+
+    # The same time is the same frame
+    frame.reset(2.0)
+    shader(state.ShaderState(t=2.0, u=0, v=1, h_res=1, v_res=4,
+                             synth=None, frame=frame))
+    assert calls == [1.0, 2.0]
+
+    # Without a frame context
+    assert shader(state.ShaderState(t=3.0, u=0, v=1, h_res=1, v_res=4,
+                                    synth=None)) == 30.0
+    assert calls == [1.0, 2.0, 3.0]
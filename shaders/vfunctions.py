@@ -0,0 +1,199 @@
+
+"""
+Vectorized shader function helpers
+
+The same functions as in shaders.functions, but built from
+numpy ufuncs instead of branches, so x can be an array of
+LED positions and a whole frame is evaluated in one call.
+
+Scalars work as well (numpy scalars are returned), so a
+vectorized shader can still be called with a single LED.
+
+"""
+
+import numpy as np
+
+
+def distance(a, b):
+    """
+    Returns the distance between a and b
+    """
+    return np.abs(b - a)
+
+
+def mix(a, b, x):
+    """
+    Returns the linear blend of a and b.
+    """
+    return (1.0 - x) * a + x * b
+
+
+def clamp(l, r, x):
+    """
+    Clamp a value between l and r, so that
+        l <= x <= r
+    """
+    return np.clip(x, l, r)
+
+
+def step(e, x):
+    """
+    Returns 0.0 if x < edge, otherwise it returns 1.0.
+    """
+    return np.where(x < e, 0.0, 1.0)
+
+
+def smoothstep(e0, e1, x):
+    """
+    Returns
+        0.0 if x <= e0 and 1.0 if x >= e1
+    and performs smooth Hermite interpolation between 0 and 1
+    when
+        e0 < x < e1.
+    """
+    x = clamp(0.0, 1.0, (x - e0) / (e1 - e0))
+    return x**3 * (x * (x * 6 - 15) + 10)
+
+
+def impulse(k, x):
+    """
+    Grows fast and then slowly decays,
+    the maximum of 1.0 is at x = 1/k.
+    """
+    h = k * x
+
+    return h * np.exp(1.0 - h)
+
+
+def almost_identity(m, n, x):
+    """
+    Blend x smoothly with the threshold m,
+    zero is mapped to n. See functions.almost_identity.
+    """
+    a = 2.0 * n - m
+    b = 2.0*m - 3.0*n
+    t = x/m
+
+    return np.where(x > m, x, (a*t + b)*t*t + n)
+
+
+def cubic_pulse(c, w, x):
+    """
+    A cheap replacement for a gaussian, the same as
+
+        smoothstep(c-w,c,x)-smoothstep(c,c+w,x)
+
+    """
+    x = np.abs(x - c) / w
+
+    return np.where(x > 1.0, 0.0, 1.0 - x**2 * (3.0 - 2.0 * x))
+
+
+def exp_step(k, n, x):
+    """
+    A natural attenuation is an exponential of a linearly
+    decaying quantity.
+    """
+    return np.exp(-k * np.power(x, n))
+
+
+def parabola(k, x):
+    """
+    Remap the 0..1 interval into 0..1,
+    the corners are mapped to 0 and the center to 1.
+    """
+    return np.power(4.0 * x * (1.0 - x), k)
+
+
+def gain(k, x):
+    """
+    Remap the unit interval by expanding the sides
+    and compressing the center, 1/2 stays at 1/2.
+    """
+    n = np.where(x < 0.5, 1.0 - x, x)
+    a = 0.5 * np.power(2.0 * n, k)
+
+    return np.where(x < 0.5, a, 1.0 - a)
+
+
+def power_curve(a, b, x):
+    """
+    Remap the 0..1 interval into 0..1, the corners are
+    mapped to 0 and the maximum of 1 is skewed by a and b.
+    """
+    k = pow(a + b, a + b) / (pow(a, a) * pow(b, b))
+
+    return k * np.power(x, a) * np.power(1.0 - x, b)
+
+
+def linear_window(l, r, x):
+    """
+    Returns a linear transition between 0 and 1 in a window
+    of length r - l;
+    """
+    outside = (x < l) | (x > r)
+
+    return np.where(outside, 0.0, (x - l) / np.abs(r - l))
+
+
+def linear_window_duration(onset, width, x):
+    """
+    Returns a linear transition between 0 and 1 in a window
+    of length width, after onset time.
+    """
+    return linear_window(onset, onset + width, x)
+
+
+def interpolate_cosine(y0, y1, x):
+    """
+    Make a simple cosine interpolation.
+    """
+    x2 = 0.5 * (1.0 - np.cos(x * np.pi))
+    return y0 * (1 - x2) + y1 * x2
+
+
+def oscillate_linear(v_min, v_max, duration, t):
+    """
+    Oscillate back and forth between v_min and v_max,
+    like oscillators.linear.
+    """
+    x = (t % duration) / duration
+
+    return np.where(x < 0.5,
+                    v_min + (x * 2.0) * (v_max - v_min),
+                    v_max - ((x - 0.5) * 2.0) * (v_max - v_min))
+
+
+def palette(a, b, c, d, t):
+    """
+    Generate a palette based on
+    http://www.iquilezles.org/www/articles/palettes/palettes.htm
+
+    a b c d are vec4
+    t is a float or an array, the result has a trailing
+    axis of 4 components.
+    """
+    t = np.asarray(t, dtype=np.float64)[..., np.newaxis]
+    a, b, c, d = (np.asarray(p, dtype=np.float64) for p in (a, b, c, d))
+
+    return a + b * np.cos(6.28318 * (c * t + d))
+
+
+def rgbw(r, g, b, w):
+    """
+    Stack the color components into an array with a trailing
+    axis of 4. Scalars are broadcast to the shape of the arrays,
+    so constant components can be given as plain numbers.
+    """
+    return np.stack(np.broadcast_arrays(r, g, b, w), axis=-1)
+
+
+def vectorized(shader):
+    """
+    Mark a shader as vectorized: it is called once per frame
+    with state.v as an array of LED indices and returns
+    an (leds, 4) array.
+    """
+    shader.vectorized = True
+    return shader
+
@@ -0,0 +1,49 @@
+import numpy as np
+
+from shaders import functions as fn
+from shaders import vfunctions as vfn
+from shaders import procs, state
+
+
+def test_matches_scalar_functions():
+    """The vectorized helpers compute the same as the scalar ones"""
+    x = np.linspace(-0.5, 1.5, 41)
+
+    cases = [
+        (fn.clamp, vfn.clamp, (0.0, 1.0)),
+        (fn.step, vfn.step, (0.5,)),
+        (fn.smoothstep, vfn.smoothstep, (0.2, 0.8)),
+        (fn.cubic_pulse, vfn.cubic_pulse, (0.5, 0.25)),
+        (fn.almost_identity, vfn.almost_identity, (0.4, 0.1)),
+        (fn.gain, vfn.gain, (2.0,)),
+        (fn.linear_window, vfn.linear_window, (0.0, 1.0)),
+        (fn.interpolate_cosine, vfn.interpolate_cosine, (0.2, 0.7)),
+    ]
+    for scalar, vectorized, params in cases:
+        expected = [scalar(*params, v) for v in x]
+        assert np.allclose(vectorized(*params, x), expected), scalar.__name__
+
+
+def test_palette():
+    """A palette of an array has a trailing color axis"""
+    p = [(0.5, 0.5, 0.5, 0.0), (0.5, 0.5, 0.5, 0.0),
+         (2.0, 1.0, 0.0, 0.0), (0.5, 0.2, 0.25, 0.0)]
+    t = np.array([0.0, 0.25, 0.6])
+
+    colors = vfn.palette(*p, t)
+    assert colors.shape == (3, 4)
+    assert np.allclose(colors[1], fn.palette(*p, 0.25))
+    assert vfn.palette(*p, 0.25).shape == (4,)
+
+
+def test_vectorized_shader():
+    """A vectorized shader renders the frame it would render per LED"""
+    synth = state.SynthState(16)
+    frame = procs.flow_pulse(state.ShaderState(
+        t=2.0, u=0, v=np.arange(16), h_res=1, v_res=16, synth=synth))
+
+    assert frame.shape == (16, 4)
+    for i in range(16):
+        rgbw = procs.flow_pulse(state.ShaderState(
+            t=2.0, u=0, v=i, h_res=1, v_res=16, synth=synth))
+        assert np.allclose(frame[i], rgbw)
@@ -5,6 +5,7 @@ in pkgs.mkShell {
         pkgs.python3
         pkgs.python3Packages.pip
         pkgs.python3Packages.pygame
+        pkgs.python3Packages.numpy
   ];  
   shellHook = ''
         alias pip="PIP_PREFIX='$(pwd)/_build/pip_packages' \pip"
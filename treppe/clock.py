@@ -0,0 +1,173 @@
+"""
+Frame Clock
+-----------
+
+Pace a render loop to absolute deadlines on the monotonic
+clock, so the frame rate does not drift with the time spent
+rendering:
+
+    clock = FrameClock(60)
+    while True:
+        render()
+        clock.wait()
+
+Frame n is due at start + n / fps. When a frame is late, the
+policy decides what happens to the deadlines already passed:
+
+    skip      Drop them, the next frame is due at the next
+              deadline in the future.
+    catch-up  Render the missed frames back to back until the
+              clock is on time again. When more than max_lag
+              seconds behind, the missed frames are dropped.
+
+time.sleep wakes up late by up to a scheduler tick. With a
+spin time, the clock sleeps until spin seconds before the
+deadline and busy-waits the rest.
+"""
+
+import time
+from collections import namedtuple
+
+from treppe import metrics
+
+
+SKIP = "skip"
+CATCH_UP = "catch-up"
+POLICIES = (SKIP, CATCH_UP)
+
+# Frame time buckets, in frame periods
+PERIOD_BUCKETS = (0.5, 0.9, 0.99, 1.01, 1.1, 1.5, 2.0, 3.0)
+
+
+FrameStats = namedtuple("FrameStats", [
+    "frames", "fps", "missed", "skipped", "elapsed",
+])
+
+
+class FrameClock:
+    """Sleep until the next frame is due"""
+
+    def __init__(self, fps, policy=SKIP, spin=0.0, max_lag=0.25):
+        """
+        :param fps: The target frame rate
+        :type fps: float
+
+        :param policy: What to do with passed deadlines,
+                       SKIP or CATCH_UP
+        :type policy: str
+
+        :param spin: Busy-wait the last spin seconds before
+                     a deadline
+        :type spin: float
+
+        :param max_lag: Catch up at most max_lag seconds
+        :type max_lag: float
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown policy: {}".format(policy))
+
+        self.period = 1.0 / float(fps)
+        self.policy = policy
+        self.spin = spin
+        self.max_lag = max_lag
+
+        self.reset()
+
+    def reset(self):
+        """Restart the clock and the stats with the next wait"""
+        self.frames = 0
+        self.missed = 0
+        self.skipped = 0
+        self.frame_times = metrics.Histogram(
+            "frame_seconds", "Time between frames",
+            buckets=[b * self.period for b in PERIOD_BUCKETS])
+
+        self._t_start = None
+        self._t_frame = None
+        self._deadline = None
+
+    def wait(self):
+        """
+        Wait until the next frame is due.
+
+        :returns: The number of frames dropped before it,
+                  always 0 unless the frame was late
+        :rtype: int
+        """
+        now = time.monotonic()
+        if self._deadline is None:
+            self._t_start = self._t_frame = now
+            self._deadline = now + self.period
+
+        dropped = 0
+        late = now - self._deadline
+        if late > 0:
+            self.missed += 1
+            if self.policy == SKIP or late > self.max_lag:
+                dropped = int(late / self.period)
+                self._deadline += dropped * self.period
+                self.skipped += dropped
+        else:
+            self._sleep_until(self._deadline)
+            now = time.monotonic()
+
+        self._deadline += self.period
+
+        self.frames += 1
+        self.frame_times.observe(now - self._t_frame)
+        self._t_frame = now
+
+        return dropped
+
+    @property
+    def t(self):
+        """
+        The scheduled time of the current frame in seconds
+        since the clock was started, 0 before the first wait.
+        It advances by whole periods, also while catching up,
+        so late frames are rendered for the time they were due.
+        """
+        if self._deadline is None:
+            return 0.0
+        return self._deadline - self.period - self._t_start
+
+    def _sleep_until(self, deadline):
+        remaining = deadline - time.monotonic() - self.spin
+        if remaining > 0:
+            time.sleep(remaining)
+
+        while time.monotonic() < deadline:
+            pass
+
+    def stats(self):
+        """
+        Get the frame stats since the clock was started.
+
+        :rtype: FrameStats
+        """
+        elapsed = 0.0
+        if self._t_start is not None:
+            elapsed = self._t_frame - self._t_start
+
+        fps = self.frames / elapsed if elapsed else 0.0
+
+        return FrameStats(self.frames, fps, self.missed, self.skipped,
+                          elapsed)
+
+    def report(self):
+        """
+        Summarize the stats and the frame times.
+
+        :rtype: str
+        """
+        stats = self.stats()
+        lines = ["{:.2f} fps, {} frames, {} missed, {} skipped".format(
+            stats.fps, stats.frames, stats.missed, stats.skipped)]
+
+        bounds = self.frame_times.buckets + (float("inf"),)
+        for bound, count in zip(bounds, self.frame_times.counts):
+            if count:
+                lines.append("    <= {:7.2f} ms: {}".format(
+                    bound * 1000.0, count))
+
+        return "\n".join(lines)
@@ -0,0 +1,101 @@
+import pytest
+
+from treppe import clock
+
+
+class FakeTime:
+    """A monotonic clock advanced by sleep and tick per reading"""
+
+    def __init__(self, tick=0.0):
+        self.now = 100.0
+        self.tick = tick
+        self.slept = []
+
+    def monotonic(self):
+        self.now += self.tick
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(clock, "time", fake)
+    return fake
+
+
+def test_no_drift(fake_time):
+    """Frames are due at absolute deadlines, work does not add up"""
+    fake_time.tick = 0.00001
+    frame_clock = clock.FrameClock(100, spin=0.001)
+    frame_clock.wait()
+    t_start = fake_time.now
+    for _ in range(20):
+        fake_time.sleep(0.004) # render
+        frame_clock.wait()
+
+    elapsed = fake_time.now - t_start
+    assert elapsed == pytest.approx(0.2, abs=0.0001)
+    assert frame_clock.frames == 21
+    assert frame_clock.missed == 0
+
+    # Slept until spin seconds before the deadline
+    assert fake_time.slept[-1] == pytest.approx(0.005, abs=0.0001)
+
+
+def test_skip(fake_time):
+    """Late frames drop the deadlines passed"""
+    frame_clock = clock.FrameClock(100, clock.SKIP)
+    frame_clock.wait()
+    fake_time.sleep(0.045)
+
+    assert frame_clock.wait() == 3
+    assert frame_clock.missed == 1
+    assert frame_clock.skipped == 3
+    assert frame_clock.t == pytest.approx(0.05)
+
+    t_start = fake_time.now
+    frame_clock.wait()
+    assert fake_time.now - t_start == pytest.approx(0.005)
+
+
+def test_catch_up(fake_time):
+    """Late frames are rendered back to back"""
+    frame_clock = clock.FrameClock(100, clock.CATCH_UP)
+    frame_clock.wait()
+    fake_time.sleep(0.045)
+
+    t_start = fake_time.now
+    times = []
+    for _ in range(3):
+        assert frame_clock.wait() == 0
+        times.append(frame_clock.t)
+    assert fake_time.now == t_start
+    assert times == pytest.approx([0.02, 0.03, 0.04])
+    assert frame_clock.missed == 3
+    assert frame_clock.skipped == 0
+
+    # Too far behind
+    fake_time.sleep(1.0)
+    assert frame_clock.wait() > 0
+
+
+def test_stats(fake_time):
+    """The frame times are counted in periods"""
+    frame_clock = clock.FrameClock(200)
+    assert frame_clock.t == 0.0
+    for _ in range(11):
+        frame_clock.wait()
+
+    stats = frame_clock.stats()
+    assert stats.frames == 11
+    assert stats.fps == pytest.approx(200)
+    assert frame_clock.t == pytest.approx(0.055)
+    assert frame_clock.frame_times.count == 11
+    assert "fps" in frame_clock.report()
+
+    with pytest.raises(ValueError):
+        clock.FrameClock(60, "rewind")
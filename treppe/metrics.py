@@ -0,0 +1,200 @@
+"""
+Metrics
+-------
+
+Counters and fixed-bucket histograms, served in the
+Prometheus text exposition format over HTTP:
+
+    registry = metrics.Registry()
+    received = registry.counter("packets_received_total",
+                                "Packets received", {"source": 3123})
+    received.inc()
+
+    metrics.serve(registry, 9123)
+
+Observing a value costs a bisection of the bucket bounds,
+nothing is allocated on the hot path.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, from 10 us to 250 ms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005,
+                   0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05,
+                   0.1, 0.25)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items())
+    if extra:
+        items += extra
+    if not items:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in items) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count"""
+
+    kind = "counter"
+
+    def __init__(self, name, help="", labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        """
+        Get the samples for the exposition.
+
+        :returns: A list of (name, labels, value)
+        :rtype: list
+        """
+        return [(self.name, _format_labels(self.labels), self.value)]
+
+
+class Histogram:
+    """
+    Count observations in fixed buckets.
+
+    The bucket bounds are inclusive upper bounds,
+    the counts are made cumulative on exposition.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help="", labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        """
+        Get the samples for the exposition.
+
+        :returns: A list of (name, labels, value)
+        :rtype: list
+        """
+        samples = []
+        total = 0
+        bounds = self.buckets + (float("inf"),)
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            le = [("le", _format_value(bound))]
+            samples.append((self.name + "_bucket",
+                            _format_labels(self.labels, le), total))
+
+        labels = _format_labels(self.labels)
+        samples.append((self.name + "_sum", labels, self.sum))
+        samples.append((self.name + "_count", labels, self.count))
+
+        return samples
+
+
+class Registry:
+    """A collection of metrics"""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help="", labels=None):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help="", labels=None,
+                  buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Get all metrics in the text exposition format.
+        Metrics with the same name share the HELP and TYPE lines.
+
+        :rtype: str
+        """
+        families = {}
+        for metric in self.metrics:
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in families.items():
+            lines.append("# HELP {} {}".format(name, metrics[0].help))
+            lines.append("# TYPE {} {}".format(name, metrics[0].kind))
+            for metric in metrics:
+                for sample, labels, value in metric.samples():
+                    lines.append("{}{} {}".format(
+                        sample, labels, _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+def _make_handler(registry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(registry, port, host="127.0.0.1"):
+    """
+    Serve the metrics of a registry in a background thread.
+
+    :param port: Listen on this port, 0 picks a free port
+    :type port: int
+
+    :returns: The running server, stop it with shutdown()
+    :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), _make_handler(registry))
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
@@ -0,0 +1,58 @@
+import urllib.request
+
+from treppe import metrics
+
+
+def test_histogram_buckets():
+    """Observations are counted in the first bucket they fit"""
+    hist = metrics.Histogram("latency_seconds", buckets=(0.001, 0.01))
+    hist.observe(0.0005)
+    hist.observe(0.001)
+    hist.observe(0.005)
+    hist.observe(1.0)
+
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+
+    samples = hist.samples()
+    assert samples[:3] == [
+        ("latency_seconds_bucket", '{le="0.001"}', 2),
+        ("latency_seconds_bucket", '{le="0.01"}', 3),
+        ("latency_seconds_bucket", '{le="+Inf"}', 4),
+    ]
+    assert samples[4] == ("latency_seconds_count", "", 4)
+
+
+def test_registry_render():
+    """Metrics of the same name share a family"""
+    registry = metrics.Registry("trepped_")
+    a = registry.counter("packets_total", "Packets", {"source": 1})
+    b = registry.counter("packets_total", "Packets", {"source": 2})
+    registry.histogram("stage_seconds", "Stages", {"stage": "decode"},
+                       buckets=(0.1,))
+    a.inc()
+    b.inc(3)
+
+    text = registry.render()
+    assert text.count("# TYPE trepped_packets_total counter") == 1
+    assert 'trepped_packets_total{source="1"} 1\n' in text
+    assert 'trepped_packets_total{source="2"} 3\n' in text
+    assert 'trepped_stage_seconds_bucket{stage="decode",le="0.1"} 0\n' \
+        in text
+    assert 'trepped_stage_seconds_sum{stage="decode"} 0.0\n' in text
+
+
+def test_serve():
+    """Serve the metrics over http"""
+    registry = metrics.Registry()
+    registry.counter("frames_total").inc(5)
+
+    server = metrics.serve(registry, 0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=2) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert b"frames_total 5\n" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
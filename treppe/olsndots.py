@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+import json
 import serial
 import struct
 from cobs import cobs
@@ -26,42 +28,134 @@ def address_pkt(addr):
 def framebuf_pkt(data):
     return struct.pack('<32I', data)
 
+class PacketStruct:
+    """ A fixed packet layout, precompiled
+
+    Packets are packed with a precompiled struct, COBS encoded and
+    copied into a transmit buffer, terminated with EOP.
+    """
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.struct = struct.Struct('<' + fmt)
+        self.size = self.struct.size
+        # COBS adds a code byte per 254 bytes started
+        self.max_encoded = self.size + self.size // 254 + 2
+
+    def encode_into(self, buf, offset, values):
+        """ Encode a packet of values and copy it into buf at offset,
+        returns the end offset. buf must have max_encoded bytes of room.
+
+        Packing and COBS encoding each make a temporary bytes object,
+        the C encoder is still faster than stuffing in place in Python.
+        """
+        data = cobs.encode(self.struct.pack(*values))
+        end = offset + len(data)
+        buf[offset:end] = data
+        buf[end] = 0
+        return end + 1
+
+ADDRESS_PACKET = PacketStruct('I')
+
 class Driver:
     type_drivers = {}
 
     def __init__(self, port, devices=None, addrs=None, baudrate=500000, timeout=0.100):
-        self._ser = serial.Serial(port, baudrate)
+        self._ser = serial.serial_for_url(port, baudrate)
+        self._txbuf = bytearray(1024)
+        self.bytes_per_frame = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.encode_time = 0.0
+        self.write_time = 0.0
         self._ser.write(b'\0')
         self._ser.flushInput()
         self.timeout = timeout
         if addrs is not None:
-            self.nodes = [ type_drivers[device_type](addr, self) for addr, device_type in addrs ]
+            self.nodes = [ self.type_drivers[device_type](addr, self) for addr, device_type in addrs ]
         if devices is not None:
             for dev in devices:
                 dev.driver = self
             self.nodes = devices
 
-    def probe_devices(self):
+    @property
+    def baudrate(self):
+        return self._ser.baudrate
+
+    def probe_devices(self, timeout=0.010):
+        """ Yield (addr, device_type, device class) until no device answers """
         while True:
             self._ser.write(b'\x00')
-            addr, device_type = self.recv_struct('IB', timeout=0.010)
-            yield addr, device_type, self.type_drivers.get[device_type]
+            try:
+                addr, device_type = self.recv_struct('IB', timeout=timeout)
+            except (struct.error, cobs.DecodeError):
+                return
+            yield addr, device_type, self.type_drivers.get(device_type)
             time.sleep(0.010)
 
+    def send_structs(self, packets):
+        """ Send several (fmt, args) packets with a single write """
+        end = 0
+        for fmt, args in packets:
+            end = self._put_struct(end, fmt, *args)
+        self._ser.write(memoryview(self._txbuf)[:end])
+
     def recv_struct(self, fmt, timeout=None):
         self._ser.timeout = self.timeout if timeout is None else timeout
         data = self._ser.read_until(b'\0')
-        print("data:" + str(data))
         return struct.unpack('<'+fmt, cobs.decode(data[:-1]))
 
+    def close(self):
+        self._ser.close()
+
+    def discard_input(self):
+        self._ser.reset_input_buffer()
+
     def send_struct(self, fmt, *args):
         data = struct.pack('<'+fmt, *args)
         self._ser.write(cobs.encode(data)+EOP)
 
+    def _put_struct(self, offset, fmt, *args):
+        """ Encode a packet into the transmit buffer at offset, returns the end offset """
+        data = cobs.encode(struct.pack('<'+fmt, *args)) + EOP
+        end = offset + len(data)
+        if end > len(self._txbuf):
+            self._txbuf.extend(bytes(end - len(self._txbuf)))
+        self._txbuf[offset:end] = data
+        return end
+
+    def send_framebufs(self, frames):
+        """ Send the framebuffers of several nodes with a single write.
+
+        frames: iterable of (node, data)
+        Returns the number of bytes written. The time spent encoding
+        and writing is kept in encode_time and write_time.
+        """
+        t_start = time.monotonic()
+        buf = self._txbuf
+        end = 0
+        for node, data in frames:
+            packet = node.framebuf_packet
+            if end + ADDRESS_PACKET.max_encoded + packet.max_encoded > len(buf):
+                buf.extend(bytes(ADDRESS_PACKET.max_encoded + packet.max_encoded + len(buf)))
+            end = ADDRESS_PACKET.encode_into(buf, end, (node.addr,))
+            end = packet.encode_into(buf, end, data)
+
+        t_encoded = time.monotonic()
+        self._ser.write(memoryview(self._txbuf)[:end])
+        self.encode_time = t_encoded - t_start
+        self.write_time = time.monotonic() - t_encoded
+
+        self.bytes_per_frame = end
+        self.bytes_sent += end
+        self.frames_sent += 1
+        return end
+
     @classmethod
     def register_device(drv_kls, device_type):
         def wrapper(dev_kls):
             drv_kls.type_drivers[device_type] = dev_kls
+            dev_kls.device_type = device_type
             return dev_kls
         return wrapper
 
@@ -80,6 +174,8 @@ class Olsndot:
     def __init__(self, addr, driver=None):
         self.addr = addr
         self._driver = driver
+        self._framebuf_packet = None
+        self._framebuf_layout = None
 
     @property
     def driver(self):
@@ -90,6 +186,19 @@ class Olsndot:
         self._driver = driver
         self.fetch_status()
 
+    def attach(self, driver):
+        """ Use a driver without fetching the status """
+        self._driver = driver
+
+    @property
+    def framebuf_packet(self):
+        """ The PacketStruct of the framebuffer, compiled once per layout """
+        layout = (self.nchannels, self.channel_spec)
+        if layout != self._framebuf_layout:
+            self._framebuf_packet = PacketStruct('{}{}'.format(*layout))
+            self._framebuf_layout = layout
+        return self._framebuf_packet
+
     def send_framebuf(self, data):
         self._driver.send_struct('I', self.addr)
         self._driver.send_struct('{}{}'.format(self.nchannels, self.channel_spec), *data)
@@ -101,16 +210,24 @@ class Olsndot:
     Status = namedtuple('Status',
             ['uptime_s', 'uart_overruns', 'frame_overruns', 'invalid_frames', 'vcc_mv', 'temp_celsius'])
 
-    def fetch_status(self):
+    STATUS_FMT = 'BBBBBHIIIIHH'
+
+    def fetch_status(self, timeout=None):
         self.send_cmd(Olsndot.CMD_READ_STATUS)
+        return self.apply_status(self._driver.recv_struct(Olsndot.STATUS_FMT, timeout=timeout))
+
+    def apply_status(self, reply):
+        """ Take the description and status from a CMD_READ_STATUS reply """
         (self.fw_ver, self.hw_ver,
         self.nbits, chspec, cs, self.nchannels,
         uptime_s,
         uart_overruns, frame_overruns, invalid_frames,
-        vcc_mv, temp_celsius) = self._driver.recv_struct('BBBBBHIIIIHH')
+        vcc_mv, temp_celsius) = reply
         self.color_spec = Olsndot.ColorSpec(cs)
         self.channel_spec = chr(chspec)
-        return Olsndot.Status(uptime_s, uart_overruns, frame_overruns, invalid_frames, vcc_mv, temp_celsius)
+        self.status = Olsndot.Status(uptime_s, uart_overruns, frame_overruns, invalid_frames, vcc_mv, temp_celsius)
+        self.t_status = time.monotonic()
+        return self.status
 
     def __str__(self):
         st = self.fetch_status()
@@ -122,6 +239,169 @@ class Olsndot:
     def channel_format(self):
         return '{}{}'.format(self.color_spec.name, self.nbits)
 
+    def describe(self):
+        """ The node table entry of the node """
+        return {'type': self.device_type, 'fw_ver': self.fw_ver, 'hw_ver': self.hw_ver,
+                'nbits': self.nbits, 'channel_spec': self.channel_spec,
+                'color_spec': self.color_spec.value, 'nchannels': self.nchannels}
+
+    def restore(self, entry, driver):
+        """ Set up the node from a node table entry, without talking to it """
+        if entry['type'] != self.device_type:
+            raise ValueError('node {:08x} is of type {}'.format(self.addr, entry['type']))
+        self.fw_ver = entry['fw_ver']
+        self.hw_ver = entry['hw_ver']
+        self.nbits = entry['nbits']
+        self.channel_spec = entry['channel_spec']
+        self.color_spec = Olsndot.ColorSpec(entry['color_spec'])
+        self.nchannels = entry['nchannels']
+        self.attach(driver)
+
+    @staticmethod
+    def probe(driver, addrs, timeout=0.020, depth=8):
+        """ Query the status of several nodes, pipelined.
+
+        Status requests for up to depth addresses are sent with one write.
+        Replies carry no address and are matched to the requests in order,
+        which is only safe if every node of the window answered. Otherwise
+        the window is queried again one node at a time. The whole probe takes
+        at most (depth + 1) * timeout per window.
+
+        Yields (addr, reply) with reply None for missing nodes.
+        """
+        addrs = list(addrs)
+        for i in range(0, len(addrs), depth):
+            window = addrs[i:i + depth]
+            driver.discard_input()
+            driver.send_structs(packet for addr in window
+                    for packet in (('I', (addr,)), ('B', (Olsndot.CMD_READ_STATUS,))))
+
+            replies = []
+            for addr in window:
+                reply = Olsndot._recv_status(driver, timeout)
+                if reply is None:
+                    break
+                replies.append(reply)
+
+            if len(replies) == len(window):
+                yield from zip(window, replies)
+                continue
+
+            for addr in window:
+                driver.discard_input()
+                driver.send_structs([('I', (addr,)), ('B', (Olsndot.CMD_READ_STATUS,))])
+                yield addr, Olsndot._recv_status(driver, timeout)
+
+    @staticmethod
+    def _recv_status(driver, timeout):
+        try:
+            return driver.recv_struct(Olsndot.STATUS_FMT, timeout=timeout)
+        except (struct.error, cobs.DecodeError):
+            return None
+
+class NodeTable:
+    """ The nodes found on every port, cached in a json file
+
+    Entries are the description of a node (see Olsndot.describe) by port and
+    address, so a restart can set up the nodes without querying them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ports = {}
+
+    def load(self):
+        """ Read the table, an unreadable file is an empty table """
+        try:
+            with open(self.path) as f:
+                ports = json.load(f)
+        except (OSError, ValueError):
+            return self
+        self.ports = {port: {int(addr, 16): entry for addr, entry in nodes.items()}
+                      for port, nodes in ports.items()}
+        return self
+
+    def save(self):
+        """ Write the table atomically """
+        ports = {port: {'{:08x}'.format(addr): entry for addr, entry in sorted(nodes.items())}
+                 for port, nodes in self.ports.items()}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(ports, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, port, addr):
+        return self.ports.get(port, {}).get(addr)
+
+    def update(self, port, node):
+        """ Store the description of a node, returns True if it changed """
+        entry = node.describe()
+        nodes = self.ports.setdefault(port, {})
+        changed = nodes.get(node.addr) != entry
+        nodes[node.addr] = entry
+        return changed
+
+class TelemetryPoller:
+    """ Read the status of one node at a time, round robin.
+
+    poll() blocks on the serial port for up to timeout, so it should
+    only be called in idle gaps of the frame stream longer than rtt,
+    the average duration of a successful poll, and be given the
+    length of the gap as its timeout. The latest status
+    of every node is cached by address, along with the error counters
+    that rose since the previous poll of the node.
+    """
+
+    ERROR_COUNTERS = ('uart_overruns', 'frame_overruns', 'invalid_frames')
+
+    def __init__(self, nodes, interval=5.0, timeout=0.020):
+        self.nodes = nodes
+        self.interval = interval
+        self.timeout = timeout
+        self.status = {}
+        self.rising = {}
+        self.rtt = 0.002
+        self.polls = 0
+        self.errors = 0
+        self._next = 0
+        self._t_poll = 0
+
+    def due(self, now=None):
+        """ Check if the next node should be polled """
+        if not self.nodes or not self.interval:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - self._t_poll >= self.interval / len(self.nodes)
+
+    def poll(self, timeout=None):
+        """ Fetch the status of the next node, None on failure.
+
+        The reply is awaited for at most timeout, capped at self.timeout.
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        # The nodes may have changed since the previous poll
+        node = self.nodes[self._next % len(self.nodes)]
+        self._next = (self._next + 1) % len(self.nodes)
+        self._t_poll = time.monotonic()
+        self.polls += 1
+
+        node.driver.discard_input() # late replies of failed polls
+        try:
+            status = node.fetch_status(timeout=max(0.0, timeout))
+        except (struct.error, cobs.DecodeError, ValueError):
+            self.errors += 1
+            return None
+        self.rtt = 0.8 * self.rtt + 0.2 * (time.monotonic() - self._t_poll)
+
+        previous = self.status.get(node.addr)
+        self.status[node.addr] = status
+        if previous is not None:
+            self.rising[node.addr] = [name for name in self.ERROR_COUNTERS
+                                      if getattr(status, name) > getattr(previous, name)]
+        return status
+
 if __name__ == '__main__':
     d = Driver('/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_A50285BI-if00-port0')
     for addr, tid, drv in d.probe_devices():
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+""" Virtual Olsndot bus
+
+A pty that behaves like a serial bus of Olsndot boards, for running
+trepped and benchmarks without hardware:
+
+    python -m treppe.olsndots_sim
+    ./trepped.py -p /dev/pts/N
+
+Packets are COBS encoded and terminated with EOP, as in olsndots. An
+address packet selects a node, the next packet is either a framebuffer
+or a command for it. The bus is read at the modeled baud rate, so a
+writer faster than the link blocks like on a real port. Each board needs
+some processing time per frame; frames arriving while it is still busy
+are counted as frame overruns and dropped.
+"""
+
+import os
+import pty
+import tty
+import time
+import struct
+import select
+import argparse
+import threading
+
+from cobs import cobs
+
+from treppe.olsndots import EOP, Olsndot
+
+STATUS_FMT = '<BBBBBHIIIIHH'
+
+BAUDRATE_DEFAULT = 1000000
+PROCESSING_TIME_DEFAULT = 0.0002
+
+
+class VirtualOlsndot:
+    """ A simulated board """
+
+    def __init__(self, addr, nchannels=32, channel_spec='H', nbits=16,
+                 color_spec=Olsndot.ColorSpec.rgbw,
+                 processing_time=PROCESSING_TIME_DEFAULT,
+                 fw_ver=1, hw_ver=1, vcc_mv=3300, temp_celsius=30):
+        self.addr = addr
+        self.nchannels = nchannels
+        self.channel_spec = channel_spec
+        self.nbits = nbits
+        self.color_spec = color_spec
+        self.processing_time = processing_time
+        self.fw_ver = fw_ver
+        self.hw_ver = hw_ver
+        self.vcc_mv = vcc_mv
+        self.temp_celsius = temp_celsius
+
+        self.frame_size = struct.calcsize('<{}{}'.format(nchannels, channel_spec))
+        self.framebuf = None
+
+        self.frames = 0
+        self.uart_overruns = 0
+        self.frame_overruns = 0
+        self.invalid_frames = 0
+
+        self._t_start = time.monotonic()
+        self._t_busy = 0
+
+    def status(self):
+        """ The reply to CMD_READ_STATUS """
+        return struct.pack(STATUS_FMT,
+                self.fw_ver, self.hw_ver, self.nbits, ord(self.channel_spec),
+                self.color_spec.value, self.nchannels,
+                int(time.monotonic() - self._t_start),
+                self.uart_overruns, self.frame_overruns, self.invalid_frames,
+                self.vcc_mv, self.temp_celsius)
+
+    def handle(self, payload, now):
+        """ Handle a packet addressed to the board, returns a reply or None """
+        if len(payload) == 1 and payload[0] == Olsndot.CMD_READ_STATUS:
+            return self.status()
+
+        if len(payload) != self.frame_size:
+            self.invalid_frames += 1
+            return None
+
+        if now < self._t_busy:
+            self.frame_overruns += 1
+            return None
+
+        self.framebuf = struct.unpack('<{}{}'.format(self.nchannels, self.channel_spec), payload)
+        self.frames += 1
+        self._t_busy = now + self.processing_time
+        return None
+
+    def __repr__(self):
+        return '<VirtualOlsndot {:08x} frames {} frame_overruns {} invalid_frames {}>'.format(
+                self.addr, self.frames, self.frame_overruns, self.invalid_frames)
+
+
+class Bus:
+    """ A pty serving a bus of simulated boards in a background thread """
+
+    def __init__(self, nodes, baudrate=BAUDRATE_DEFAULT, bits_per_byte=10):
+        self.nodes = {node.addr: node for node in nodes}
+        self.byte_time = bits_per_byte / baudrate
+
+        self.bytes = 0
+        self.packets = 0
+        self.unaddressed = 0
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+
+        self._buf = b''
+        self._selected = None
+        self._t_wire = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self.receive(data)
+
+    def receive(self, data, now=None):
+        """ Receive data from the wire, blocking for its transmission time """
+        if now is None:
+            now = time.monotonic()
+
+        self.bytes += len(data)
+        self._t_wire = max(self._t_wire, now) + len(data) * self.byte_time
+        delay = self._t_wire - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        *packets, self._buf = (self._buf + data).split(EOP)
+        for packet in packets:
+            self._handle(packet, self._t_wire)
+
+    def _handle(self, packet, now):
+        if not packet:
+            return # sync
+        self.packets += 1
+
+        try:
+            payload = cobs.decode(packet)
+        except cobs.DecodeError:
+            self._selected = None
+            return
+
+        node = self._selected
+        if node is None:
+            if len(payload) == 4:
+                addr, = struct.unpack('<I', payload)
+                self._selected = self.nodes.get(addr)
+            if self._selected is None:
+                self.unaddressed += 1
+            return
+
+        self._selected = None
+        reply = node.handle(payload, now)
+        if reply is not None:
+            os.write(self._master, cobs.encode(reply) + EOP)
+
+    def __repr__(self):
+        return '<Bus {} bytes {} packets {} unaddressed>'.format(
+                self.bytes, self.packets, self.unaddressed)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--addr", action="append", type=lambda a: int(a, 0),
+                        dest="addrs", help="board address (default: 0x23420001 and 0x23420002)")
+    parser.add_argument("-b", "--baudrate", default=BAUDRATE_DEFAULT, type=int)
+    parser.add_argument("-c", "--channels", default=32, type=int,
+                        help="16 bit channels per board")
+    parser.add_argument("-t", "--processing-time", default=PROCESSING_TIME_DEFAULT, type=float,
+                        help="time a board needs per frame (s)")
+    parser.add_argument("-s", "--stats", default=1.0, type=float)
+
+    return parser.parse_args()
+
+
+def main(args):
+    addrs = args.addrs or [0x23420001, 0x23420002]
+    nodes = [VirtualOlsndot(addr, args.channels, processing_time=args.processing_time)
+             for addr in addrs]
+    bus = Bus(nodes, args.baudrate).start()
+
+    print("Simulating {} boards at {} baud on {}".format(len(nodes), args.baudrate, bus.path))
+    try:
+        while True:
+            time.sleep(args.stats)
+            print(bus)
+            for node in nodes:
+                print(node)
+    except KeyboardInterrupt:
+        bus.stop()
+
+
+if __name__ == '__main__':
+    main(_parse_args())
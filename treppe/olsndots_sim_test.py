@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from treppe import olsndots
+from treppe import olsndots_sim
+
+
+@pytest.fixture
+def bus():
+    nodes = [olsndots_sim.VirtualOlsndot(0x23420001, processing_time=0.0),
+             olsndots_sim.VirtualOlsndot(0x23420002, processing_time=0.0)]
+    bus = olsndots_sim.Bus(nodes).start()
+    yield bus
+    bus.stop()
+
+
+def test_fetch_status(bus):
+    """Boards are initialized from the simulated status"""
+    boards = [olsndots.Olsndot(0x23420001), olsndots.Olsndot(0x23420002)]
+    driver = olsndots.Driver(bus.path, devices=boards, baudrate=1000000)
+
+    for board in boards:
+        assert board.nchannels == 32
+        assert board.channel_spec == "H"
+        assert board.color_spec == olsndots.Olsndot.ColorSpec.rgbw
+        assert board.status.frame_overruns == 0
+
+    poller = olsndots.TelemetryPoller(boards, timeout=0.1)
+    assert poller.poll() is not None
+    assert poller.poll() is not None
+    assert sorted(poller.status) == [0x23420001, 0x23420002]
+    assert poller.errors == 0
+
+
+def test_send_framebufs(bus):
+    """Frames reach the addressed boards"""
+    boards = [olsndots.Olsndot(0x23420001), olsndots.Olsndot(0x23420002)]
+    driver = olsndots.Driver(bus.path, devices=boards, baudrate=1000000)
+
+    for i in range(10):
+        driver.send_framebufs([(boards[0], [i] * 32),
+                               (boards[1], [65535 - i] * 32)])
+
+    status = boards[0].fetch_status()
+    nodes = bus.nodes
+    assert nodes[0x23420001].frames == 10
+    assert nodes[0x23420001].framebuf == (9,) * 32
+    assert nodes[0x23420002].framebuf == (65526,) * 32
+    assert status.invalid_frames == 0
+
+
+def test_frame_overruns():
+    """Frames arriving while a board is busy are dropped"""
+    node = olsndots_sim.VirtualOlsndot(1, processing_time=0.01)
+    frame = b"\x00" * node.frame_size
+
+    node.handle(frame, now=1.0)
+    node.handle(frame, now=1.005)
+    node.handle(frame, now=1.02)
+    node.handle(b"\x00" * 3, now=1.03)
+
+    assert node.frames == 2
+    assert node.frame_overruns == 1
+    assert node.invalid_frames == 1
+
+
+def test_probe(bus):
+    """All nodes are queried with a single write"""
+    driver = olsndots.Driver(bus.path, baudrate=1000000)
+
+    replies = dict(olsndots.Olsndot.probe(driver, [0x23420001, 0x23420002]))
+    assert sorted(replies) == [0x23420001, 0x23420002]
+
+    board = olsndots.Olsndot(0x23420001)
+    board.apply_status(replies[0x23420001])
+    assert board.nchannels == 32
+    assert board.describe()["type"] == 0x01
+
+
+def test_probe_missing(bus):
+    """A missing node is detected, the others are still matched"""
+    driver = olsndots.Driver(bus.path, baudrate=1000000)
+
+    addrs = [0x23420001, 0x23420009, 0x23420002]
+    replies = list(olsndots.Olsndot.probe(driver, addrs, timeout=0.05))
+
+    assert [addr for addr, _ in replies] == addrs
+    assert replies[0][1] is not None
+    assert replies[1][1] is None
+    assert replies[2][1] is not None
+
+
+def test_poll_timeout(bus):
+    """A node that does not answer blocks the poll for the given timeout"""
+    driver = olsndots.Driver(bus.path, baudrate=1000000)
+    missing = olsndots.Olsndot(0x23420009, driver)
+
+    poller = olsndots.TelemetryPoller([missing], timeout=0.5)
+    rtt = poller.rtt
+    t_start = time.monotonic()
+    assert poller.poll(timeout=0.02) is None
+    assert time.monotonic() - t_start < 0.25
+    assert poller.errors == 1
+    assert poller.rtt == rtt
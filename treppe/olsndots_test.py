@@ -0,0 +1,121 @@
+import struct
+
+from cobs import cobs
+
+from treppe import olsndots
+
+
+def _make_node(addr, nchannels=4):
+    node = olsndots.Olsndot(addr)
+    node.nchannels = nchannels
+    node.channel_spec = "H"
+    return node
+
+
+def _read_packets(driver, size):
+    data = driver._ser.read(size)
+    return [cobs.decode(p) for p in data.split(olsndots.EOP)[:-1]]
+
+
+def test_send_framebufs():
+    """Send all framebuffers with a single write"""
+    driver = olsndots.Driver("loop://", devices=[])
+    driver._ser.timeout = 0.1
+
+    nodes = [_make_node(0x23420001), _make_node(0x23420002)]
+    frames = [(nodes[0], [0, 1, 2, 65535]),
+              (nodes[1], [4, 0, 256, 7])]
+
+    size = driver.send_framebufs(frames)
+    assert driver.bytes_per_frame == size
+    assert driver.frames_sent == 1
+    assert driver.bytes_sent == size
+
+    packets = _read_packets(driver, size)
+    assert packets == [
+        olsndots.address_pkt(0x23420001),
+        b"\x00\x00\x01\x00\x02\x00\xff\xff",
+        olsndots.address_pkt(0x23420002),
+        b"\x04\x00\x00\x00\x00\x01\x07\x00",
+    ]
+
+    # Same as sending one by one
+    for node, data in frames:
+        node._driver = driver
+        node.send_framebuf(data)
+
+    assert _read_packets(driver, size) == packets
+
+
+def test_send_framebufs_grow():
+    """The transmit buffer grows for large frames"""
+    driver = olsndots.Driver("loop://", devices=[])
+    driver._ser.timeout = 0.1
+
+    node = _make_node(1, nchannels=1024)
+    size = driver.send_framebufs([(node, [0xabcd] * 1024)])
+
+    assert size > 2048
+    assert len(_read_packets(driver, size)) == 2
+
+
+
+def test_telemetry_poller_errors():
+    """Failed status reads are counted, nodes are polled round robin"""
+    driver = olsndots.Driver("loop://", devices=[])
+
+    nodes = [_make_node(1), _make_node(2)]
+    for node in nodes:
+        node._driver = driver
+
+    poller = olsndots.TelemetryPoller(nodes, interval=1.0, timeout=0.01)
+    assert poller.due(now=1000.0)
+
+    # The loopback echoes the request, which is no status reply
+    assert poller.poll() is None
+    assert not poller.due()
+    assert poller.poll() is None
+
+    assert poller.polls == 2
+    assert poller.errors == 2
+    assert poller.status == {}
+
+
+def test_node_table(tmp_path):
+    """Nodes are restored from the saved table"""
+    path = str(tmp_path / "nodes.json")
+    node = _make_node(0x23420001, nchannels=32)
+    node.fw_ver = 1
+    node.hw_ver = 2
+    node.nbits = 16
+    node.color_spec = olsndots.Olsndot.ColorSpec.rgbw
+
+    table = olsndots.NodeTable(path).load()
+    assert table.ports == {}
+    assert table.update("/dev/ttyUSB0", node)
+    assert not table.update("/dev/ttyUSB0", node)
+    table.save()
+
+    table = olsndots.NodeTable(path).load()
+    entry = table.get("/dev/ttyUSB0", 0x23420001)
+    assert table.get("/dev/ttyUSB1", 0x23420001) is None
+
+    restored = olsndots.Olsndot(0x23420001)
+    restored.restore(entry, None)
+    assert restored.describe() == node.describe()
+
+
+def test_packet_struct():
+    """Encoded packets match the generic cobs path"""
+    for fmt, args in [("I", [0x23420001]),
+                      ("B", [olsndots.Olsndot.CMD_READ_STATUS]),
+                      ("32H", [(i * 4099) % 65536 for i in range(32)]),
+                      ("200H", [i % 3 for i in range(200)])]:
+        packet = olsndots.PacketStruct(fmt)
+        buf = bytearray(3 + packet.max_encoded)
+
+        end = packet.encode_into(buf, 3, args)
+
+        expected = cobs.encode(struct.pack("<" + fmt, *args)) + olsndots.EOP
+        assert bytes(buf[3:end]) == expected
+        assert end - 3 <= packet.max_encoded
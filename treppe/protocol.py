@@ -6,6 +6,8 @@ Commands:
 
 0x23 - Set Channel to 16 bit RGBW value (Direct to serial)
 0x42 - Set frame with RGB(W) values
+0x43 - Set a batch of frames with presentation times
+0x44 - Update changed channels of the last frame
 
 
 Flags:
@@ -25,17 +27,63 @@ Frame:
 
 [1 Byte Cmd, 1 Byte Frame, Payload]
 
+
+Frame Batch:
+
+[1 Byte Cmd, 1 Byte Frame, 1 Byte Count, 1 Byte Channels,
+ 4 Byte Time (ms, Big Endian),
+ Count * [2 Byte Offset (ms, Big Endian), Channels * RGB(A) Values]]
+
+The time is the sender's monotonic clock (wrapping),
+each frame is presented at time + offset.
+
+
+Frame Delta:
+
+[1 Byte Cmd, 1 Byte Frame, 1 Byte Channels,
+ (Channels + 7) / 8 Byte Changed Mask,
+ RGB(A) Values of changed channels]
+
+Bit 7 of the first mask byte is channel 0. Channels not in
+the mask keep their value from the previous frame.
+
+
+Header Extension:
+
+Any packet can be prefixed with a header extension:
+
+[1 Byte 0x48, 1 Byte Version, 1 Byte Header Size, 1 Byte Reserved,
+ 4 Byte Sequence Number (Big Endian, wrapping),
+ 8 Byte Send Time (us, monotonic clock, Big Endian),
+ Packet]
+
+Later versions may append fields; receivers skip the
+extension by its size. Packets without extension are
+read as before.
+
 """
 
 import collections
+import selectors
+import struct
 import time
-import select
+
+import numpy as np
+
+from treppe import quantize
 
 CHANNELS_AVAILABLE = 16
 
 CMD_INVALID = 0x00
 CMD_SET_DIRECT = 0x23
 CMD_FRAME = 0x42
+CMD_FRAME_BATCH = 0x43
+CMD_FRAME_DELTA = 0x44
+
+HEADER_EXT = 0x48
+HEADER_EXT_VERSION = 0x01
+
+PACKET_SIZE_MAX = 2048
 
 FLAG_RGB = 0x01
 FLAG_RGBA = 0x02
@@ -50,20 +98,415 @@ DecodeResult = collections.namedtuple("DecodeResult", [
                                       "flags",
                                       "payload"])
 
+FrameBatch = collections.namedtuple("FrameBatch", [
+                                    "time",
+                                    "frames"])
+
+PacketHeader = collections.namedtuple("PacketHeader", [
+                                      "version",
+                                      "seq",
+                                      "time",
+                                      "size"])
+
+
+class Frame:
+    """
+    A reusable frame buffer for decode_packet_into.
+
+    Values are stored as 16 bit RGBW integers in a
+    (capacity, 4) array. 8 bit values are expanded to the
+    full 16 bit range, missing white components are 0.
+    """
+    __slots__ = ("cmd", "flags", "channels", "values", "seq", "time",
+                 "_float")
+
+    def __init__(self, capacity=CHANNELS_AVAILABLE):
+        self.cmd = CMD_INVALID
+        self.flags = 0x00
+        self.channels = 0
+        self.seq = None
+        self.time = None
+        self.values = np.zeros((capacity, 4), dtype=np.uint16)
+        self._float = np.zeros((capacity, 4), dtype=np.float32)
+
+    def __len__(self):
+        return self.channels
+
+    def to_float(self):
+        """
+        Get all channels as (capacity, 4) float32 array.
+        The array is reused and overwritten on the next call.
+        """
+        return quantize.decode_16(self.values, out=self._float)
+
+    def to_list(self):
+        """Get the decoded channels as list of rgbw tuples"""
+        return _frame_to_list(self.to_float()[:self.channels])
+
+
+class Sequencer:
+    """
+    Prefix packets with a header extension carrying
+    a sequence number and the monotonic send time.
+    """
+
+    def __init__(self, seq=0):
+        self.seq = seq
+
+    def wrap(self, packet, t=None):
+        """Prefix a packet with the next header extension"""
+        if t is None:
+            t = time.monotonic()
+
+        header = _HEADER_EXT.pack(HEADER_EXT,
+                                  HEADER_EXT_VERSION,
+                                  _HEADER_EXT.size,
+                                  self.seq,
+                                  int(t * 1000000.0))
+        self.seq = (self.seq + 1) & 0xffffffff
+
+        return header + packet
+
+
+class LatencyStats:
+    """Minimum, maximum and mean of latencies in seconds"""
 
-def receive_sockets(sock_a, sock_b):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        if not self.count:
+            return "-"
+        return "{:.2f}/{:.2f}/{:.2f} ms".format(
+            self.min * 1000.0, self.mean * 1000.0, self.max * 1000.0)
+
+
+class SequenceTracker:
+    """
+    Track the sequence numbers of a packet stream.
+
+    Duplicated and stale (reordered) packets are rejected,
+    gaps in the sequence are counted as lost. A jump by more
+    than resync packets is taken as a restart of the sender.
+
+    The latency is measured from the send time to the arrival.
+    It is only meaningful if sender and receiver share the
+    monotonic clock, e.g. run on the same host.
+
+    The gap is the number of packets lost right before
+    the last new one, e.g. to resync delta frames.
+    """
+
+    def __init__(self, resync=1024):
+        self.resync = resync
+        self.gap = 0
+
+        self.accepted = 0
+        self.superseded = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicated = 0
+        self.latency = LatencyStats()
+
+        self._seq = None
+
+    def _check(self, seq):
+        """Check a sequence number and advance to it if it is new"""
+        if self._seq is not None:
+            delta = (seq - self._seq) & 0xffffffff
+            if delta == 0:
+                self.duplicated += 1
+                return False
+
+            self.gap = 0
+            if delta < 0x80000000:
+                if delta <= self.resync:
+                    self.gap = delta - 1
+                    self.lost += self.gap
+            elif 0x100000000 - delta <= self.resync:
+                # Arrived after a newer packet: it was not lost,
+                # but we can not use it anymore.
+                self.reordered += 1
+                self.lost = max(0, self.lost - 1)
+                return False
+
+        self._seq = seq
+        return True
+
+    def supersede(self, seq):
+        """
+        Mark a packet as received that was superseded
+        before it was checked, so it is not counted as lost.
+
+        :returns: True if the packet is new
+        :rtype: bool
+        """
+        if not self._check(seq):
+            return False
+
+        self.superseded += 1
+        return True
+
+    def accept(self, seq, t_send=None, now=None):
+        """
+        Check a sequence number.
+
+        :returns: True if the packet is new
+        :rtype: bool
+        """
+        if not self._check(seq):
+            return False
+
+        self.accepted += 1
+
+        if t_send is not None:
+            if now is None:
+                now = time.monotonic()
+            self.latency.add(now - t_send)
+
+        return True
+
+    def __str__(self):
+        return "accepted {} superseded {} lost {} reordered {} " \
+               "duplicated {} latency {}".format(self.accepted,
+                                                 self.superseded,
+                                                 self.lost,
+                                                 self.reordered,
+                                                 self.duplicated,
+                                                 self.latency)
+
+
+class Receiver:
+    """
+    Receive datagrams from several sockets.
+
+    On every wakeup each readable socket is drained completely
+    with recv_into into a pool of preallocated buffers.
+    The packets are yielded as (source, memoryview) and are
+    only valid until the next iteration.
+
+    In latest only mode, a full frame supersedes all packets
+    received before it from the same source in the same wakeup,
+    so a backlog never builds up behind a slow consumer. The
+    buffers of superseded packets are reused. Superseded packets
+    with a header extension are marked as received in the
+    SequenceTracker of their source, if trackers are given.
+
+    When all buffers hold packets, draining stops and the rest
+    is received on the next wakeup; this is counted in overflows.
+
+    When no data arrives within timeout seconds, (None, None)
+    is yielded. The timeout can be a callable returning the
+    timeout (or None to wait forever) before each wait.
+    """
+
+    def __init__(self, sockets, latest_only=False, timeout=None, buffers=64,
+                 trackers=None):
+        self.latest_only = latest_only
+        self.timeout = timeout
+        self.trackers = trackers
+
+        self.received = {}
+        self.superseded = {}
+        self.overflows = {}
+
+        self._sockets = {}
+        self._selector = selectors.DefaultSelector()
+        for source, sock in sockets.items():
+            sock.setblocking(False)
+            views = [memoryview(bytearray(PACKET_SIZE_MAX))
+                     for _ in range(buffers)]
+            self._sockets[source] = (sock, views)
+            self._selector.register(sock, selectors.EVENT_READ, source)
+            self.received[source] = 0
+            self.superseded[source] = 0
+            self.overflows[source] = 0
+
+    @property
+    def sockets(self):
+        """The sockets by source"""
+        return {source: sock for source, (sock, _) in self._sockets.items()}
+
+    def _supersede(self, source, packets):
+        """Count the packets superseded by a full frame"""
+        self.superseded[source] += len(packets)
+        if self.trackers is None:
+            return
+
+        for view, n in packets:
+            try:
+                header = decode_header(view, n)
+            except ValueError:
+                continue # invalid data
+            if header is not None:
+                sequence_tracker(self.trackers, source).supersede(header.seq)
+
+    def drain(self, source):
+        """
+        Receive the datagrams queued on the socket of a source
+        without waiting.
+
+        :returns: The packets as memoryviews, valid until
+                  the source is drained again
+        :rtype: list
+        """
+        sock, views = self._sockets[source]
+
+        free = list(views)
+        packets = []
+        while free:
+            view = free.pop()
+            try:
+                n = sock.recv_into(view)
+            except BlockingIOError:
+                break
+
+            if self.latest_only and packet_cmd(view, n) == CMD_FRAME:
+                self._supersede(source, packets)
+                free.extend(view for view, _ in packets)
+                packets.clear()
+
+            packets.append((view, n))
+        else:
+            self.overflows[source] += 1
+
+        self.received[source] += len(packets)
+
+        return [view[:n] for view, n in packets]
+
+    def __iter__(self):
+        while 42:
+            timeout = self.timeout
+            wait = timeout() if callable(timeout) else timeout
+            events = self._selector.select(wait)
+            if not events:
+                yield (None, None)
+
+            for key, _ in events:
+                source = key.data
+                for packet in self.drain(source):
+                    yield (source, packet)
+
+    def close(self):
+        self._selector.close()
+
+
+def receive_sockets(sock_a, sock_b, timeout=None, latest_only=False):
     """
     Receive from both sockets.
+
+    See Receiver for timeout and latest_only.
     """
-    while 42:
-        sockets, _, _ = select.select([sock_a, sock_b], [], [])
-        packet = None
-        for sock in sockets:
-            data = sock.recv(2048)
-            if sock == sock_a:
-                yield ('a', data)
-            else:
-                yield ('b', data)
+    yield from Receiver({'a': sock_a, 'b': sock_b},
+                        latest_only=latest_only,
+                        timeout=timeout)
+
+
+class Source:
+    """
+    A packet source of an Arbiter with its counters.
+    """
+    __slots__ = ("name", "priority", "holdoff", "last_seen",
+                 "accepted", "suppressed")
+
+    def __init__(self, name, priority=0, holdoff=0.0):
+        self.name = name
+        self.priority = priority
+        self.holdoff = holdoff
+        self.last_seen = float("-inf")
+        self.accepted = 0
+        self.suppressed = 0
+
+    def __str__(self):
+        return "priority {} accepted {} suppressed {}".format(
+            self.priority, self.accepted, self.suppressed)
+
+
+class Arbiter:
+    """
+    Arbitrate between packet sources of different priority.
+
+    After a source sent a packet, all sources with a lower
+    priority are suppressed for the holdoff of that source.
+    Sources with the same priority are all accepted.
+    """
+
+    def __init__(self, sources):
+        """
+        :param sources: Priority and holdoff for each source name
+        :type sources: dict
+        """
+        self.sources = {name: Source(name, priority, holdoff)
+                        for name, (priority, holdoff) in sources.items()}
+        self._active = None
+
+    def _elect(self, now):
+        """Get the source with the highest priority still holding off"""
+        active = None
+        for source in self.sources.values():
+            if source.last_seen + source.holdoff <= now:
+                continue
+            if active is None or source.priority > active.priority:
+                active = source
+
+        return active
+
+    def accept(self, name, now=None):
+        """
+        Check a packet from a source.
+
+        :returns: True if the packet should be used
+        :rtype: bool
+        """
+        if now is None:
+            now = time.monotonic()
+
+        source = self.sources[name]
+        source.last_seen = now
+
+        active = self._active
+        if active is None or active.last_seen + active.holdoff <= now:
+            active = self._elect(now)
+        if active is None or source.priority > active.priority:
+            active = source
+        self._active = active
+
+        if source.priority < active.priority:
+            source.suppressed += 1
+            return False
+
+        source.accepted += 1
+        return True
+
+    def filter(self, reader):
+        """
+        Drop suppressed packets from a reader yielding
+        (source, packet). Idle ticks are passed on.
+        """
+        accept = self.accept
+        for source, packet in reader:
+            if source is None or accept(source):
+                yield (source, packet)
 
 
 def demultiplex_sockets(reader, gracetime):
@@ -73,28 +516,134 @@ def demultiplex_sockets(reader, gracetime):
     Socket b has priority over a, so when data is
     received on b, any data from a is discarded for a grace period
     to prevent oversplill.
+
+    Idle ticks of the reader are passed on as None.
+    """
+    arbiter = Arbiter({'a': (0, 0.0), 'b': (1, gracetime)})
+    for _, packet in arbiter.filter(reader):
+        yield packet
+
+
+def sequence_tracker(trackers, source):
+    """
+    Get the SequenceTracker of a source,
+    it is created in the trackers dict on first use.
+    """
+    tracker = trackers.get(source)
+    if tracker is None:
+        tracker = trackers[source] = SequenceTracker()
+
+    return tracker
+
+
+def drop_stale_packets(reader, trackers):
+    """
+    Drop duplicated and out of order packets.
+
+    Packets with header extension are checked against
+    a SequenceTracker per source, which are created
+    in the trackers dict. Packets without extension,
+    already decoded Frames and idle ticks are passed on.
     """
-    t_b = 0
     for source, packet in reader:
-        t = time.time()
-        if source == 'b':
-            t_b = t
-            yield packet
+        if packet is None or isinstance(packet, Frame):
+            yield (source, packet)
             continue
-        if t_b + gracetime < t:
-            yield packet
+
+        try:
+            header = decode_header(packet)
+        except ValueError:
+            continue # invalid data
+
+        if header is not None:
+            tracker = sequence_tracker(trackers, source)
+            if not tracker.accept(header.seq, header.time):
+                continue
+
+        yield (source, packet)
 
 
-def decode_packet(data):
+def decode_header(buf, nbytes=None):
+    """
+    Decode the header extension of a packet.
+
+    :returns: The header or None for packets without extension
+    :rtype: PacketHeader
+    """
+    if nbytes is None:
+        nbytes = len(buf)
+    if nbytes < 1 or buf[0] != HEADER_EXT:
+        return None
+
+    if nbytes < _HEADER_EXT.size:
+        raise ValueError("truncated header extension")
+
+    _, version, size, seq, t_us = _HEADER_EXT.unpack_from(buf)
+    if size < _HEADER_EXT.size or size > nbytes:
+        raise ValueError("invalid header extension size")
+
+    return PacketHeader(version, seq, t_us / 1000000.0, size)
+
+
+def split_header(buf, nbytes=None):
+    """
+    Split the header extension off a packet without copying.
+
+    :returns: The header (or None) and the packet and
+              its size without the extension
+    :rtype: tuple
+    """
+    if nbytes is None:
+        nbytes = len(buf)
+
+    header = decode_header(buf, nbytes)
+    if header is None:
+        return None, buf, nbytes
+
+    return header, memoryview(buf)[header.size:nbytes], nbytes - header.size
+
+
+def packet_cmd(buf, nbytes=None):
+    """
+    Get the command of a packet without decoding it.
+    The header extension is skipped.
+    """
+    if nbytes is None:
+        nbytes = len(buf)
+    if nbytes < 1:
+        return CMD_INVALID
+
+    offset = 0
+    if buf[0] == HEADER_EXT:
+        if nbytes < 3:
+            return CMD_INVALID
+        offset = buf[2]
+        if offset >= nbytes:
+            return CMD_INVALID
+
+    return buf[offset]
+
+
+def decode_packet(data, as_array=False):
     """
     Read and decode packet from socket.
 
     :param sock: The socket to read from
     :type sock: socket.socket
 
+    :param as_array: Decode frames as (channels, 4) float32 array
+    :type as_array: bool
+
     :returns: The decoded command
     :rtype: DecodeResult
     """
+    try:
+        header, data, _ = split_header(data)
+    except ValueError:
+        return DecodeResult(CMD_INVALID, 0x00, None)
+    if header is not None:
+        data = bytes(data)
+
     cmd = data[0]
     flags = data[1]
     payload_data = data[2:]
@@ -105,145 +654,472 @@ def decode_packet(data):
         payload = payload_data[:8] # RRGGBBWW
     elif cmd == CMD_FRAME:
         try:
-            payload = decode_frame(payload_data, flags)
+            payload = decode_frame(payload_data, flags, as_array)
+        except Exception as e:
+            return DecodeResult(CMD_INVALID, 0x00, None)
+    elif cmd == CMD_FRAME_BATCH:
+        try:
+            payload = decode_frame_batch(data, as_array)
+        except Exception as e:
+            return DecodeResult(CMD_INVALID, 0x00, None)
+    elif cmd == CMD_FRAME_DELTA:
+        try:
+            payload = decode_frame_delta(data)
         except Exception as e:
             return DecodeResult(CMD_INVALID, 0x00, None)
 
     return DecodeResult(cmd, flags, payload)
 
 
+def _frame_layout(flags):
+    """
+    Get the payload layout of a frame as
+    (components, dtype, expand table) or None for invalid flags.
+    """
+    if flags & FLAG_RGB:
+        components = 3
+    elif flags & FLAG_RGBA:
+        components = 4
+    else:
+        return None
+
+    if flags & FLAG_BITS_8:
+        return (components, _DTYPE_8, quantize.EXPAND_8)
+
+    return (components, _DTYPE_16, None)
+
+
+def decode_packet_into(buf, frame, nbytes=None):
+    """
+    Decode a packet into a preallocated frame.
+
+    The payload is read straight from buf (e.g. the buffer
+    filled by sock.recv_into) without intermediate bytes
+    or tuples.
+
+    :param buf: The received data
+    :type buf: bytes-like
+
+    :param frame: The frame to decode into
+    :type frame: Frame
+
+    :param nbytes: Number of valid bytes in buf (default: all)
+    :type nbytes: int
+
+    :returns: The decoded command
+    :rtype: int
+    """
+    if nbytes is None:
+        nbytes = len(buf)
+
+    frame.cmd = CMD_INVALID
+    frame.seq = None
+    frame.time = None
+
+    try:
+        header, buf, nbytes = split_header(buf, nbytes)
+    except ValueError:
+        return CMD_INVALID
+    if header is not None:
+        frame.seq = header.seq
+        frame.time = header.time
+
+    if nbytes < 2:
+        return CMD_INVALID
+
+    cmd = buf[0]
+    flags = buf[1]
+    values = frame.values
+
+    if cmd == CMD_SET_DIRECT:
+        if nbytes < 10 or flags >= len(values):
+            return CMD_INVALID
+        values[flags] = np.frombuffer(buf, dtype=_DTYPE_16, count=4, offset=2)
+        frame.channels = max(frame.channels, flags + 1)
+
+    elif cmd == CMD_FRAME:
+        if not decode_frame_into(buf, frame, flags, 2, nbytes - 2):
+            return CMD_INVALID
+
+    elif cmd == CMD_FRAME_DELTA:
+        if not decode_frame_delta_into(buf, frame, nbytes):
+            return CMD_INVALID
+
+    else:
+        return CMD_INVALID
+
+    frame.cmd = cmd
+    frame.flags = flags
+
+    return cmd
+
+
+def decode_frame_into(buf, frame, flags, offset, size):
+    """
+    Decode a frame payload of size bytes starting at offset
+    in buf into a preallocated frame.
+
+    :returns: True if the payload was valid
+    :rtype: bool
+    """
+    layout = _FRAME_LAYOUTS[flags]
+    if layout is None:
+        return False
+
+    components, dtype, expand = layout
+    channel_size = components * dtype.itemsize
+    if size % channel_size != 0:
+        return False
+
+    values = frame.values
+    n = min(size // channel_size, len(values))
+    payload = np.frombuffer(buf, dtype=dtype,
+                            count=n * components,
+                            offset=offset).reshape(n, components)
+    if expand is None:
+        values[:n, :components] = payload
+    else:
+        np.take(expand, payload, out=values[:n, :components])
+
+    values[:n, components:] = 0
+    values[n:] = 0
+    frame.channels = n
+
+    return True
+
+
+def _parse_frame_delta(buf, nbytes):
+    """
+    Parse the header of a delta frame.
+
+    :returns: The payload layout, the number of channels,
+              the sorted indices of the changed channels
+              and their values
+    :rtype: tuple
+    """
+    if nbytes < 3:
+        raise ValueError("truncated frame delta")
+
+    layout = _FRAME_LAYOUTS[buf[1]]
+    if layout is None:
+        raise ValueError("invalid frame flags: {:#x}".format(buf[1]))
+    components, dtype, _ = layout
+
+    channels = buf[2]
+    mask_size = (channels + 7) // 8
+    mask = np.frombuffer(buf, dtype=np.uint8, count=mask_size, offset=3)
+    changed = np.flatnonzero(np.unpackbits(mask, count=channels))
+
+    offset = 3 + mask_size
+    if nbytes != offset + len(changed) * components * dtype.itemsize:
+        raise ValueError("invalid frame delta size")
+
+    payload = np.frombuffer(buf, dtype=dtype,
+                            count=len(changed) * components,
+                            offset=offset).reshape(-1, components)
+
+    return layout, channels, changed, payload
+
+
+def decode_frame_delta(data):
+    """
+    Decode a delta frame packet.
+
+    :returns: The changed channels as list of (channel, rgbw)
+    :rtype: list
+    """
+    layout, _, changed, payload = _parse_frame_delta(data, len(data))
+    _, dtype, _ = layout
+    values = _decode_frame_array(payload.tobytes(), payload.shape[1], dtype)
+
+    return list(zip(changed.tolist(), _frame_to_list(values)))
+
+
+def decode_frame_delta_into(buf, frame, nbytes=None):
+    """
+    Apply a delta frame packet to a preallocated frame.
+    Only the changed channels are decoded.
+
+    :returns: True if the packet was valid
+    :rtype: bool
+    """
+    if nbytes is None:
+        nbytes = len(buf)
+    try:
+        layout, channels, changed, payload = _parse_frame_delta(buf, nbytes)
+    except ValueError:
+        return False
+
+    components, _, expand = layout
+    values = frame.values
+
+    # Ignore channels we can not hold
+    n = np.searchsorted(changed, len(values))
+    changed = changed[:n]
+    payload = payload[:n]
+
+    if expand is None:
+        values[changed, :components] = payload
+    else:
+        values[changed, :components] = expand[payload]
+    values[changed, components:] = 0
+
+    frame.channels = min(channels, len(values))
+
+    return True
+
+
+def _batch_frame_size(flags, channels):
+    """Get the size of a single frame payload in a batch"""
+    layout = _FRAME_LAYOUTS[flags]
+    if layout is None:
+        raise ValueError("invalid frame flags: {:#x}".format(flags))
+    components, dtype, _ = layout
+
+    return channels * components * dtype.itemsize
+
+
+def frame_batch_time(data):
+    """Get the send time of a batch packet in seconds"""
+    (t_ms,) = _BATCH_TIME.unpack_from(data, _BATCH_HEADER.size - 4)
+    return t_ms / 1000.0
+
+
+def iter_frame_batch(data):
+    """
+    Iterate the frames of a batch packet without decoding them.
+
+    Yields (time, offset, size) for each frame, where time is
+    the presentation time in seconds on the sender's clock
+    and offset and size locate the frame payload in data.
+    """
+    _, flags, count, channels, t_ms = _BATCH_HEADER.unpack_from(data)
+    frame_size = _batch_frame_size(flags, channels)
+    offset = _BATCH_HEADER.size
+    if len(data) < offset + count * (_BATCH_OFFSET.size + frame_size):
+        raise ValueError("truncated frame batch")
+
+    for _ in range(count):
+        (dt_ms,) = _BATCH_OFFSET.unpack_from(data, offset)
+        offset += _BATCH_OFFSET.size
+        yield ((t_ms + dt_ms) / 1000.0, offset, frame_size)
+        offset += frame_size
+
+
+def decode_frame_batch(data, as_array=False):
+    """
+    Decode a batch packet.
+
+    :returns: The batch time and a list of (time, frame)
+    :rtype: FrameBatch
+    """
+    _, flags, _, _, t_ms = _BATCH_HEADER.unpack_from(data)
+    frames = [(t, decode_frame(data[offset:offset + size], flags, as_array))
+              for t, offset, size in iter_frame_batch(data)]
+
+    return FrameBatch(t_ms / 1000.0, frames)
+
+
+# Single value codecs
+
+_RGB8 = struct.Struct(">3B")
+_RGBW8 = struct.Struct(">4B")
+_RGB16 = struct.Struct(">3H")
+_RGBW16 = struct.Struct(">4H")
+
+
 def encode_rgb8(r, g, b):
-    return bytes([int(r * 255.0),
-                  int(g * 255.0),
-                  int(b * 255.0)])
+    return _RGB8.pack(int(r * 255.0),
+                      int(g * 255.0),
+                      int(b * 255.0))
 
 
 def encode_rgbw8(r, g, b, w):
-    return bytes([int(r * 255.0),
-                  int(g * 255.0),
-                  int(b * 255.0),
-                  int(w * 255.0)])
+    return _RGBW8.pack(int(r * 255.0),
+                       int(g * 255.0),
+                       int(b * 255.0),
+                       int(w * 255.0))
 
 
 def encode_rgb16(r, g, b):
-    return int(r * 65535.0).to_bytes(2, "big") + \
-           int(g * 65535.0).to_bytes(2, "big") + \
-           int(b * 65535.0).to_bytes(2, "big")
+    return _RGB16.pack(int(r * 65535.0),
+                       int(g * 65535.0),
+                       int(b * 65535.0))
 
 
 def encode_rgbw16(r, g, b, w):
-    return int(r * 65535.0).to_bytes(2, "big") + \
-           int(g * 65535.0).to_bytes(2, "big") + \
-           int(b * 65535.0).to_bytes(2, "big") + \
-           int(w * 65535.0).to_bytes(2, "big")
+    return _RGBW16.pack(int(r * 65535.0),
+                        int(g * 65535.0),
+                        int(b * 65535.0),
+                        int(w * 65535.0))
 
 
 def decode_rgbw8(payload):
-    r = float(int(payload[0])) / 255.0
-    g = float(int(payload[1])) / 255.0
-    b = float(int(payload[2])) / 255.0
-    w = float(int(payload[3])) / 255.0
-
-    return (r, g, b, w)
+    r, g, b, w = _RGBW8.unpack_from(payload)
+    return (r / 255.0, g / 255.0, b / 255.0, w / 255.0)
 
 
 def decode_rgbw16(payload):
-    r = float(int.from_bytes(payload[0:2], "big")) / 65535.0
-    g = float(int.from_bytes(payload[2:4], "big")) / 65535.0
-    b = float(int.from_bytes(payload[4:6], "big")) / 65535.0
-    w = float(int.from_bytes(payload[6:8], "big")) / 65535.0
-
-    return (r, g, b, w)
+    r, g, b, w = _RGBW16.unpack_from(payload)
+    return (r / 65535.0, g / 65535.0, b / 65535.0, w / 65535.0)
 
 
 def decode_rgb8(payload):
-    r = float(int(payload[0])) / 255.0
-    g = float(int(payload[1])) / 255.0
-    b = float(int(payload[2])) / 255.0
-
-    return (r, g, b, 0.0)
+    r, g, b = _RGB8.unpack_from(payload)
+    return (r / 255.0, g / 255.0, b / 255.0, 0.0)
 
 
 def decode_rgb16(payload):
-    r = float(int.from_bytes(payload[0:2], "big")) / 65535.0
-    g = float(int.from_bytes(payload[2:4], "big")) / 65535.0
-    b = float(int.from_bytes(payload[4:6], "big")) / 65535.0
+    r, g, b = _RGB16.unpack_from(payload)
+    return (r / 65535.0, g / 65535.0, b / 65535.0, 0.0)
+
+
+# Frame codecs
+#
+# All frame codecs work on the whole frame at once:
+# The payload is viewed as an (channels, components) array
+# of big endian integers and converted in a single step
+# (see treppe.quantize).
 
-    return (r, g, b, 0.0)
+_DTYPE_8 = np.dtype("u1")
+_DTYPE_16 = np.dtype(">u2")
+
+_FRAME_LAYOUTS = [_frame_layout(flags) for flags in range(256)]
+
+_BATCH_HEADER = struct.Struct(">BBBBI")
+_BATCH_OFFSET = struct.Struct(">H")
+_BATCH_TIME = struct.Struct(">I")
+
+_HEADER_EXT = struct.Struct(">BBBxIQ")
+
+
+def _decode_frame_array(data, components, dtype):
+    """
+    Decode a frame payload into a (channels, 4) float32 array.
+    Missing white components are set to 0.
+    """
+    values = np.frombuffer(data, dtype=dtype).reshape(-1, components)
+    frame = np.zeros((len(values), 4), dtype=np.float32)
+    if dtype == _DTYPE_8:
+        quantize.decode_8(values, out=frame[:, :components])
+    else:
+        quantize.decode_16(values, out=frame[:, :components])
+
+    return frame
+
+
+def _frame_to_list(frame):
+    """Convert a (channels, 4) array to a list of rgbw tuples"""
+    return list(map(tuple, frame.tolist()))
+
+
+def _frame_array(frame, components, channels):
+    """
+    Get a (channels, components) float array from a frame.
+    The frame can be a list of rgb(w) tuples or an array.
+    It is padded with black or truncated to the number of channels.
+    """
+    out = np.zeros((channels, components), dtype=np.float64)
+    if len(frame) == 0:
+        return out
 
+    values = np.asarray(frame, dtype=np.float64)
+    if values.ndim != 2:
+        raise ValueError("frame must be a sequence of rgb(w) values")
 
-def decode_frame(data, flags):
+    n = min(len(values), channels)
+    k = min(values.shape[1], components)
+    out[:n, :k] = values[:n, :k]
+
+    return out
+
+
+def _quantize_frame_array(frame, components, dtype, max_value, channels):
+    """Quantize a frame with a single scale to big endian integers"""
+    values = _frame_array(frame, components, channels)
+    np.clip(values, 0.0, 1.0, out=values)
+    values *= max_value
+
+    return values.astype(dtype)
+
+
+def _encode_frame_array(frame, components, dtype, max_value, channels):
+    """Encode a frame with a single scale into big endian integers"""
+    return _quantize_frame_array(
+        frame, components, dtype, max_value, channels).tobytes()
+
+
+def decode_frame(data, flags, as_array=False):
     if flags & FLAG_RGB:
         if flags & FLAG_BITS_8:
-            return decode_frame_rgb8(data)
+            return decode_frame_rgb8(data, as_array)
         else:
-            return decode_frame_rgb16(data)
+            return decode_frame_rgb16(data, as_array)
 
     elif flags & FLAG_RGBA:
         if flags & FLAG_BITS_8:
-            return decode_frame_rgbw8(data)
+            return decode_frame_rgbw8(data, as_array)
         else:
-            return decode_frame_rgbw16(data)
+            return decode_frame_rgbw16(data, as_array)
 
 
-def decode_frame_rgb8(data):
-    return [decode_rgb8(data[i:i+3]) for i in range(0, len(data), 3)]
+def decode_frame_rgb8(data, as_array=False):
+    frame = _decode_frame_array(data, 3, _DTYPE_8)
+    if as_array:
+        return frame
+    return _frame_to_list(frame)
 
-def decode_frame_rgbw8(data):
-    return [decode_rgbw8(data[i:i+4]) for i in range(0, len(data), 4)]
 
-def decode_frame_rgb16(data):
-    return [decode_rgb16(data[i:i+6]) for i in range(0, len(data), 6)]
+def decode_frame_rgbw8(data, as_array=False):
+    frame = _decode_frame_array(data, 4, _DTYPE_8)
+    if as_array:
+        return frame
+    return _frame_to_list(frame)
 
-def decode_frame_rgbw16(data):
-    return [decode_rgbw16(data[i:i+8]) for i in range(0, len(data), 8)]
 
-
-def _pad_frame_rgb(frame):
-    if len(frame) < CHANNELS_AVAILABLE:
-        frame = frame + [(0, 0, 0)
-                         for _ in range(0, CHANNELS_AVAILABLE - len(frame))]
-    return frame
+def decode_frame_rgb16(data, as_array=False):
+    frame = _decode_frame_array(data, 3, _DTYPE_16)
+    if as_array:
+        return frame
+    return _frame_to_list(frame)
 
 
-def _pad_frame_rgbw(frame):
-    if len(frame) < CHANNELS_AVAILABLE:
-        frame = frame + [(0, 0, 0, 0)
-                         for _ in range(0, CHANNELS_AVAILABLE - len(frame))]
-    return frame
+def decode_frame_rgbw16(data, as_array=False):
+    frame = _decode_frame_array(data, 4, _DTYPE_16)
+    if as_array:
+        return frame
+    return _frame_to_list(frame)
 
 
 def encode_frame_rgb8(frame):
-    frame = _pad_frame_rgb(frame)
-
-    return b"".join(encode_rgb8(*(rgb[:3]))
-                    for rgb in frame[:CHANNELS_AVAILABLE])
+    return _encode_frame_array(frame, 3, _DTYPE_8, 255.0,
+                               CHANNELS_AVAILABLE)
 
 def encode_frame_crap8(frame):
-    frame = _pad_frame_rgb(frame)
-
-    return b"".join(encode_rgb8(*(rgb[:3]))
-                    for rgb in frame)
+    return _encode_frame_array(frame, 3, _DTYPE_8, 255.0,
+                               max(len(frame), CHANNELS_AVAILABLE))
 
 def encode_frame_rgbw8(frame):
-    frame = _pad_frame_rgbw(frame)
-
-    return b"".join(encode_rgbw8(*rgbw)
-                    for rgbw in frame[:CHANNELS_AVAILABLE])
+    return _encode_frame_array(frame, 4, _DTYPE_8, 255.0,
+                               CHANNELS_AVAILABLE)
 
 
 def encode_frame_rgb16(frame):
-    frame = _pad_frame_rgb(frame)
-
-    return b"".join(encode_rgb16(*rgb)
-                    for rgb in frame[:CHANNELS_AVAILABLE])
+    return _encode_frame_array(frame, 3, _DTYPE_16, 65535.0,
+                               CHANNELS_AVAILABLE)
 
 
 def encode_frame_rgbw16(frame):
-    frame = _pad_frame_rgbw(frame)
+    return _encode_frame_array(frame, 4, _DTYPE_16, 65535.0,
+                               CHANNELS_AVAILABLE)
 
-    return b"".join(encode_rgbw16(*rgbw)
-                    for rgbw in frame[:CHANNELS_AVAILABLE])
+
+def quantize_frame_rgbw16(frame, channels=CHANNELS_AVAILABLE):
+    """
+    Get the 16 bit values of a frame as a (channels, 4)
+    array in native byte order, truncated like the encoders.
+    """
+    return _quantize_frame_array(frame, 4, np.uint16, 65535.0, channels)
 
 
 def cmd_frame_rgbw16(frame):
@@ -258,3 +1134,102 @@ def cmd_frame_rgb8(frame):
               encode_frame_rgb8(frame)
 
     return payload
+
+
+def cmd_frame_batches_rgbw16(frames, times, t0=None):
+    """
+    Encode frames with presentation times into batch packets.
+
+    :param frames: The frames to send
+    :type frames: list
+
+    :param times: Presentation time of each frame in seconds,
+                  relative to t0. Must be less than 65 s.
+    :type times: list
+
+    :param t0: Sender time (default: time.monotonic())
+    :type t0: float
+
+    :returns: A list of packets, each at most PACKET_SIZE_MAX bytes
+    :rtype: list
+    """
+    if t0 is None:
+        t0 = time.monotonic()
+    t_ms = int(t0 * 1000.0) & 0xffffffff
+
+    flags = FLAG_RGBA|FLAG_BITS_16
+    frame_size = _batch_frame_size(flags, CHANNELS_AVAILABLE)
+    batch_size = min(255, (PACKET_SIZE_MAX - _BATCH_HEADER.size) //
+                          (_BATCH_OFFSET.size + frame_size))
+
+    packets = []
+    for i in range(0, len(frames), batch_size):
+        batch = zip(frames[i:i + batch_size], times[i:i + batch_size])
+        count = min(batch_size, len(frames) - i)
+        packet = _BATCH_HEADER.pack(
+            CMD_FRAME_BATCH, flags, count, CHANNELS_AVAILABLE, t_ms)
+        packet += b"".join(
+            _BATCH_OFFSET.pack(round(t * 1000.0)) + encode_frame_rgbw16(frame)
+            for frame, t in batch)
+        packets.append(packet)
+
+    return packets
+
+
+class DeltaEncoder:
+    """
+    Encode frames as CMD_FRAME_DELTA against the last sent frame.
+
+    Every keyframe_interval frames a full CMD_FRAME is sent,
+    so receivers recover from lost packets.
+    """
+
+    def __init__(self,
+                 keyframe_interval=60,
+                 flags=FLAG_RGBA|FLAG_BITS_16,
+                 channels=CHANNELS_AVAILABLE):
+        layout = _FRAME_LAYOUTS[flags]
+        if layout is None:
+            raise ValueError("invalid frame flags: {:#x}".format(flags))
+        if channels > 255:
+            raise ValueError("too many channels for delta frames")
+
+        self.keyframe_interval = keyframe_interval
+        self.flags = flags
+        self.channels = channels
+
+        self._components, self._dtype, _ = layout
+        self._max_value = 255.0 if self._dtype == _DTYPE_8 else 65535.0
+
+        self._last = None
+        self._count = 0
+
+    def keyframe(self):
+        """Send a keyframe with the next frame"""
+        self._last = None
+
+    def encode(self, frame):
+        """
+        Encode a frame as keyframe or delta frame.
+
+        :returns: The packet to send
+        :rtype: bytes
+        """
+        values = _quantize_frame_array(frame,
+                                       self._components,
+                                       self._dtype,
+                                       self._max_value,
+                                       self.channels)
+
+        if self._last is None or self._count >= self.keyframe_interval:
+            self._last = values
+            self._count = 1
+            return bytes([CMD_FRAME, self.flags]) + values.tobytes()
+
+        changed = np.any(values != self._last, axis=1)
+        self._last = values
+        self._count += 1
+
+        return bytes([CMD_FRAME_DELTA, self.flags, self.channels]) + \
+               np.packbits(changed).tobytes() + \
+               values[changed].tobytes()
@@ -0,0 +1,232 @@
+"""
+Benchmarks for the protocol encode and decode paths
+and the serial packet encoding.
+
+    python -m treppe.protocol_bench            # compare with baseline
+    python -m treppe.protocol_bench --save     # store a new baseline
+
+Every benchmark is run for several channel counts and reports
+the time (ns) and the peak memory allocated (bytes) per frame.
+The run fails if a benchmark is worse than the baseline,
+protocol_bench.json next to this file, by more than the
+threshold. Timings depend on the machine, so store a new
+baseline when benchmarking on another one.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import struct
+import tracemalloc
+
+import numpy as np
+from cobs import cobs
+
+from treppe import protocol
+from treppe import olsndots
+
+
+CHANNEL_COUNTS = [4, 16, 64, 256]
+
+BASELINE_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "protocol_bench.json")
+THRESHOLD_DEFAULT = 0.25
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--baseline", default=BASELINE_DEFAULT)
+    parser.add_argument("-s", "--save", default=False, action="store_true",
+                        help="store the results as new baseline")
+    parser.add_argument("-t", "--threshold", default=THRESHOLD_DEFAULT,
+                        type=float,
+                        help="allowed relative regression (default: 0.25)")
+    parser.add_argument("-r", "--repeat", default=5, type=int)
+
+    return parser.parse_args()
+
+
+def _frame(channels):
+    """Make a frame of rgbw tuples with some variation"""
+    return [((i % 7) / 7.0, (i % 5) / 5.0, (i % 3) / 3.0, (i % 2) / 2.0)
+            for i in range(0, channels)]
+
+
+def _payload(channels, components, dtype):
+    """Make a frame payload with the given number of channels"""
+    info = np.iinfo(dtype)
+    values = np.arange(channels * components) * 97 % (info.max + 1)
+
+    return values.astype(dtype).tobytes()
+
+
+def benchmarks(channels):
+    """
+    Get all benchmarks for a channel count.
+
+    :returns: A list of (name, function, argument)
+    :rtype: list
+    """
+    rgbw = _frame(channels)
+    rgb = [v[:3] for v in rgbw]
+
+    rgb8 = _payload(channels, 3, ">u1")
+    rgbw8 = _payload(channels, 4, ">u1")
+    rgb16 = _payload(channels, 3, ">u2")
+    rgbw16 = _payload(channels, 4, ">u2")
+
+    packet = bytes([protocol.CMD_FRAME,
+                    protocol.FLAG_RGBA | protocol.FLAG_BITS_16]) + rgbw16
+
+    frame = protocol.Frame(max(channels, protocol.CHANNELS_AVAILABLE))
+
+    def decode_packet_into(data):
+        return protocol.decode_packet_into(data, frame)
+
+    # A framebuffer of 16 bit rgbw values
+    framebuf = np.frombuffer(rgbw16, dtype=">u2").tolist()
+    framebuf_fmt = "{}H".format(len(framebuf))
+    framebuf_packet = olsndots.PacketStruct(framebuf_fmt)
+    txbuf = bytearray(framebuf_packet.max_encoded)
+
+    def cobs_send_struct(data):
+        packet = cobs.encode(struct.pack("<" + framebuf_fmt, *data))
+        packet += olsndots.EOP
+        txbuf[0:len(packet)] = packet
+        return len(packet)
+
+    def cobs_packet_struct(data):
+        return framebuf_packet.encode_into(txbuf, 0, data)
+
+    return [
+        ("encode_frame_rgb8", protocol.encode_frame_rgb8, rgb),
+        ("encode_frame_rgbw8", protocol.encode_frame_rgbw8, rgbw),
+        ("encode_frame_rgb16", protocol.encode_frame_rgb16, rgb),
+        ("encode_frame_rgbw16", protocol.encode_frame_rgbw16, rgbw),
+        ("decode_frame_rgb8", protocol.decode_frame_rgb8, rgb8),
+        ("decode_frame_rgbw8", protocol.decode_frame_rgbw8, rgbw8),
+        ("decode_frame_rgb16", protocol.decode_frame_rgb16, rgb16),
+        ("decode_frame_rgbw16", protocol.decode_frame_rgbw16, rgbw16),
+        ("decode_packet", protocol.decode_packet, packet),
+        ("decode_packet_into", decode_packet_into, packet),
+        ("cmd_frame_rgbw16", protocol.cmd_frame_rgbw16, rgbw),
+        ("cmd_frame_rgb8", protocol.cmd_frame_rgb8, rgb),
+        ("cobs_send_struct", cobs_send_struct, framebuf),
+        ("cobs_packet_struct", cobs_packet_struct, framebuf),
+    ]
+
+
+def measure_time(fn, arg, repeat=5, min_time=0.01):
+    """Get the best time of a call in ns"""
+    timer = timeit.Timer(lambda: fn(arg))
+
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 10
+
+    best = min(timer.repeat(repeat, number))
+
+    return best / number * 1e9
+
+
+def measure_alloc(fn, arg):
+    """Get the peak memory allocated by a call in bytes"""
+    fn(arg) # warm up caches
+
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak - base
+
+
+def run(repeat=5):
+    """
+    Run all benchmarks.
+
+    :returns: The results by benchmark key
+    :rtype: dict
+    """
+    results = {}
+    for channels in CHANNEL_COUNTS:
+        for name, fn, arg in benchmarks(channels):
+            key = "{}[{}]".format(name, channels)
+            results[key] = {
+                "ns": measure_time(fn, arg, repeat),
+                "peak_bytes": measure_alloc(fn, arg),
+            }
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline.
+
+    Benchmarks and metrics missing in the baseline are skipped.
+
+    :returns: A list of (key, metric, baseline, result) regressions
+    :rtype: list
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric in ("ns", "peak_bytes"):
+            if metric not in base:
+                continue
+            if result[metric] > base[metric] * (1.0 + threshold):
+                regressions.append(
+                    (key, metric, base[metric], result[metric]))
+
+    return regressions
+
+
+def _load_baseline(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def main(args):
+    results = run(args.repeat)
+    baseline = _load_baseline(args.baseline)
+
+    for key, result in sorted(results.items()):
+        line = "{:32} {:10.0f} ns/frame {:8d} peak bytes/frame".format(
+            key, result["ns"], result["peak_bytes"])
+        if baseline and key in baseline:
+            line += " ({:+.0%})".format(
+                result["ns"] / baseline[key]["ns"] - 1.0)
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+
+    if baseline is None:
+        print("No baseline at {}, run with --save".format(args.baseline))
+        return 1
+
+    regressions = compare(results, baseline, args.threshold)
+    for key, metric, base, result in regressions:
+        print("REGRESSION: {} {} {:.0f} -> {:.0f}".format(
+            key, metric, base, result))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    sys.exit(main(args))
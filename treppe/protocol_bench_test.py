@@ -0,0 +1,35 @@
+import json
+
+from treppe import protocol_bench
+
+
+def test_compare():
+    baseline = {
+        "encode[4]": {"ns": 100.0, "peak_bytes": 1000},
+        "decode[4]": {"ns": 100.0, "peak_bytes": 1000},
+        "old[4]": {"ns": 100.0},
+    }
+    results = {
+        "encode[4]": {"ns": 124.0, "peak_bytes": 1300},
+        "decode[4]": {"ns": 130.0, "peak_bytes": 900},
+        "old[4]": {"ns": 90.0, "peak_bytes": 5000},
+        "new[4]": {"ns": 1e9, "peak_bytes": 1e9},
+    }
+
+    regressions = protocol_bench.compare(results, baseline, 0.25)
+    assert regressions == [
+        ("decode[4]", "ns", 100.0, 130.0),
+        ("encode[4]", "peak_bytes", 1000, 1300),
+    ]
+    assert protocol_bench.compare(results, baseline, 0.5) == []
+
+
+def test_baseline():
+    """The committed baseline covers all benchmarks"""
+    with open(protocol_bench.BASELINE_DEFAULT) as f:
+        baseline = json.load(f)
+
+    for channels in protocol_bench.CHANNEL_COUNTS:
+        for name, _, _ in protocol_bench.benchmarks(channels):
+            result = baseline["{}[{}]".format(name, channels)]
+            assert set(result) == {"ns", "peak_bytes"}
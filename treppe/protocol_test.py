@@ -1,4 +1,6 @@
 
+import socket
+
 from treppe import protocol
 
 
@@ -75,3 +77,399 @@ def test_encode_decode_frame_rgb8():
 
     assert decoded[0][0] == 1.0
     assert round(decoded[0][1], 1) == 0.5
+
+
+def test_decode_frame_as_array():
+    payload = b"\xff\xff\x7f\xff\x00\x00" * protocol.CHANNELS_AVAILABLE
+    frame = protocol.decode_frame(payload,
+                                  protocol.FLAG_RGB | protocol.FLAG_BITS_16,
+                                  as_array=True)
+
+    assert frame.shape == (protocol.CHANNELS_AVAILABLE, 4)
+    assert frame.dtype == "float32"
+    assert frame[0][0] == 1.0
+    assert round(float(frame[0][1]), 1) == 0.5
+    assert frame[0][3] == 0.0
+
+
+def test_decode_frame_invalid_length():
+    packet = bytes([protocol.CMD_FRAME,
+                    protocol.FLAG_RGBA | protocol.FLAG_BITS_16]) + b"\x00" * 7
+    result = protocol.decode_packet(packet)
+
+    assert result.cmd == protocol.CMD_INVALID
+
+
+def test_encode_decode_frame_rgbw16():
+    frame = [(1.0, 0.5, 0.0, 0.25) for _ in range(0, 3)]
+
+    encoded = protocol.encode_frame_rgbw16(frame)
+    decoded = protocol.decode_frame_rgbw16(encoded)
+
+    assert encoded[:8] == protocol.encode_rgbw16(*frame[0])
+    assert decoded[0][0] == 1.0
+    assert round(decoded[0][3], 4) == 0.25
+    assert decoded[3] == (0.0, 0.0, 0.0, 0.0)
+
+
+def test_encode_decode_empty_frame():
+    packet = protocol.cmd_frame_rgbw16([])
+
+    assert len(packet) == 2 + protocol.CHANNELS_AVAILABLE * 8
+    assert packet[2:] == b"\x00" * protocol.CHANNELS_AVAILABLE * 8
+    assert protocol.encode_frame_rgb8([]) == \
+        b"\x00" * protocol.CHANNELS_AVAILABLE * 3
+
+    assert protocol.decode_frame_rgbw16(b"") == []
+    assert protocol.decode_frame_rgb8(b"", as_array=True).shape == (0, 4)
+
+
+def test_decode_packet_into():
+    frame = protocol.Frame()
+    values = [(1.0, 0.5, 0.0, 0.25), (0.0, 0.0, 1.0, 1.0)]
+    encoders = {
+        protocol.FLAG_RGB | protocol.FLAG_BITS_8: protocol.encode_frame_rgb8,
+        protocol.FLAG_RGBA | protocol.FLAG_BITS_8: protocol.encode_frame_rgbw8,
+        protocol.FLAG_RGB | protocol.FLAG_BITS_16: protocol.encode_frame_rgb16,
+        protocol.FLAG_RGBA | protocol.FLAG_BITS_16: protocol.encode_frame_rgbw16,
+    }
+
+    for flags, encode in encoders.items():
+        data = bytes([protocol.CMD_FRAME, flags]) + encode(values)
+        packet = bytearray(2048)
+        packet[:len(data)] = data
+
+        cmd = protocol.decode_packet_into(packet, frame, len(data))
+        expected = protocol.decode_packet(data)
+
+        assert cmd == protocol.CMD_FRAME
+        assert frame.flags == flags
+        assert len(frame) == protocol.CHANNELS_AVAILABLE
+        for decoded, rgbw in zip(frame.to_list(), expected.payload):
+            assert [round(v, 4) for v in decoded] == \
+                   [round(v, 4) for v in rgbw]
+
+
+def test_decode_packet_into_set_direct():
+    frame = protocol.Frame()
+    packet = bytes([protocol.CMD_SET_DIRECT, 3]) + \
+             protocol.encode_rgbw16(1.0, 0.0, 0.0, 1.0)
+
+    cmd = protocol.decode_packet_into(packet, frame)
+
+    assert cmd == protocol.CMD_SET_DIRECT
+    assert frame.values[3].tolist() == [0xffff, 0, 0, 0xffff]
+    assert frame.values[2].tolist() == [0, 0, 0, 0]
+
+
+def test_decode_packet_into_invalid():
+    frame = protocol.Frame()
+
+    packet = bytes([protocol.CMD_FRAME,
+                    protocol.FLAG_RGBA | protocol.FLAG_BITS_16]) + b"\x00" * 7
+    assert protocol.decode_packet_into(packet, frame) == protocol.CMD_INVALID
+    assert frame.cmd == protocol.CMD_INVALID
+
+    packet = bytes([protocol.CMD_FRAME, 0x00]) + b"\x00" * 8
+    assert protocol.decode_packet_into(packet, frame) == protocol.CMD_INVALID
+
+
+def test_frame_batch():
+    frames = [[(i / 100.0, 0.0, 1.0, 0.5)] for i in range(0, 40)]
+    times = [i / 60.0 for i in range(0, 40)]
+
+    packets = protocol.cmd_frame_batches_rgbw16(frames, times, t0=12.5)
+    assert len(packets) > 1
+    for packet in packets:
+        assert len(packet) <= protocol.PACKET_SIZE_MAX
+
+    decoded = [protocol.decode_packet(packet) for packet in packets]
+    assert all(p.cmd == protocol.CMD_FRAME_BATCH for p in decoded)
+    assert decoded[0].payload.time == 12.5
+    assert protocol.frame_batch_time(packets[1]) == 12.5
+
+    received = [f for p in decoded for f in p.payload.frames]
+    assert len(received) == 40
+    for (t, frame), t_expected, frame_expected in zip(received, times, frames):
+        assert round(t - 12.5, 3) == round(t_expected, 3)
+        assert round(frame[0][0], 3) == round(frame_expected[0][0], 3)
+        assert frame[1] == (0.0, 0.0, 0.0, 0.0)
+
+
+def test_frame_batch_decode_into():
+    packet = protocol.cmd_frame_batches_rgbw16(
+        [[(1.0, 0.0, 0.0, 0.0)], [(0.0, 1.0, 0.0, 0.0)]], [0.0, 0.1])[0]
+    frame = protocol.Frame()
+
+    for i, (_, offset, size) in enumerate(protocol.iter_frame_batch(packet)):
+        flags = packet[1]
+        assert protocol.decode_frame_into(packet, frame, flags, offset, size)
+        assert frame.values[0][i] == 0xffff
+
+
+def test_frame_batch_truncated():
+    packet = protocol.cmd_frame_batches_rgbw16(
+        [protocol.EMPTY_FRAME, protocol.EMPTY_FRAME], [0.0, 0.1])[0]
+
+    result = protocol.decode_packet(packet[:-1])
+    assert result.cmd == protocol.CMD_INVALID
+
+
+def test_frame_delta():
+    encoder = protocol.DeltaEncoder(keyframe_interval=3)
+    frame = protocol.Frame()
+
+    a = [(0.5, 0.5, 0.5, 0.5)] * protocol.CHANNELS_AVAILABLE
+    b = list(a)
+    b[2] = (1.0, 0.0, 0.0, 0.0)
+    b[9] = (0.0, 0.0, 0.0, 1.0)
+
+    key = encoder.encode(a)
+    delta = encoder.encode(b)
+    unchanged = encoder.encode(b)
+
+    assert key[0] == protocol.CMD_FRAME
+    assert delta[0] == protocol.CMD_FRAME_DELTA
+    assert len(delta) == 3 + 2 + 2 * 8
+    assert len(unchanged) == 3 + 2
+    assert encoder.encode(b)[0] == protocol.CMD_FRAME # keyframe interval
+
+    assert protocol.decode_packet(delta).payload == [
+        (2, (1.0, 0.0, 0.0, 0.0)),
+        (9, (0.0, 0.0, 0.0, 1.0)),
+    ]
+
+    protocol.decode_packet_into(key, frame)
+    assert protocol.decode_packet_into(delta, frame) == \
+           protocol.CMD_FRAME_DELTA
+    assert len(frame) == protocol.CHANNELS_AVAILABLE
+    assert frame.values[2].tolist() == [0xffff, 0, 0, 0]
+    assert frame.values[9].tolist() == [0, 0, 0, 0xffff]
+    assert frame.values[3].tolist() == [0x7fff] * 4
+
+
+def test_frame_delta_invalid():
+    encoder = protocol.DeltaEncoder()
+    encoder.encode(protocol.EMPTY_FRAME)
+    delta = encoder.encode([(1.0, 0.0, 0.0, 0.0)])
+
+    result = protocol.decode_packet(delta[:-1])
+    assert result.cmd == protocol.CMD_INVALID
+
+    frame = protocol.Frame()
+    assert protocol.decode_packet_into(delta[:-1], frame) == \
+           protocol.CMD_INVALID
+
+
+def test_header_extension():
+    sequencer = protocol.Sequencer(seq=41)
+    packet = sequencer.wrap(protocol.cmd_frame_rgbw16([(1.0, 0, 0, 0)]),
+                            t=2.5)
+
+    header = protocol.decode_header(packet)
+    assert header.version == protocol.HEADER_EXT_VERSION
+    assert header.seq == 41
+    assert header.time == 2.5
+    assert sequencer.seq == 42
+
+    assert protocol.decode_packet(packet).payload[0] == (1.0, 0.0, 0.0, 0.0)
+
+    frame = protocol.Frame()
+    assert protocol.decode_packet_into(packet, frame) == protocol.CMD_FRAME
+    assert frame.seq == 41
+    assert frame.time == 2.5
+    assert frame.values[0][0] == 0xffff
+
+    # Legacy packets have no header
+    legacy = protocol.cmd_frame_rgbw16([])
+    assert protocol.decode_header(legacy) is None
+    protocol.decode_packet_into(legacy, frame)
+    assert frame.seq is None
+
+
+def test_sequence_tracker():
+    tracker = protocol.SequenceTracker()
+
+    assert tracker.accept(0)
+    assert tracker.accept(1)
+    assert not tracker.accept(1) # duplicated
+    assert tracker.accept(4) # 2 and 3 missing
+    assert tracker.gap == 2
+    assert not tracker.accept(3) # reordered
+    assert tracker.accept(5)
+    assert tracker.gap == 0
+
+    assert tracker.accepted == 4
+    assert tracker.duplicated == 1
+    assert tracker.reordered == 1
+    assert tracker.lost == 1
+
+    # Sender restart
+    assert tracker.accept(0x12345)
+    assert tracker.accept(0)
+    assert tracker.lost == 1
+
+    # Wrap around
+    tracker = protocol.SequenceTracker()
+    assert tracker.accept(0xffffffff)
+    assert tracker.accept(0)
+    assert not tracker.accept(0xfffffffe)
+
+
+def test_drop_stale_packets():
+    sequencer = protocol.Sequencer()
+    first = sequencer.wrap(b"\x42\x0a")
+    second = sequencer.wrap(b"\x42\x0a")
+
+    trackers = {}
+    reader = [('a', second), ('a', first), ('b', first),
+              ('a', b"\x42\x0a"), (None, None)]
+    packets = list(protocol.drop_stale_packets(reader, trackers))
+
+    assert packets == [('a', second), ('b', first),
+                       ('a', b"\x42\x0a"), (None, None)]
+    assert trackers['a'].reordered == 1
+
+
+def _udp_pair():
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.connect(rx.getsockname())
+    return rx, tx
+
+
+def test_receiver():
+    rx_a, tx_a = _udp_pair()
+    rx_b, tx_b = _udp_pair()
+
+    frames = [protocol.cmd_frame_rgbw16([(i / 10.0, 0, 0, 0)])
+              for i in range(0, 5)]
+    for frame in frames:
+        tx_a.send(frame)
+    tx_b.send(frames[0])
+
+    receiver = protocol.Receiver({'a': rx_a, 'b': rx_b}, timeout=0.1)
+    received = []
+    for source, packet in receiver:
+        if source is None:
+            break
+        received.append((source, bytes(packet)))
+
+    assert [p for s, p in received if s == 'a'] == frames
+    assert [p for s, p in received if s == 'b'] == frames[:1]
+    assert receiver.received == {'a': 5, 'b': 1}
+
+    for sock in (rx_a, tx_a, rx_b, tx_b):
+        sock.close()
+
+
+def test_receiver_latest_only():
+    rx, tx = _udp_pair()
+
+    encoder = protocol.DeltaEncoder()
+    packets = [protocol.cmd_frame_rgbw16([(0.1, 0, 0, 0)]),
+               protocol.cmd_frame_rgbw16([(0.2, 0, 0, 0)]),
+               encoder.encode([(0.3, 0, 0, 0)]),
+               encoder.encode([(0.4, 0, 0, 0)])]
+    for packet in packets:
+        tx.send(packet)
+
+    receiver = protocol.Receiver({'a': rx}, latest_only=True, timeout=0.1)
+    received = []
+    for source, packet in receiver:
+        if source is None:
+            break
+        received.append(bytes(packet))
+
+    # The delta depends on the last keyframe
+    assert received == packets[2:]
+    assert receiver.superseded == {'a': 2}
+
+    rx.close()
+    tx.close()
+
+
+def test_receiver_superseded_sequence():
+    """Superseded packets are not counted as lost"""
+    rx, tx = _udp_pair()
+
+    sequencer = protocol.Sequencer()
+    for i in range(4):
+        packet = protocol.cmd_frame_rgbw16([(i / 10.0, 0, 0, 0)])
+        tx.send(sequencer.wrap(packet))
+
+    trackers = {}
+    receiver = protocol.Receiver({'a': rx}, latest_only=True, timeout=0.1,
+                                 trackers=trackers)
+    received = []
+    for source, packet in protocol.drop_stale_packets(receiver, trackers):
+        if source is None:
+            break
+        received.append(bytes(packet))
+
+    assert len(received) == 1
+    assert protocol.decode_header(received[0]).seq == 3
+    assert trackers['a'].superseded == 3
+    assert trackers['a'].accepted == 1
+    assert trackers['a'].lost == 0
+
+    rx.close()
+    tx.close()
+
+
+def test_receiver_overflow():
+    """The buffers of superseded packets are reused"""
+    rx, tx = _udp_pair()
+    receiver = protocol.Receiver({'a': rx}, latest_only=True, buffers=4)
+
+    for i in range(10):
+        tx.send(protocol.cmd_frame_rgbw16([(i / 10.0, 0, 0, 0)]))
+    packets = receiver.drain('a')
+    assert [bytes(p) for p in packets] == \
+        [protocol.cmd_frame_rgbw16([(0.9, 0, 0, 0)])]
+    assert receiver.superseded == {'a': 9}
+    assert receiver.overflows == {'a': 0}
+
+    # Deltas depend on each other and fill up the buffers
+    encoder = protocol.DeltaEncoder()
+    deltas = [encoder.encode([(i / 10.0, 0, 0, 0)]) for i in range(6)][1:]
+    for delta in deltas:
+        tx.send(delta)
+    assert [bytes(p) for p in receiver.drain('a')] == deltas[:4]
+    assert receiver.overflows == {'a': 1}
+    assert [bytes(p) for p in receiver.drain('a')] == deltas[4:]
+    assert receiver.received == {'a': 6}
+
+    rx.close()
+    tx.close()
+
+
+def test_arbiter():
+    arbiter = protocol.Arbiter({
+        'low': (0, 0.0),
+        'mid': (1, 1.0),
+        'high': (2, 0.5),
+    })
+
+    assert arbiter.accept('low', now=0.0)
+    assert arbiter.accept('mid', now=0.1)
+    assert not arbiter.accept('low', now=0.2)
+    assert arbiter.accept('high', now=0.3)
+    assert not arbiter.accept('mid', now=0.4)
+
+    # high holds off until 0.8, mid (seen at 0.4) until 1.4
+    assert arbiter.accept('mid', now=0.9)
+    assert not arbiter.accept('low', now=1.0)
+    assert arbiter.accept('low', now=2.0)
+
+    assert arbiter.sources['low'].accepted == 2
+    assert arbiter.sources['low'].suppressed == 2
+    assert arbiter.sources['mid'].suppressed == 1
+
+
+def test_demultiplex_sockets():
+    reader = [('a', b"a1"), ('b', b"b1"), ('a', b"a2"), (None, None)]
+    packets = list(protocol.demultiplex_sockets(reader, 1.5))
+
+    assert packets == [b"a1", b"b1", None]
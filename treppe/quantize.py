@@ -0,0 +1,90 @@
+"""
+Color Quantization
+------------------
+
+Lookup tables for converting color values between
+normalized floats (0..1), 8 bit and 16 bit integers.
+
+A ResponseCurve maps normalized or 16 bit values to
+16 bit output values through a single table, so a
+gamma correction costs the same as a plain conversion.
+"""
+
+import numpy as np
+
+
+# 8 bit -> normalized float
+DECODE_8 = np.arange(256, dtype=np.float32) / np.float32(255.0)
+
+# 8 bit -> 16 bit (0xff -> 0xffff)
+EXPAND_8 = np.arange(256, dtype=np.uint16) * np.uint16(257)
+
+# 16 bit -> 8 bit, rounded
+REDUCE_16 = np.round(np.arange(65536) * (255.0 / 65535.0)).astype(np.uint8)
+
+
+def decode_8(values, out=None):
+    """Convert 8 bit values to normalized float32"""
+    return np.take(DECODE_8, values, out=out)
+
+
+def decode_16(values, out=None):
+    """Convert 16 bit values to normalized float32"""
+    return np.divide(values, np.float32(65535.0), out=out,
+                     dtype=np.float32)
+
+
+def expand_8(values, out=None):
+    """Convert 8 bit values to 16 bit"""
+    return np.take(EXPAND_8, values, out=out)
+
+
+def reduce_16(values, out=None):
+    """Convert 16 bit values to 8 bit"""
+    return np.take(REDUCE_16, values, out=out)
+
+
+def quantize_16(values):
+    """
+    Get the table index (the rounded 16 bit value)
+    of normalized values. Values are clipped to 0..1.
+    """
+    values = np.clip(values, 0.0, 1.0)
+    values *= 65535.0
+
+    return np.rint(values).astype(np.uint16)
+
+
+class ResponseCurve:
+    """
+    A response curve mapping to 16 bit output values.
+
+    The curve is a table with one entry per 16 bit input
+    value, so applying it is a single lookup.
+    """
+
+    def __init__(self, gamma=1.0, table=None):
+        """
+        :param gamma: Exponent of the curve (out = in ** gamma)
+        :type gamma: float
+
+        :param table: Use a custom table of 65536 16 bit values
+        :type table: array-like
+        """
+        if table is None:
+            x = np.arange(65536, dtype=np.float64) / 65535.0
+            table = np.round(x ** gamma * 65535.0)
+
+        self.table = np.asarray(table, dtype=np.uint16)
+        if self.table.shape != (65536,):
+            raise ValueError("response table must have 65536 entries")
+
+        self.identity = bool(np.all(self.table == np.arange(65536)))
+
+    def apply(self, values, out=None):
+        """Map 16 bit values through the curve"""
+        return np.take(self.table, values, out=out)
+
+    def __call__(self, values):
+        """Map normalized values through the curve"""
+        return self.table[quantize_16(values)]
@@ -0,0 +1,35 @@
+
+import numpy as np
+
+from treppe import quantize
+
+
+def test_decode_8():
+    values = np.array([0, 127, 255], dtype=np.uint8)
+    decoded = quantize.decode_8(values)
+
+    assert decoded.dtype == np.float32
+    assert decoded[0] == 0.0
+    assert round(float(decoded[1]), 1) == 0.5
+    assert decoded[2] == 1.0
+
+
+def test_expand_reduce():
+    values = np.arange(256, dtype=np.uint8)
+    expanded = quantize.expand_8(values)
+
+    assert expanded[255] == 0xffff
+    assert np.all(quantize.reduce_16(expanded) == values)
+
+
+def test_response_curve():
+    identity = quantize.ResponseCurve()
+    assert identity.identity
+    assert identity(np.array([0.0, 0.5, 1.0, 2.0])).tolist() == \
+           [0, 32768, 65535, 65535]
+
+    gamma = quantize.ResponseCurve(2.0)
+    assert not gamma.identity
+
+    values = np.array([0, 32768, 65535], dtype=np.uint16)
+    assert gamma.apply(values).tolist() == [0, 16384, 65535]
@@ -0,0 +1,274 @@
+"""
+Recording
+---------
+
+Record the datagrams received by trepped and replay them,
+to reproduce a packet stream exactly.
+
+A recording is an append-only file:
+
+    Header:  4 Byte Magic "TRPR", 4 Byte Version
+
+    Record:  4 Byte Length of the payload,
+             8 Byte Arrival time (monotonic, s),
+             2 Byte Port the datagram was received on,
+             Payload
+
+All fields are little endian. Recordings are read through
+mmap, so replaying does not load them into memory. A record
+cut short (e.g. by a crash while writing) ends the recording.
+
+    python -m treppe.recording record -o stream.trpr -P 3123 -P 3124
+    python -m treppe.recording replay stream.trpr --speed 2
+    python -m treppe.recording info stream.trpr
+"""
+
+import sys
+import mmap
+import time
+import socket
+import struct
+import argparse
+import selectors
+
+MAGIC = b"TRPR"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sI")
+_RECORD = struct.Struct("<IdH")
+
+
+class Recorder:
+    """Append datagrams to a recording"""
+
+    def __init__(self, path, flush_interval=0.5):
+        """
+        :param path: The recording, created if it does not exist
+        :type path: str
+
+        :param flush_interval: Flush the file at most every
+                               flush_interval seconds
+        :type flush_interval: float
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0
+
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(MAGIC, VERSION))
+        else:
+            _check_header(path)
+
+        self._t_flush = time.monotonic()
+
+    def record(self, port, data, t=None):
+        """Append a datagram received at time t on port"""
+        if t is None:
+            t = time.monotonic()
+
+        self._file.write(_RECORD.pack(len(data), t, port))
+        self._file.write(data)
+        self.records += 1
+
+        if t - self._t_flush >= self.flush_interval:
+            self._file.flush()
+            self._t_flush = t
+
+    def close(self):
+        self._file.close()
+
+
+def _check_header(path):
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size or \
+            _HEADER.unpack(header) != (MAGIC, VERSION):
+        raise ValueError("{} is not a treppe recording".format(path))
+
+
+class Recording:
+    """
+    A recording mapped into memory.
+    The payloads are memoryviews into the mapping.
+    """
+
+    def __init__(self, path):
+        _check_header(path)
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+
+    def __iter__(self):
+        """Yield all records as (time, port, payload)"""
+        view = self._view
+        size = len(view)
+        offset = _HEADER.size
+        while offset + _RECORD.size <= size:
+            length, t, port = _RECORD.unpack_from(view, offset)
+            offset += _RECORD.size
+            if offset + length > size:
+                return # cut short
+            yield t, port, view[offset:offset + length]
+            offset += length
+
+    def close(self):
+        """Unmap the recording, payloads must not be used anymore"""
+        self._view.release()
+        self._mm.close()
+
+
+def replay(records, send, speed=1.0):
+    """
+    Send records at their original timing.
+
+    :param records: (time, port, payload) tuples
+    :type records: iterable
+
+    :param send: Called with (port, payload) for every record
+    :type send: callable
+
+    :param speed: Replay speed, 2 is twice as fast as recorded,
+                  0 sends as fast as possible
+    :type speed: float
+
+    :returns: The number of records sent
+    :rtype: int
+    """
+    count = 0
+    t_first = None
+    t_start = time.monotonic()
+    for t, port, payload in records:
+        if speed:
+            if t_first is None:
+                t_first = t
+            delay = t_start + (t - t_first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        send(port, payload)
+        count += 1
+
+    return count
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    record = commands.add_parser("record", help="record datagrams")
+    record.add_argument("-o", "--output", required=True)
+    record.add_argument("-P", "--port", action="append", type=int,
+                        dest="ports", required=True,
+                        help="listen on PORT, can be repeated")
+
+    play = commands.add_parser("replay", help="send a recording")
+    play.add_argument("recording")
+    play.add_argument("-H", "--host", default="127.0.0.1")
+    play.add_argument("-o", "--port-offset", default=0, type=int,
+                      help="add this to the recorded ports")
+    play.add_argument("-s", "--speed", default=1.0, type=float,
+                      help="replay speed, 0 is as fast as possible "
+                           "(default: 1.0)")
+    play.add_argument("-l", "--loop", default=False, action="store_true")
+
+    info = commands.add_parser("info", help="summarize a recording")
+    info.add_argument("recording")
+
+    return parser.parse_args()
+
+
+def _record(args):
+    recorder = Recorder(args.output)
+    selector = selectors.DefaultSelector()
+    for port in args.ports:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("0.0.0.0", port))
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ, port)
+
+    print("Recording to {}".format(args.output))
+    try:
+        while True:
+            for key, _ in selector.select():
+                data = key.fileobj.recv(65536)
+                recorder.record(key.data, data)
+    except KeyboardInterrupt:
+        print("{} datagrams recorded".format(recorder.records))
+    finally:
+        recorder.close()
+
+
+def _replay(args):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(port, payload):
+        s.sendto(payload, (args.host, port + args.port_offset))
+
+    recording = Recording(args.recording)
+    try:
+        while True:
+            t_start = time.monotonic()
+            count = replay(recording, send, args.speed)
+            elapsed = time.monotonic() - t_start
+            print("{} datagrams in {:.3f} s ({:.0f}/s)".format(
+                count, elapsed, count / elapsed if elapsed else 0))
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recording.close()
+
+
+def summarize(records):
+    """
+    Count the records.
+
+    :returns: The number of records, payload bytes,
+              the duration and the records by port
+    :rtype: tuple
+    """
+    count = 0
+    size = 0
+    ports = {}
+    t_first = t_last = None
+    for t, port, payload in records:
+        if t_first is None:
+            t_first = t
+        t_last = t
+        count += 1
+        size += len(payload)
+        ports[port] = ports.get(port, 0) + 1
+
+    duration = t_last - t_first if count else 0.0
+
+    return count, size, duration, ports
+
+
+def _info(args):
+    recording = Recording(args.recording)
+    count, size, duration, ports = summarize(recording)
+    recording.close()
+
+    print("{} datagrams, {} bytes, {:.3f} s".format(count, size, duration))
+    for port, n in sorted(ports.items()):
+        print("Port {}: {} datagrams".format(port, n))
+
+
+def main(args):
+    if args.command == "record":
+        _record(args)
+    elif args.command == "replay":
+        _replay(args)
+    elif args.command == "info":
+        _info(args)
+
+    return 0
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,65 @@
+import time
+
+from treppe import recording
+
+
+def test_record_and_read(tmp_path):
+    """Records are read back in order"""
+    path = str(tmp_path / "stream.trpr")
+
+    recorder = recording.Recorder(path)
+    recorder.record(3123, b"\x42\x00abc", t=10.0)
+    recorder.record(3124, b"", t=10.5)
+    recorder.close()
+
+    # Recordings are appended to
+    recorder = recording.Recorder(path)
+    recorder.record(3123, b"xyz", t=11.0)
+    recorder.close()
+
+    rec = recording.Recording(path)
+    records = [(t, port, bytes(payload)) for t, port, payload in rec]
+    assert records == [
+        (10.0, 3123, b"\x42\x00abc"),
+        (10.5, 3124, b""),
+        (11.0, 3123, b"xyz"),
+    ]
+
+    assert recording.summarize(rec) == (3, 8, 1.0, {3123: 2, 3124: 1})
+    rec.close()
+
+
+def test_truncated(tmp_path):
+    """A record cut short ends the recording"""
+    path = str(tmp_path / "stream.trpr")
+
+    recorder = recording.Recorder(path)
+    recorder.record(3123, b"complete", t=1.0)
+    recorder.record(3123, b"truncated", t=2.0)
+    recorder.close()
+
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+
+    rec = recording.Recording(path)
+    assert [bytes(p) for _, _, p in rec] == [b"complete"]
+    rec.close()
+
+
+def test_replay_timing():
+    """Replay keeps the relative timing, scaled by speed"""
+    records = [(100.0, 1, b"a"), (100.1, 1, b"b"), (100.2, 2, b"c")]
+
+    sent = []
+    def send(port, payload):
+        sent.append((time.monotonic(), port, payload))
+
+    assert recording.replay(records, send, speed=2.0) == 3
+    assert [(port, p) for _, port, p in sent] == \
+        [(1, b"a"), (1, b"b"), (2, b"c")]
+    assert 0.09 <= sent[-1][0] - sent[0][0] < 0.2
+
+    sent = []
+    t_start = time.monotonic()
+    recording.replay(records, send, speed=0)
+    assert time.monotonic() - t_start < 0.05
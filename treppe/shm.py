@@ -0,0 +1,240 @@
+"""
+Shared Memory Transport
+-----------------------
+
+Local producers can hand frames to trepped through a
+memory mapped file (e.g. in /dev/shm) instead of UDP.
+
+The file holds a ring of fixed size RGBW16 frames written
+by a single producer:
+
+    Header:  4 Byte Magic "TRPS", 4 Byte Version,
+             4 Byte Slots, 4 Byte Channels,
+             8 Byte Sequence number of the latest frame
+
+    Slot:    8 Byte Sequence number, 8 Byte Time (monotonic, s),
+             Channels * 4 * 2 Byte RGBW values (native endian)
+
+All fields are native endian. A slot's sequence number
+is set to 0 while the slot is written, so readers can
+detect frames overwritten under them.
+"""
+
+import os
+import mmap
+import time
+import struct
+
+import numpy as np
+
+from treppe import protocol
+
+
+SHM_PATH_DEFAULT = "/dev/shm/treppe"
+
+MAGIC = b"TRPS"
+VERSION = 1
+
+SLOTS_DEFAULT = 8
+
+# Seconds between checks if the file was replaced
+CHECK_INTERVAL = 1.0
+
+_HEADER = struct.Struct("=4sIII")
+_HEADER_SEQ_OFFSET = 16
+_HEADER_SIZE = 64
+
+_SLOT_HEADER = struct.Struct("=Qd")
+
+
+def _slot_size(channels):
+    return _SLOT_HEADER.size + channels * 4 * 2
+
+
+def _file_id(st):
+    """Identify a file and its size"""
+    return (st.st_dev, st.st_ino, st.st_size)
+
+
+class _Ring:
+    """The memory mapped ring of frames"""
+
+    def __init__(self, mm, slots, channels):
+        self.mm = mm
+        self.slots = slots
+        self.channels = channels
+
+        self.latest = np.frombuffer(mm, dtype=np.uint64, count=1,
+                                    offset=_HEADER_SEQ_OFFSET)
+
+        size = _slot_size(channels)
+        self.slot_seqs = []
+        self.slot_times = []
+        self.slot_values = []
+        for i in range(slots):
+            offset = _HEADER_SIZE + i * size
+            self.slot_seqs.append(
+                np.frombuffer(mm, dtype=np.uint64, count=1, offset=offset))
+            self.slot_times.append(
+                np.frombuffer(mm, dtype=np.float64, count=1, offset=offset + 8))
+            self.slot_values.append(
+                np.frombuffer(mm, dtype=np.uint16, count=channels * 4,
+                              offset=offset + _SLOT_HEADER.size)
+                .reshape(channels, 4))
+
+
+class Writer:
+    """
+    The producer side of the ring.
+    There must be only one writer per file.
+    """
+
+    def __init__(self, path=SHM_PATH_DEFAULT,
+                 slots=SLOTS_DEFAULT,
+                 channels=protocol.CHANNELS_AVAILABLE):
+        size = _HEADER_SIZE + slots * _slot_size(channels)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._mm[:size] = bytes(size)
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, slots, channels)
+
+        self._ring = _Ring(self._mm, slots, channels)
+        self.seq = 0
+
+    def write_values(self, values, t=None):
+        """
+        Write a frame of 16 bit rgbw values
+        with shape (channels, 4).
+        """
+        if t is None:
+            t = time.monotonic()
+
+        ring = self._ring
+        seq = self.seq + 1
+        slot = seq % ring.slots
+
+        ring.slot_seqs[slot][0] = 0
+        ring.slot_values[slot][:] = values
+        ring.slot_times[slot][0] = t
+        ring.slot_seqs[slot][0] = seq
+        ring.latest[0] = seq
+
+        self.seq = seq
+
+    def write(self, frame, t=None):
+        """Write a frame of normalized rgbw values"""
+        values = protocol.quantize_frame_rgbw16(frame, self._ring.channels)
+        self.write_values(values, t)
+
+    def close(self):
+        self._ring = None
+        self._mm.close()
+
+
+class Reader:
+    """
+    The consumer side of the ring.
+
+    Frames are not copied: the values of the returned
+    Frame are a view into the shared memory. They stay
+    valid until the producer wrapped around the ring,
+    which can be checked with valid() after using them.
+
+    A producer restarting with another layout resizes
+    the file, which is detected by changed(). The reader
+    must be closed then, before the mapping is accessed.
+    """
+
+    def __init__(self, path=SHM_PATH_DEFAULT, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._t_checked = time.monotonic()
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._stat = _file_id(os.fstat(fd))
+            self._mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        self._header = _HEADER.unpack_from(self._mm)
+        magic, version, slots, channels = self._header
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a treppe frame ring".format(path))
+        if len(self._mm) < _HEADER_SIZE + slots * _slot_size(channels):
+            raise ValueError("{} is truncated".format(path))
+
+        self._ring = _Ring(self._mm, slots, channels)
+        self.channels = channels
+        self.seq = 0
+
+        # One frame per slot, backed by the shared memory
+        self._frames = []
+        for values in self._ring.slot_values:
+            frame = protocol.Frame(channels)
+            frame.values = values
+            frame.channels = channels
+            frame.cmd = protocol.CMD_FRAME
+            self._frames.append(frame)
+
+    def latest(self):
+        """
+        Get the latest frame if it is newer than the
+        last one returned, otherwise None.
+
+        :rtype: protocol.Frame
+        """
+        ring = self._ring
+        seq = int(ring.latest[0])
+        if seq == self.seq:
+            return None
+
+        slot = seq % ring.slots
+        if ring.slot_seqs[slot][0] != seq:
+            return None # overwritten, try again next time
+
+        frame = self._frames[slot]
+        frame.seq = seq
+        frame.time = float(ring.slot_times[slot][0])
+        self.seq = seq
+
+        return frame
+
+    def valid(self, frame):
+        """Check if a frame was not overwritten since latest()"""
+        slot = frame.seq % self._ring.slots
+        return self._ring.slot_seqs[slot][0] == frame.seq
+
+    def changed(self, now=None):
+        """
+        Check if the file got a new header since it was mapped,
+        or was replaced or resized. Only the mapped header is
+        compared on every call, the file is looked up at most
+        once per check interval.
+
+        :rtype: bool
+        """
+        if _HEADER.unpack_from(self._mm) != self._header:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        if now - self._t_checked < self.check_interval:
+            return False
+        self._t_checked = now
+
+        try:
+            return _file_id(os.stat(self.path)) != self._stat
+        except OSError:
+            return True
+
+    def close(self):
+        self._frames = []
+        self._ring = None
+        self._mm.close()
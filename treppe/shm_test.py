@@ -0,0 +1,78 @@
+import os
+import time
+
+
+from treppe import shm
+
+
+def test_write_read(tmp_path):
+    path = str(tmp_path / "treppe")
+    writer = shm.Writer(path, slots=4)
+    reader = shm.Reader(path)
+
+    assert reader.latest() is None
+
+    writer.write([(1.0, 0.5, 0.0, 0.25)], t=1.5)
+    frame = reader.latest()
+
+    assert frame.seq == 1
+    assert frame.time == 1.5
+    assert len(frame) == 16
+    assert frame.values[0].tolist() == [0xffff, 0x7fff, 0, 0x3fff]
+    assert frame.values[1].tolist() == [0, 0, 0, 0]
+    assert reader.valid(frame)
+
+    # Nothing new
+    assert reader.latest() is None
+
+    # Skip to the latest frame
+    for i in range(0, 6):
+        writer.write([(i / 10.0, 0, 0, 0)])
+    latest = reader.latest()
+
+    assert latest.seq == 7
+    assert latest.values[0][0] == int(0.5 * 65535)
+    assert not reader.valid(frame) # overwritten
+
+    del frame, latest
+    reader.close()
+    writer.close()
+
+
+def test_changed(tmp_path, monkeypatch):
+    path = str(tmp_path / "treppe")
+    writer = shm.Writer(path, slots=4)
+    reader = shm.Reader(path)
+    assert not reader.changed()
+
+    # Frequent checks only look at the mapped header
+    stats = []
+    with monkeypatch.context() as patch:
+        patch.setattr(shm.os, "stat", lambda path: stats.append(path))
+        for _ in range(100):
+            assert not reader.changed()
+    assert stats == []
+
+    # The producer restarts with the same layout
+    writer.close()
+    writer = shm.Writer(path, slots=4)
+    assert not reader.changed()
+
+    writer.close()
+    writer = shm.Writer(path, slots=4, channels=8)
+    assert reader.changed()
+    reader.close()
+
+    # A replaced file is found by the next check of the file
+    reader = shm.Reader(path)
+    writer.close()
+    os.unlink(path)
+    writer = shm.Writer(path, slots=4, channels=8)
+    assert not reader.changed()
+    assert reader.changed(now=time.monotonic() + shm.CHECK_INTERVAL)
+    reader.close()
+
+    reader = shm.Reader(path)
+    assert reader.channels == 8
+    reader.close()
+    writer.close()
@@ -2,27 +2,59 @@
 
 """
 UDP Server for treppe2000
+
+The sockets are drained by the asyncio loop into the
+preallocated buffers of a protocol.Receiver, and packets are
+decoded into a single slot holding the latest frame. A
+separate writer task pushes the slot to the serial bus at
+a fixed output rate, so slow serial writes never hold up
+the sockets: frames arriving in between supersede each other.
 """
 
+import math
 import time
+import heapq
+import signal
 import socket
+import struct
+import asyncio
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import serial
+import numpy as np
 
 from treppe import protocol
 from treppe import olsndots
+from treppe import quantize
+from treppe import shm
+from treppe import metrics
+from treppe import recording
 
 LISTEN_PORT_DEFAULT = 3123
 
 SERIAL_PORT_DEFAULT = "/dev/ttyUSB0"
-SERIAL_BAUD_DEFAULT = 1000000
+SERIAL_BAUD_DEFAULT = 500000
+
+# Retry validating restored boards after 1 s, doubling up to a minute
+VALIDATE_INTERVAL = 1.0
+VALIDATE_INTERVAL_MAX = 60.0
+
+# Status requests sent with one write, and the timeout per reply
+PROBE_DEPTH = 8
+PROBE_TIMEOUT = 0.020
+
+OUTPUT_RATE_DEFAULT = 100.0
 
 CHANNELS_ACTIVE = 13
 CHANNELS_AVAILABLE = 16
 
 CHANNEL_MAPPING = [14,12,11,10,7,6,9,8,14,14,5,4,1,0,3,2]
 
+WRGB = [3, 0, 1, 2]
+
+BOARDS_DEFAULT = [0x23420001, 0x23420002]
+
 
 def _open_socket(port):
     """
@@ -40,14 +72,414 @@ def _open_socket(port):
     return s
 
 
-def _parse_args():
+def _parse_port(spec):
+    """
+    Parse a port spec PORT[:PRIORITY[:HOLDOFF]].
+    The holdoff defaults to the gracetime (None).
+    """
+    fields = spec.split(":")
+    if not 1 <= len(fields) <= 3:
+        raise argparse.ArgumentTypeError("invalid port: {}".format(spec))
+
+    try:
+        port = int(fields[0])
+        priority = int(fields[1]) if len(fields) > 1 else 0
+        holdoff = float(fields[2]) if len(fields) > 2 else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid port: {}".format(spec))
+
+    return (port, priority, holdoff)
+
+
+def _ports(args):
+    """Get the (port, priority, holdoff) of all listen ports"""
+    if not args.ports:
+        return [(args.listen_port, 0, 0.0),
+                (args.listen_port + 1, 1, args.gracetime)]
+
+    return [(port, priority,
+             args.gracetime if holdoff is None else holdoff)
+            for port, priority, holdoff in args.ports]
+
+
+def _parse_board(spec):
+    """
+    Parse a board spec ADDR[:CHANNELS]@SERIAL_PORT,
+    the channels are None if not given.
+    """
+    board, sep, port = spec.partition("@")
+    if not sep or not port:
+        raise argparse.ArgumentTypeError("invalid board: {}".format(spec))
+
+    addr, _, channels = board.partition(":")
+    try:
+        addr = int(addr, 0)
+        if channels:
+            channels = [int(c) for c in channels.split(",")]
+        else:
+            channels = None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid board: {}".format(spec))
+
+    return (port, addr, channels)
+
+
+def _topology(args):
+    """
+    Get the (serial port, address, frame channels) of all boards.
+    Boards without channels share CHANNEL_MAPPING evenly.
+    """
+    if not args.boards:
+        half = len(CHANNEL_MAPPING) // 2
+        return [(args.serial_port, BOARDS_DEFAULT[0], CHANNEL_MAPPING[:half]),
+                (args.serial_port, BOARDS_DEFAULT[1], CHANNEL_MAPPING[half:])]
+
+    boards = args.boards
+    if all(channels is None for _, _, channels in boards):
+        size = len(CHANNEL_MAPPING) // len(boards)
+        return [(port, addr, CHANNEL_MAPPING[i * size:(i + 1) * size])
+                for i, (port, addr, _) in enumerate(boards)]
+
+    if any(channels is None for _, _, channels in boards):
+        raise ValueError("channels must be given for all boards or none")
+
+    return boards
+
+
+def _unique(items):
+    """Get the distinct items in order"""
+    return list(dict.fromkeys(items))
+
+
+def _parse_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("-l", "--listen-port", default=LISTEN_PORT_DEFAULT)
+    parser.add_argument("-l", "--listen-port", default=LISTEN_PORT_DEFAULT,
+                        type=int)
     parser.add_argument("-p", "--serial-port", default=SERIAL_PORT_DEFAULT)
-    parser.add_argument("-b", "--baudrate", default=SERIAL_BAUD_DEFAULT)
+    parser.add_argument("-b", "--baudrate", default=SERIAL_BAUD_DEFAULT,
+                        type=int,
+                        help="baud rate of the serial ports "
+                             "(default: {})".format(SERIAL_BAUD_DEFAULT))
+    parser.add_argument("-B", "--board", action="append", type=_parse_board,
+                        dest="boards", metavar="ADDR[:CHANNELS]@SERIAL_PORT",
+                        help="drive board ADDR on SERIAL_PORT with the "
+                             "comma separated frame CHANNELS. Can be "
+                             "repeated, boards on different ports are "
+                             "written in parallel. (default: the two "
+                             "stair boards on SERIAL_PORT)")
+    parser.add_argument("-N", "--node-cache", metavar="PATH",
+                        help="keep the boards found in PATH, e.g. "
+                             "/var/tmp/treppe-nodes.json, start from them "
+                             "next time and validate them in the "
+                             "background (default: probe the boards "
+                             "before starting)")
     parser.add_argument("-t", "--gracetime", default=1.5, type=float)
+    parser.add_argument("-P", "--port", action="append", type=_parse_port,
+                        dest="ports", metavar="PORT[:PRIORITY[:HOLDOFF]]",
+                        help="listen on PORT; packets suppress lower "
+                             "priorities for HOLDOFF seconds. Can be "
+                             "repeated. (default: LISTEN_PORT:0:0 and "
+                             "LISTEN_PORT+1:1:GRACETIME)")
+    parser.add_argument("-r", "--output-rate", default=OUTPUT_RATE_DEFAULT,
+                        type=float,
+                        help="frames per second written to the serial bus "
+                             "(default: {})".format(OUTPUT_RATE_DEFAULT))
+    parser.add_argument("-i", "--interpolate", default="none",
+                        choices=["none"] + Interpolator.MODES,
+                        help="crossfade between the last two frames "
+                             "at the output rate (default: none)")
+    parser.add_argument("-j", "--jitter-delay", default=0.05, type=float)
+    parser.add_argument("--shm", default=None, metavar="PATH",
+                        help="read frames from a shared memory ring, "
+                             "e.g. {}".format(shm.SHM_PATH_DEFAULT))
+    parser.add_argument("--shm-priority", default=0, type=int)
+    parser.add_argument("-g", "--gamma", default=1.0, type=float,
+                        help="gamma correction of the output values")
+    parser.add_argument("-R", "--refresh", default=1.0, type=float,
+                        help="rewrite unchanged boards every REFRESH "
+                             "seconds, 0 writes every frame (default: 1.0)")
+    parser.add_argument("-T", "--telemetry", default=5.0, type=float,
+                        help="read the status of every board each "
+                             "TELEMETRY seconds, 0 disables (default: 5.0)")
+    parser.add_argument("-m", "--metrics-port", default=0, type=int,
+                        help="serve prometheus metrics on this local "
+                             "port (default: off)")
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="append all received datagrams to a "
+                             "recording, see treppe.recording")
+    parser.add_argument("-s", "--stats", default=0, type=float,
+                        help="print packet statistics every STATS seconds")
+    parser.add_argument("-a", "--all-packets", default=False,
+                        action="store_true",
+                        help="process every queued frame instead of "
+                             "only the latest, implied by --record")
+
+    args = parser.parse_args(argv)
+    try:
+        args.topology = _topology(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    return args
+
+
+class Stats:
+    """
+    Datagram counters of all sockets, packet counters of all
+    sources, the frames output and superseded in the slot,
+    the bytes written to the serial port per frame and the
+    latency from sending a packet to writing it to the serial
+    port.
+    """
+
+    def __init__(self, interval=0, slot=None, arbiter=None, buses=None):
+        self.interval = interval
+        self.slot = slot
+        self.arbiter = arbiter
+        self.buses = buses or []
+        self.receiver = None
+        self.shm_source = None
+        self.suppressor = None
+        self.sources = {}
+        self.serial_latency = protocol.LatencyStats()
+
+        self._t_report = time.monotonic()
+
+    def report(self):
+        """Print the statistics every interval seconds"""
+        if not self.interval:
+            return
+
+        now = time.monotonic()
+        if now - self._t_report < self.interval:
+            return
+        self._t_report = now
+
+        if self.receiver:
+            receiver = self.receiver
+            for source, received in sorted(receiver.received.items()):
+                print("Socket {}: received {} superseded {} "
+                      "overflows {}".format(source, received,
+                                            receiver.superseded[source],
+                                            receiver.overflows[source]))
+        if self.slot:
+            print("Frames: {}".format(self.slot))
+        if self.shm_source:
+            print("Shared memory: {} torn frames dropped".format(
+                self.shm_source.torn))
+        if self.arbiter:
+            sources = sorted(self.arbiter.sources.items(),
+                             key=lambda item: str(item[0]))
+            for source, counters in sources:
+                print("Source {}: {}".format(source, counters))
+        for source, tracker in sorted(self.sources.items()):
+            print("Source {}: {}".format(source, tracker))
+        if self.suppressor:
+            print("Boards: {}".format(self.suppressor))
+        for bus in self.buses:
+            bus.report()
+        print("Serial latency: {}".format(self.serial_latency))
+        self.serial_latency.reset()
+
+
+class FrameSlot:
+    """
+    Hold the latest frame until the writer takes it.
+
+    A frame put while the previous one was not taken
+    yet supersedes it.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.time = None
+        self.t_arrival = None
+        self.pending = False
+
+        self.received = 0
+        self.superseded = 0
+        self.output = 0
+
+    def put(self, frame, t_send=None):
+        """
+        Replace the frame in the slot.
+
+        :param t_send: The (monotonic) send time of the frame, if known
+        :type t_send: float
+        """
+        if self.pending:
+            self.superseded += 1
+
+        self.frame = frame
+        self.time = t_send
+        self.t_arrival = time.monotonic()
+        self.pending = True
+        self.received += 1
+
+    def take(self):
+        """Get the pending frame or None"""
+        if not self.pending:
+            return None
+
+        self.pending = False
+        return self.frame
+
+    def __repr__(self):
+        return "received {} superseded {} output {}".format(
+            self.received, self.superseded, self.output)
+
+
+class JitterBuffer:
+    """
+    Present the frames of batch packets on schedule.
+
+    Frame times are on the sender's clock. The offset to our
+    monotonic clock is estimated from the fastest batch seen
+    in a sliding window, and every frame is held back by a
+    fixed playout delay to absorb network jitter.
+    """
+
+    def __init__(self, delay=0.05, window=10.0, resync=1.0):
+        self.delay = delay
+        self.window = window
+        self.resync = resync
+
+        self.frames_presented = 0
+        self.frames_skipped = 0
+
+        self._queue = []
+        self._seq = 0
+        self._skew = None
+        self._skew_min = None
+        self._t_window = 0
+
+    def clear(self):
+        """Drop all pending frames"""
+        self.frames_skipped += len(self._queue)
+        self._queue = []
+
+    def _update_skew(self, skew, now):
+        if self._skew is None or abs(skew - self._skew) > self.resync:
+            # First batch or the sender was restarted
+            self.clear()
+            self._skew = skew
+            self._skew_min = skew
+            self._t_window = now
+            return
+
+        self._skew = min(self._skew, skew)
+        self._skew_min = min(self._skew_min, skew)
 
-    return parser.parse_args()
+        # Follow slow clock drift
+        if now - self._t_window > self.window:
+            self._skew = self._skew_min
+            self._skew_min = skew
+            self._t_window = now
+
+    def push(self, data, now=None):
+        """
+        Schedule all frames of a batch packet.
+        The data is copied, as receive buffers are reused.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        data = bytes(data)
+
+        frames = list(protocol.iter_frame_batch(data))
+        self._update_skew(now - protocol.frame_batch_time(data), now)
+
+        flags = data[1]
+        for t, offset, size in frames:
+            t_present = t + self._skew + self.delay
+            heapq.heappush(self._queue,
+                           (t_present, self._seq, data, flags, offset, size))
+            self._seq += 1
+
+    def pop_due(self, now=None):
+        """
+        Get the latest frame that is due as (data, flags, offset, size).
+        Older due frames are skipped.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        due = None
+        while self._queue and self._queue[0][0] <= now:
+            if due is not None:
+                self.frames_skipped += 1
+            due = heapq.heappop(self._queue)[2:]
+
+        if due is not None:
+            self.frames_presented += 1
+
+        return due
+
+    def timeout(self):
+        """Get the time until the next frame is due"""
+        if not self._queue:
+            return None
+        return max(0.0, self._queue[0][0] - time.monotonic())
+
+
+class ShmSource:
+    """
+    Poll frames from a shared memory ring.
+
+    The ring is opened once the producer created it, and
+    again when the producer restarted with another layout.
+    Frames are copied out of the ring, alternating between
+    two frames so the one returned last stays intact. Frames
+    overwritten by the producer while copying are dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.torn = 0
+
+        self._reader = None
+        self._frames = None
+
+    def _open(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+        try:
+            reader = shm.Reader(self.path)
+        except (OSError, ValueError):
+            return False
+
+        self._reader = reader
+        self._frames = [protocol.Frame(reader.channels),
+                        protocol.Frame(reader.channels)]
+        return True
+
+    def poll(self):
+        """Get the latest new frame or None"""
+        reader = self._reader
+        if reader is None or reader.changed():
+            if not self._open():
+                return None
+            reader = self._reader
+
+        latest = reader.latest()
+        if latest is None:
+            return None
+
+        frame = self._frames[0]
+        frame.values[:] = latest.values
+        frame.channels = latest.channels
+        frame.cmd = latest.cmd
+        frame.seq = latest.seq
+        frame.time = latest.time
+
+        if not reader.valid(latest):
+            self.torn += 1
+            return None
+
+        self._frames.reverse()
+        return frame
 
 
 def _encode_rgbw16(rgbw):
@@ -58,96 +490,950 @@ def _encode_rgbw16(rgbw):
            round(rgbw[3] * 65535.0).to_bytes(2, "little")
 
 
-def _encode_frame(frame_data):
+class ChannelMap:
+    """
+    The channel mapping compiled to flat indices into the
+    frame values, so the wrgb framebuffers of all boards
+    are packed with a single take.
+    """
+
+    def __init__(self, mapping, num_boards, order=WRGB):
+        """
+        :param mapping: The frame channel of every output channel
+        :type mapping: list
+
+        :param num_boards: The output channels are split evenly
+                           across this many boards
+        :type num_boards: int
+
+        :param order: Order of the rgbw components on the wire
+        :type order: list
+        """
+        if len(mapping) % num_boards != 0:
+            raise ValueError("all boards need the same number of channels")
+
+        mapping = np.asarray(mapping, dtype=np.intp)
+        index = mapping[:, np.newaxis] * 4 + np.asarray(order, dtype=np.intp)
+
+        self.index = index.reshape(num_boards, -1)
+        self.channels = int(mapping.max()) + 1
+
+    def map(self, frame, curve=None):
+        """
+        Get the framebuffers of all boards.
+
+        :returns: A (boards, channels * 4) array of 16 bit values,
+                  None if the frame is invalid
+        :rtype: numpy.ndarray
+        """
+        if len(frame) < self.channels:
+            return None # invalid data
+
+        framebufs = np.take(frame.values.reshape(-1), self.index)
+        if curve is not None:
+            curve.apply(framebufs, out=framebufs)
+
+        return framebufs
+
+    def mismatched(self, boards):
+        """
+        Get the boards without the channels mapped to them.
+
+        :returns: The indices of the boards
+        :rtype: list
+        """
+        mapped = self.index.shape[1]
+        return [i for i, board in enumerate(boards)
+                if board.nchannels != mapped]
+
+    def check(self, boards):
+        """
+        :raises ValueError: If a board does not have the
+                            channels mapped to it
+        """
+        for i in self.mismatched(boards):
+            raise ValueError(
+                "board {:08x} has {} channels, mapped {}".format(
+                    boards[i].addr, boards[i].nchannels,
+                    self.index.shape[1]))
+
+
+class ChangeSuppressor:
+    """
+    Skip boards whose framebuffer did not change since it
+    was last written. Every board is refreshed at least once
+    per refresh interval, even without new frames.
+    A refresh interval of 0 writes every board every frame.
+    """
+
+    def __init__(self, num_boards, refresh=1.0):
+        self.refresh = refresh
+
+        self.written = 0
+        self.skipped = 0
+
+        self._last = [None] * num_boards
+        self._t_written = [0.0] * num_boards
+
+    def select(self, framebufs, now=None):
+        """
+        Get the framebuffers to write.
+
+        :param framebufs: The new framebuffers of all boards,
+                          None to only refresh
+        :type framebufs: numpy.ndarray
+
+        :returns: A list of (board index, framebuffer)
+        :rtype: list
+        """
+        if now is None:
+            now = time.monotonic()
+
+        writes = []
+        for i, last in enumerate(self._last):
+            stale = now - self._t_written[i] >= self.refresh
+            if framebufs is None:
+                if last is None or not self.refresh or not stale:
+                    continue
+                framebuf = last
+            else:
+                framebuf = framebufs[i]
+                if self.refresh and not stale and last is not None \
+                        and np.array_equal(framebuf, last):
+                    self.skipped += 1
+                    continue
+
+            self._last[i] = framebuf
+            self._t_written[i] = now
+            self.written += 1
+            writes.append((i, framebuf))
+
+        return writes
+
+    def __repr__(self):
+        return "written {} skipped {}".format(self.written, self.skipped)
+
+
+class WireScheduler:
     """
-    Frame data: [(r,g,b,w), ...]
+    Pace the serial writes to what the link can carry.
 
-    The driver (maybe) expects a flat layout of wrgb data (0..65535)
-    Let's try this.
+    Every write keeps the link busy for its wire time,
+    computed from the baud rate and the encoded length.
+    Nothing is written before the link is idle again, so
+    frames wait in the slot instead of the kernel and
+    adapter buffers.
     """
-    frame = [round(v*65535.0)
-             for (r, g, b, w) in frame_data
-             for v in (w, r, g, b)]
 
-    return frame
+    def __init__(self, baudrate, bits_per_byte=10):
+        """
+        :param baudrate: The baud rate of the serial port
+        :type baudrate: int
+
+        :param bits_per_byte: Bits on the wire per byte,
+                              including start and stop bits (8N1)
+        :type bits_per_byte: int
+        """
+        self.byte_time = bits_per_byte / baudrate
+        self.t_idle = 0.0
 
+        self.reset()
 
-def _write_frame(boards, frame):
-    # FIXME: This kind of sucks.
-    num_boards = len(boards)
-    frame_size = len(frame)
-    if frame_size % 2 != 0:
-        return
+    def reset(self):
+        """Restart the write rate measurement"""
+        self.bytes = 0
+        self.writes = 0
+        self._t_start = time.monotonic()
 
-    sub_frame_size = int(frame_size / num_boards)
+    def wire_time(self, size):
+        """Get the time to transmit size bytes"""
+        return size * self.byte_time
 
-    if len(frame) < max(CHANNEL_MAPPING) + 1:
-        return # invalid data
+    def ready(self, now=None):
+        """Check if the link is idle"""
+        if now is None:
+            now = time.monotonic()
+        return now >= self.t_idle
 
-    mapped_frame = [frame[channel] for channel in CHANNEL_MAPPING]
+    def sent(self, size, t_write):
+        """Account a write of size bytes started at t_write"""
+        self.t_idle = max(self.t_idle, t_write) + self.wire_time(size)
+        self.bytes += size
+        self.writes += 1
+
+    @property
+    def theoretical(self):
+        """The capacity of the link in bytes per second"""
+        return 1.0 / self.byte_time
+
+    def write_rate(self, now=None):
+        """
+        Get the bytes written per second since the last reset.
+        These are the bytes handed to the port, not measured
+        on the wire.
+        """
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self._t_start
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes / elapsed
+
+    def __repr__(self):
+        write_rate = self.write_rate()
+        frame_time = 0.0
+        if self.writes:
+            frame_time = self.wire_time(self.bytes / self.writes)
+        return "written {:.0f} of {:.0f} bytes/s ({:.0%}), " \
+               "{:.2f} ms/write".format(write_rate, self.theoretical,
+                                        write_rate / self.theoretical,
+                                        frame_time * 1e3)
+
+
+class Interpolator:
+    """
+    Crossfade from the previous to the latest frame, so frames
+    sent at low rates fade smoothly at the output rate.
+
+    Each fade takes as long as the interval between the arrivals
+    of the last two frames, which delays the output by up to one
+    interval. Intervals longer than max_interval are taken as a
+    pause of the producer and the latest frame is shown at once.
+    """
 
-    sub_frames = [mapped_frame[i:i + sub_frame_size]
-                  for i in range(0, frame_size, sub_frame_size)]
+    MODES = ["linear", "cosine"]
 
-    for i, board in enumerate(boards):
-        sub_frame = sub_frames[i]
-        board.send_framebuf(_encode_frame(sub_frame))
+    def __init__(self, mode="linear", max_interval=0.5):
+        """
+        :param mode: The crossfade curve, "linear" or "cosine"
+        :type mode: str
 
-        time.sleep(20e-6)
+        :param max_interval: Do not fade over longer intervals (s)
+        :type max_interval: float
+        """
+        if mode not in self.MODES:
+            raise ValueError("unknown interpolation: {}".format(mode))
 
+        self.mode = mode
+        self.max_interval = max_interval
 
-def recv_loop(boards, source):
-    for data in source:
-        packet = protocol.decode_packet(data)
+        self._from = None
+        self._to = None
+        self._current = None
+        self._t_start = None
+        self._duration = 0.0
+        self._done = True
 
-        if packet.cmd == protocol.CMD_SET_DIRECT:
+    @property
+    def active(self):
+        """True while a fade is in progress"""
+        return not self._done
+
+    def push(self, framebufs, t_arrival):
+        """Start a fade to new framebuffers arriving at t_arrival"""
+        if self._to is None or self._to.shape != framebufs.shape:
+            self._from = np.empty(framebufs.shape, dtype=np.float32)
+            self._to = np.empty(framebufs.shape, dtype=np.float32)
+            self._current = framebufs.astype(np.float32)
+            self._t_start = t_arrival
+
+        interval = t_arrival - self._t_start
+        self._duration = interval if interval <= self.max_interval else 0.0
+
+        # Start from what was shown last, so a new frame never jumps
+        self._from[:] = self._current
+        self._to[:] = framebufs
+        self._t_start = t_arrival
+        self._done = False
+
+    def render(self, now):
+        """
+        Get the framebuffers at time now.
+
+        :returns: A new array of 16 bit values,
+                  None if the last fade was completed
+        :rtype: numpy.ndarray
+        """
+        if self._done:
+            return None
+
+        alpha = 1.0
+        if self._duration > 0:
+            alpha = min(max((now - self._t_start) / self._duration, 0.0), 1.0)
+        if alpha >= 1.0:
+            self._done = True
+
+        if self.mode == "cosine":
+            alpha = 0.5 - 0.5 * math.cos(math.pi * alpha)
+
+        current = self._current
+        np.subtract(self._to, self._from, out=current)
+        current *= alpha
+        current += self._from
+
+        return np.rint(current).astype(np.uint16)
+
+
+def _write_framebufs(driver, boards, writes):
+    """Write the framebuffers of the selected boards at once. This blocks."""
+    return driver.send_framebufs((boards[i], framebuf.tolist())
+                                 for i, framebuf in writes)
+
+
+def _probe_boards_until(driver, serial_port, devices, nodes, t_next):
+    """Probe the boards, giving up on the replies at t_next. This blocks."""
+    # A probe waits for (depth + 1) timeouts per window at most
+    windows = -(-len(devices) // PROBE_DEPTH)
+    timeout = (t_next - time.monotonic()) / (len(devices) + windows)
+    return probe_boards(driver, serial_port, devices, nodes,
+                        max(0.0, min(PROBE_TIMEOUT, timeout)))
+
+
+def _poll_telemetry(telemetry, t_next):
+    """Poll the next board, giving up on the reply at t_next. This blocks."""
+    return telemetry.poll(timeout=t_next - time.monotonic())
+
+
+class Bus:
+    """
+    A serial port with its boards.
+
+    Every bus has its own writer thread and wire scheduler,
+    so the buses of a frame are written in parallel.
+    """
+
+    def __init__(self, port, driver, boards, indices, telemetry=5.0,
+                 restored=False):
+        """
+        :param port: The serial port of the bus
+        :type port: str
+
+        :param driver: The driver of the port
+        :type driver: olsndots.Driver
+
+        :param boards: All boards of the topology
+        :type boards: list
+
+        :param indices: The indices of the boards on this bus
+        :type indices: list
+
+        :param telemetry: Poll the status of every board each
+                          telemetry seconds, 0 disables
+        :type telemetry: float
+
+        :param restored: The boards were set up from the node
+                         table and need to be validated
+        :type restored: bool
+        """
+        self.port = port
+        self.driver = driver
+        self.boards = boards
+        self.indices = set(indices)
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.scheduler = WireScheduler(driver.baudrate)
+        self.telemetry = olsndots.TelemetryPoller(
+            [boards[i] for i in indices], telemetry)
+        self.restored = restored
+        self.validate_interval = VALIDATE_INTERVAL
+        self._t_validate = 0.0
+
+    def disable(self, index):
+        """Stop writing and polling a board of this bus"""
+        self.indices.discard(index)
+        self.telemetry.nodes = [self.boards[i] for i in sorted(self.indices)]
+
+    def select(self, writes):
+        """Get the writes for the boards of this bus"""
+        return [(i, framebuf) for i, framebuf in writes
+                if i in self.indices]
+
+    async def write(self, writes, t_write):
+        """Write the framebuffers in the writer thread of the bus"""
+        loop = asyncio.get_running_loop()
+        size = await loop.run_in_executor(
+            self.executor, _write_framebufs, self.driver, self.boards, writes)
+        self.scheduler.sent(size, t_write)
+
+    def validation_due(self, now):
+        """Check if the restored boards should be probed again"""
+        return self.restored and \
+            now - self._t_validate >= self.validate_interval
+
+    async def validate(self, t_next, nodes=None):
+        """
+        Probe the restored boards once, updating the node table.
+        The replies are awaited until t_next at most. After a failed
+        probe, the interval until the next one is doubled.
+
+        :returns: True if all boards answered
+        :rtype: bool
+        """
+        loop = asyncio.get_running_loop()
+        devices = [self.boards[i] for i in sorted(self.indices)]
+        self._t_validate = time.monotonic()
+        if not await loop.run_in_executor(
+                self.executor, _probe_boards_until,
+                self.driver, self.port, devices, nodes, t_next):
+            self.validate_interval = min(2 * self.validate_interval,
+                                         VALIDATE_INTERVAL_MAX)
+            return False
+
+        self.restored = False
+        print("Bus {}: boards validated".format(self.port))
+        return True
+
+    async def poll_telemetry(self, t_next):
+        """Poll the next board, waiting for the reply until t_next at most"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, _poll_telemetry, self.telemetry, t_next)
+
+    def report(self):
+        """Print the link, serial and telemetry statistics"""
+        driver = self.driver
+        print("Bus {}: link {}".format(self.port, self.scheduler))
+        print("Bus {}: {} bytes/frame, {} frames, {} bytes".format(
+            self.port, driver.bytes_per_frame, driver.frames_sent,
+            driver.bytes_sent))
+        self.scheduler.reset()
+
+        telemetry = self.telemetry
+        if not telemetry.interval:
+            return
+
+        print("Bus {}: telemetry {} polls, {} errors".format(
+            self.port, telemetry.polls, telemetry.errors))
+        for addr, status in sorted(telemetry.status.items()):
+            print("Board {:08x}: {}".format(addr, status))
+            rising = telemetry.rising.get(addr)
+            if rising:
+                print("Board {:08x}: rising {}".format(
+                    addr, ", ".join(rising)))
+
+
+class Server:
+    """
+    Receive frames from all sources into the slot
+    and write them to the boards at the output rate.
+    """
+
+    def __init__(self, buses, boards, mapping, arbiter, jitter, stats,
+                 shm_source=None, curve=None, refresh=1.0,
+                 interpolator=None, metrics=None, recorder=None,
+                 nodes=None):
+        self.buses = buses
+        self.boards = boards
+        self.mapping = mapping
+        self.nodes = nodes
+        self.channel_map = ChannelMap(mapping, len(boards))
+        self.suppressor = ChangeSuppressor(len(boards), refresh)
+        self.interpolator = interpolator
+        self.metrics = metrics
+        self.recorder = recorder
+        self.arbiter = arbiter
+        self.jitter = jitter
+        self.stats = stats
+        self.shm_source = shm_source
+        self.curve = curve
+
+        self.slot = stats.slot
+        self.frame = protocol.Frame()
+
+        # Deltas apply to the last frame of their own source, and
+        # only once a full frame of it was decoded after a gap
+        self.frames = {}
+        self.synced = set()
+
+    def read(self, receiver, source):
+        """Handle the datagrams queued on the socket of a source"""
+        for packet in receiver.drain(source):
+            self.receive(source, packet)
+
+    def receive(self, source, data):
+        """
+        Handle a packet from a source. The data is only
+        used until this returns, it may be a receive buffer.
+        """
+        if self.recorder is not None:
+            self.recorder.record(source, data)
+
+        metrics = self.metrics
+        if metrics is not None:
+            t_receive = time.monotonic()
+            metrics.received[source].inc()
+
+        try:
+            header, data, _ = protocol.split_header(data)
+        except ValueError:
+            if metrics is not None:
+                metrics.invalid.inc()
+            return # invalid data
+
+        # Sequence numbers are tracked before the arbiter,
+        # so suppressed packets are not counted as lost
+        t_send = None
+        if header is not None:
+            tracker = protocol.sequence_tracker(self.stats.sources, source)
+            if not tracker.accept(header.seq, header.time):
+                if metrics is not None:
+                    metrics.stale[source].inc()
+                return
+            if tracker.gap:
+                self.synced.discard(source)
+            t_send = header.time
+
+        if not self.arbiter.accept(source):
+            self.synced.discard(source)
+            if metrics is not None:
+                metrics.dropped[source].inc()
+            return
+
+        if not data:
+            return
+
+        if data[0] == protocol.CMD_FRAME_BATCH:
+            try:
+                self.jitter.push(data)
+            except (ValueError, struct.error):
+                if metrics is not None:
+                    metrics.invalid.inc()
+            return
+
+        if data[0] == protocol.CMD_FRAME_DELTA and source not in self.synced:
+            if metrics is not None:
+                metrics.stale[source].inc()
+            return
+
+        frame = self.frames.get(source)
+        if frame is None:
+            frame = self.frames[source] = protocol.Frame()
+
+        cmd = protocol.decode_packet_into(data, frame)
+        if metrics is not None:
+            metrics.stages["decode"].observe(time.monotonic() - t_receive)
+            if cmd == protocol.CMD_INVALID:
+                metrics.invalid.inc()
+
+        if cmd == protocol.CMD_SET_DIRECT:
             print("This command is currently not supported")
-            pass
-        elif packet.cmd == protocol.CMD_FRAME:
-            _write_frame(boards, packet.payload)
+        elif cmd in (protocol.CMD_FRAME, protocol.CMD_FRAME_DELTA):
+            self.synced.add(source)
+            self.jitter.clear()
+            self.slot.put(frame, t_send)
+
+    def poll(self):
+        """Put due batch frames and new shared memory frames into the slot"""
+        due = self.jitter.pop_due()
+        if due is not None:
+            data, flags, offset, size = due
+            if protocol.decode_frame_into(data, self.frame,
+                                          flags, offset, size):
+                self.slot.put(self.frame)
+
+        if self.shm_source is None:
+            return
+
+        frame = self.shm_source.poll()
+        if frame is None:
+            return
+
+        if self.metrics is not None:
+            self.metrics.received["shm"].inc()
+        if not self.arbiter.accept("shm"):
+            if self.metrics is not None:
+                self.metrics.dropped["shm"].inc()
+            return
+
+        # From shared memory, no decoding required
+        self.jitter.clear()
+        self.slot.put(frame, frame.time)
+
+    def _observe_write(self, buses, frame, t_arrival, t_write, t_mapped):
+        metrics = self.metrics
+        if frame is not None:
+            metrics.stages["slot"].observe(t_write - t_arrival)
+        if frame is not None or buses:
+            metrics.stages["map"].observe(t_mapped - t_write)
+        for bus in buses:
+            metrics.stages["encode"].observe(bus.driver.encode_time)
+            metrics.stages["write"].observe(bus.driver.write_time)
+            metrics.bytes.inc(bus.driver.bytes_per_frame)
+        if buses:
+            metrics.written.inc()
+            if frame is not None:
+                metrics.stages["total"].observe(time.monotonic() - t_arrival)
 
-        time.sleep(20e-6)
+    def remap(self):
+        """
+        Compile the channel map for the boards as they are now.
 
+        :raises ValueError: If a board does not have the
+                            channels mapped to it
+        """
+        channel_map = ChannelMap(self.mapping, len(self.boards))
+        channel_map.check(self.boards)
+        self.channel_map = channel_map
 
-def initialize_boards(serial_port, devices):
+    async def _validate(self, bus, t_next):
+        """
+        Validate the restored boards of a bus. Boards that came back
+        with other channels than mapped to them are disabled, the
+        others keep being written with the previous channel map.
+        """
+        nchannels = [board.nchannels for board in self.boards]
+        if not await bus.validate(t_next, self.nodes) or \
+                nchannels == [board.nchannels for board in self.boards]:
+            return
+
+        print("Bus {}: board channels changed".format(bus.port))
+        channel_map = ChannelMap(self.mapping, len(self.boards))
+        mismatched = channel_map.mismatched(self.boards)
+        for i in mismatched:
+            board = self.boards[i]
+            print("Board {:08x}: {} channels, mapped {}, disabled".format(
+                board.addr, board.nchannels, channel_map.index.shape[1]))
+            for each in self.buses:
+                if i in each.indices:
+                    each.disable(i)
+        if not mismatched:
+            self.channel_map = channel_map
+
+    def _idle(self):
+        """Check that no frame is waiting to be written"""
+        if self.slot.pending:
+            return False
+        return self.interpolator is None or not self.interpolator.active
+
+    def _validation_due(self, t_next):
+        """
+        Get the buses with restored boards to probe in the gap
+        before the next output, without any frame waiting.
+        """
+        if not self._idle():
+            return []
+
+        # A probe takes about a status read per board
+        now = time.monotonic()
+        return [bus for bus in self.buses
+                if t_next - now >= len(bus.indices) * bus.telemetry.rtt
+                and bus.validation_due(now)]
+
+    def _telemetry_due(self, t_next):
+        """
+        Get the buses where a status read fits into the gap
+        before the next output, without any frame waiting.
+        """
+        if not self._idle():
+            return []
+
+        now = time.monotonic()
+        return [bus for bus in self.buses
+                if t_next - now >= bus.telemetry.rtt
+                and bus.telemetry.due(now)]
+
+    def _t_idle(self):
+        """Get the time when the links of all buses are idle"""
+        return max(bus.scheduler.t_idle for bus in self.buses)
+
+    async def write_loop(self, rate):
+        """
+        Write the latest frame to the boards rate times per second.
+        The serial writes run in the writer threads of the buses,
+        the next frame is started when all buses are done.
+        """
+        period = 1.0 / rate
+        t_next = time.monotonic()
+        while True:
+            self.poll()
+
+            t_write = time.monotonic()
+            t_idle = self._t_idle()
+            if t_write < t_idle:
+                # A link is still busy, the slot keeps the newest frame
+                t_next = t_idle
+                await asyncio.sleep(t_next - t_write)
+                continue
+
+            framebufs = None
+            t_send = None
+            t_arrival = None
+            frame = self.slot.take()
+            if frame is not None:
+                t_send = self.slot.time
+                t_arrival = self.slot.t_arrival
+                framebufs = self.channel_map.map(frame)
+            mapped = framebufs is not None
+
+            if self.interpolator is not None:
+                if framebufs is not None:
+                    self.interpolator.push(framebufs, self.slot.t_arrival)
+                framebufs = self.interpolator.render(t_write)
+
+            if framebufs is not None and self.curve is not None:
+                self.curve.apply(framebufs, out=framebufs)
+
+            t_mapped = time.monotonic()
+
+            writes = self.suppressor.select(framebufs)
+            written = []
+            if writes:
+                for bus in self.buses:
+                    bus_writes = bus.select(writes)
+                    if bus_writes:
+                        written.append((bus, bus.write(bus_writes, t_write)))
+                await asyncio.gather(*(write for _, write in written))
+
+            if self.metrics is not None:
+                self._observe_write([bus for bus, _ in written], frame,
+                                    t_arrival, t_write, t_mapped)
+
+            if mapped:
+                self.slot.output += 1
+                if t_send is not None:
+                    self.stats.serial_latency.add(time.monotonic() - t_send)
+
+            self.stats.report()
+
+            t_next = max(t_next + period, self._t_idle())
+
+            # Probes and status reads share the writer thread
+            validations = self._validation_due(t_next)
+            polls = [self._validate(bus, t_next) for bus in validations]
+            polls += [bus.poll_telemetry(t_next)
+                      for bus in self._telemetry_due(t_next)
+                      if bus not in validations]
+            if polls:
+                await asyncio.gather(*polls)
+            delay = t_next - time.monotonic()
+            if delay < 0:
+                # Fell behind, don't try to catch up
+                t_next -= delay
+                delay = 0
+            await asyncio.sleep(delay)
+
+
+class Metrics:
+    """
+    The counters and stage latency histograms of the server.
+
+    Stages are timed with the monotonic clock: decode (socket
+    receive to decoded), slot (decoded to taken by the writer),
+    map (channel mapping, interpolation and response curve),
+    encode (COBS), write (serial write) and total (decoded to
+    written).
+    """
+
+    STAGES = ["decode", "slot", "map", "encode", "write", "total"]
+
+    def __init__(self, sources):
+        registry = metrics.Registry("trepped_")
+        self.registry = registry
+
+        self.received = {}
+        self.dropped = {}
+        self.stale = {}
+        for source in sources:
+            labels = {"source": source}
+            self.received[source] = registry.counter(
+                "packets_received_total", "Packets received", labels)
+            self.dropped[source] = registry.counter(
+                "packets_dropped_total",
+                "Packets dropped for a higher priority source", labels)
+            self.stale[source] = registry.counter(
+                "packets_stale_total",
+                "Duplicated or reordered packets and deltas "
+                "without a full frame", labels)
+
+        self.invalid = registry.counter(
+            "packets_invalid_total", "Packets that could not be decoded")
+        self.written = registry.counter(
+            "frames_written_total", "Frames written to the serial port")
+        self.bytes = registry.counter(
+            "serial_bytes_total", "Bytes written to the serial port")
+
+        self.stages = {stage: registry.histogram(
+                           "stage_seconds", "Time spent per stage",
+                           {"stage": stage})
+                       for stage in self.STAGES}
+
+
+def probe_boards(driver, serial_port, devices, nodes=None,
+                 timeout=PROBE_TIMEOUT):
+    """
+    Query all boards of a port at once and update the node table.
+
+    :returns: True if all boards answered
+    :rtype: bool
+    """
+    replies = dict(olsndots.Olsndot.probe(driver,
+                                          [dev.addr for dev in devices],
+                                          timeout, PROBE_DEPTH))
+
+    missing = [dev for dev in devices if replies.get(dev.addr) is None]
+    if missing:
+        print("Boards not answering on {}: {}".format(serial_port, ", ".join(
+            "{:08x}".format(dev.addr) for dev in missing)))
+        return False
+
+    changed = False
+    for dev in devices:
+        dev.apply_status(replies[dev.addr])
+        dev.attach(driver)
+        if nodes is not None and nodes.update(serial_port, dev):
+            print("Board {:08x}: {}".format(dev.addr, dev.describe()))
+            changed = True
+
+    if changed:
+        nodes.save()
+
+    return True
+
+
+def _restore_boards(driver, serial_port, devices, nodes):
+    """Set up the boards from the node table if all are in it"""
+    entries = [nodes.get(serial_port, dev.addr) for dev in devices]
+    if None in entries:
+        return False
+
+    try:
+        for dev, entry in zip(devices, entries):
+            dev.restore(entry, driver)
+    except (KeyError, ValueError):
+        return False
+
+    return True
+
+
+def initialize_boards(serial_port, devices, baudrate=SERIAL_BAUD_DEFAULT,
+                      nodes=None):
     """
     Initialize boards.
-    This can fail. So, as long we don't have a
-    driver - we repeat this.
+
+    If all boards are in the node table, they are set up from it
+    right away and should be validated later with probe_boards.
+    Otherwise the boards are probed until all of them answered.
+
+    :returns: The driver and whether the boards were restored
+    :rtype: tuple
     """
     print("Waiting for boards...")
     while True:
         try:
-            driver = olsndots.Driver(serial_port, devices=devices)
-            print("Drivers initialized.")
-            return driver
-        except:
+            driver = olsndots.Driver(serial_port, baudrate=baudrate)
+        except (serial.SerialException, OSError):
             time.sleep(1)
+            continue
+
+        driver.nodes = devices
+        if nodes is not None and \
+                _restore_boards(driver, serial_port, devices, nodes):
+            print("Boards restored from {}.".format(nodes.path))
+            return driver, True
+
+        if probe_boards(driver, serial_port, devices, nodes):
+            print("Drivers initialized.")
+            return driver, False
+
+        driver.close()
+        time.sleep(1)
+
+
+async def serve(server, receiver, rate):
+    loop = asyncio.get_running_loop()
+    for source, sock in receiver.sockets.items():
+        loop.add_reader(sock, server.read, receiver, source)
+
+    await server.write_loop(rate)
 
 
 def main(args):
-    print("Listening on 0.0.0.0:{}".format(args.listen_port))
-    print("Listening on 0.0.0.0:{} (priority)".format(args.listen_port+1))
-    print("Gracetime: {} s".format(args.gracetime))
+    ports = _ports(args)
+    for port, priority, holdoff in ports:
+        print("Listening on 0.0.0.0:{} (priority {}, holdoff {} s)".format(
+            port, priority, holdoff))
+    print("Jitter delay: {} s".format(args.jitter_delay))
+    print("Output rate: {} fps".format(args.output_rate))
+
+    topology = args.topology
+    boards = [olsndots.Olsndot(addr) for _, addr, _ in topology]
+    mapping = [channel for _, _, channels in topology
+               for channel in channels]
+
+    nodes = None
+    if args.node_cache:
+        nodes = olsndots.NodeTable(args.node_cache).load()
 
-    sock_a = _open_socket(args.listen_port)
-    sock_b = _open_socket(args.listen_port+1)
+    buses = []
+    for port in _unique(port for port, _, _ in topology):
+        indices = [i for i, (p, _, _) in enumerate(topology) if p == port]
+        print("Bus {}: boards {}".format(port, ", ".join(
+            "{:08x}".format(boards[i].addr) for i in indices)))
+        driver, restored = initialize_boards(
+            port, [boards[i] for i in indices], args.baudrate, nodes)
+        buses.append(Bus(port, driver, boards, indices, args.telemetry,
+                         restored))
 
-    boards = [
-        olsndots.Olsndot(0x23420001),
-        olsndots.Olsndot(0x23420002),
-    ]
+    jitter = JitterBuffer(args.jitter_delay)
 
-    driver = initialize_boards(args.serial_port, boards)
+    sources = {port: (priority, holdoff)
+               for port, priority, holdoff in ports}
 
-    source = protocol.demultiplex_sockets(
-        protocol.receive_sockets(sock_a, sock_b),
-        args.gracetime)
+    shm_source = None
+    if args.shm:
+        print("Reading frames from {} (priority {})".format(
+            args.shm, args.shm_priority))
+        shm_source = ShmSource(args.shm)
+        sources["shm"] = (args.shm_priority, args.gracetime)
 
-    recv_loop(boards, source)
+    arbiter = protocol.Arbiter(sources)
+    stats = Stats(args.stats, FrameSlot(), arbiter, buses)
+
+    # A recording should hold every datagram, none superseded
+    sockets = {port: _open_socket(port) for port, _, _ in ports}
+    receiver = protocol.Receiver(
+        sockets, latest_only=not (args.all_packets or args.record),
+        trackers=stats.sources)
+    stats.receiver = receiver
+
+    curve = None
+    if args.gamma != 1.0:
+        curve = quantize.ResponseCurve(args.gamma)
+
+    interpolator = None
+    if args.interpolate != "none":
+        print("Interpolation: {}".format(args.interpolate))
+        interpolator = Interpolator(args.interpolate)
+
+    server_metrics = None
+    if args.metrics_port:
+        print("Serving metrics on 127.0.0.1:{}".format(args.metrics_port))
+        server_metrics = Metrics(sources)
+        metrics.serve(server_metrics.registry, args.metrics_port)
+
+    recorder = None
+    if args.record:
+        print("Recording datagrams to {}".format(args.record))
+        recorder = recording.Recorder(args.record)
+
+    server = Server(buses, boards, mapping, arbiter, jitter, stats,
+                    shm_source, curve, args.refresh, interpolator,
+                    server_metrics, recorder, nodes)
+    server.remap()
+    stats.suppressor = server.suppressor
+    stats.shm_source = shm_source
+
+    # Stop like on ctrl-c, so the recording is complete
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(server, receiver, args.output_rate))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder is not None:
+            recorder.close()
 
 
 if __name__ == "__main__":
     args = _parse_args()
     main(args)
-
@@ -0,0 +1,560 @@
+import time
+import socket
+import asyncio
+import argparse
+
+import pytest
+import numpy as np
+
+import trepped
+from treppe import protocol
+from treppe import olsndots
+from treppe import olsndots_sim
+from treppe import quantize
+from treppe import shm
+
+
+def _udp_pair():
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.connect(rx.getsockname())
+    return rx, tx
+
+
+def _batches(t0, times, value=1.0):
+    frames = [[(value, 0.0, 0.0, i / 100.0)] for i in range(len(times))]
+    return protocol.cmd_frame_batches_rgbw16(frames, times, t0=t0)
+
+
+def _batch(t0, times, value=1.0):
+    (packet,) = _batches(t0, times, value)
+    return packet
+
+
+def test_jitter_buffer_pop_due():
+    """Frames are presented on schedule, late ones are skipped"""
+    jitter = trepped.JitterBuffer(delay=0.05)
+    packet = _batch(100.0, [0.0, 0.01, 0.02])
+    jitter.push(packet, now=5.0)
+
+    assert jitter.pop_due(now=5.04) is None
+
+    data, flags, offset, size = jitter.pop_due(now=5.05)
+    assert flags == protocol.FLAG_RGBA | protocol.FLAG_BITS_16
+    assert data[offset:offset + size] == packet[offset:offset + size]
+    assert jitter.frames_presented == 1
+
+    # Frame 1 is superseded by frame 2
+    _, _, offset_2, _ = jitter.pop_due(now=5.075)
+    assert offset_2 > offset
+    assert jitter.frames_presented == 2
+    assert jitter.frames_skipped == 1
+
+    assert jitter.pop_due(now=6.0) is None
+
+
+def test_jitter_buffer_skew():
+    """The clock offset follows the fastest batch in the window"""
+    jitter = trepped.JitterBuffer(delay=0.0, window=10.0)
+    jitter.push(_batch(100.0, [0.0]), now=5.0)
+    assert jitter._skew == -95.0
+
+    # A delayed batch does not move the offset
+    jitter.push(_batch(101.0, [0.0]), now=6.2)
+    assert jitter._skew == -95.0
+
+    # A faster one does
+    jitter.push(_batch(102.0, [0.0]), now=6.99)
+    assert round(jitter._skew, 3) == -95.01
+
+    # After the window the offset is taken from its minimum
+    jitter.push(_batch(110.0, [0.0]), now=15.1)
+    assert round(jitter._skew, 3) == -95.01
+    jitter.push(_batch(120.0, [0.0]), now=25.2)
+    assert round(jitter._skew, 3) == -94.9
+
+
+def test_jitter_buffer_resync():
+    """A jump of the sender clock drops the pending frames"""
+    jitter = trepped.JitterBuffer(delay=0.05, resync=1.0)
+    jitter.push(_batch(100.0, [0.0, 0.01, 0.02]), now=5.0)
+    jitter.push(_batch(500.0, [0.0]), now=5.01)
+
+    assert jitter.frames_skipped == 3
+    assert round(jitter._skew, 3) == -494.99
+
+    assert jitter.pop_due(now=5.06) is not None
+    assert jitter.pop_due(now=6.0) is None
+    assert jitter.frames_presented == 1
+
+
+def test_jitter_buffer_batches_sent_early():
+    """Batches sent ahead with a lead play back to back"""
+    fps = 100
+    n = 50
+    jitter = trepped.JitterBuffer(delay=0.05, resync=1.0)
+
+    # Like play_image: the next batch is sent when the previous
+    # one starts playing, so it leads the send time by a batch.
+    t_batch = 10.0
+    for i in range(3):
+        t_send = t_batch - (n / fps if i else 0.0)
+        times = [(t_batch - t_send) + k / fps for k in range(n)]
+        for packet in _batches(t_send, times, value=i / 10.0):
+            jitter.push(packet, now=t_send + 0.001)
+        t_batch += n / fps
+
+    assert jitter.frames_skipped == 0
+
+    presented = []
+    now = 10.0
+    while now < t_batch + 0.1:
+        due = jitter.pop_due(now=now)
+        if due is not None:
+            data, flags, offset, size = due
+            frame = protocol.decode_frame(data[offset:offset + size], flags)
+            presented.append(round(frame[0][0], 1))
+        now += 1.0 / fps
+
+    assert presented == [0.0] * n + [0.1] * n + [0.2] * n
+    assert jitter.frames_skipped == 0
+
+
+def _server(sources):
+    stats = trepped.Stats(slot=trepped.FrameSlot())
+    arbiter = protocol.Arbiter(sources)
+    return trepped.Server([], [None], list(range(16)), arbiter,
+                          trepped.JitterBuffer(), stats)
+
+
+def _delta(frame, changed):
+    """Encode a delta of frame for the changed channels"""
+    encoder = protocol.DeltaEncoder()
+    encoder.encode([(0.0, 0.0, 0.0, 0.0) if i in changed else rgbw
+                    for i, rgbw in enumerate(frame)])
+    return encoder.encode(frame)
+
+
+def test_server_delta_per_source():
+    """Deltas apply to the frame of their source after a keyframe"""
+    red = [(1.0, 0.0, 0.0, 0.0)] * 4
+    blue = [(0.0, 0.0, 1.0, 0.0)] * 4
+    server = _server({"a": (0, 0.0), "b": (1, 10.0)})
+
+    # A delta without a keyframe has nothing to apply to
+    server.receive("a", _delta(red, {1}))
+    assert server.slot.take() is None
+
+    server.receive("a", protocol.cmd_frame_rgbw16(red))
+    server.receive("b", protocol.cmd_frame_rgbw16(blue))
+    assert server.slot.take().to_list()[1] == (0.0, 0.0, 1.0, 0.0)
+
+    # Suppressed while b holds off, a missed its keyframes
+    server.receive("a", _delta(red, {1}))
+    server.arbiter.sources["b"].holdoff = 0.0
+    server.receive("a", _delta(red, {2}))
+    assert server.slot.take() is None
+
+    server.receive("a", protocol.cmd_frame_rgbw16(red))
+    server.receive("a", _delta(red[:2] + [(0.0, 1.0, 0.0, 0.0)] * 2, {2, 3}))
+    assert server.slot.take().to_list()[:4] == [
+        (1.0, 0.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0),
+        (0.0, 1.0, 0.0, 0.0), (0.0, 1.0, 0.0, 0.0)]
+
+
+def test_server_delta_after_loss():
+    """A lost packet drops the deltas until the next keyframe"""
+    frame = [(1.0, 0.0, 0.0, 0.0)] * 4
+    sequencer = protocol.Sequencer()
+    server = _server({"a": (0, 0.0)})
+
+    server.receive("a", sequencer.wrap(protocol.cmd_frame_rgbw16(frame)))
+    server.receive("a", sequencer.wrap(_delta(frame, {0})))
+    assert server.slot.take() is not None
+
+    sequencer.wrap(_delta(frame, {1})) # lost
+    server.receive("a", sequencer.wrap(_delta(frame, {2})))
+    assert server.slot.take() is None
+
+    server.receive("a", sequencer.wrap(protocol.cmd_frame_rgbw16(frame)))
+    assert server.slot.take() is not None
+
+
+def test_frame_slot():
+    """The slot keeps the latest frame until it is taken"""
+    slot = trepped.FrameSlot()
+    assert slot.take() is None
+
+    first, second = protocol.Frame(), protocol.Frame()
+    slot.put(first, 1.0)
+    slot.put(second, 2.0)
+    assert slot.pending
+    assert slot.take() is second
+    assert slot.time == 2.0
+    assert slot.take() is None
+
+    slot.put(first)
+    assert slot.take() is first
+    assert slot.time is None
+    assert (slot.received, slot.superseded) == (3, 1)
+
+
+def test_server_receive_stale():
+    """Duplicated and invalid packets do not reach the slot"""
+    server = _server({"a": (0, 0.0)})
+    sequencer = protocol.Sequencer()
+
+    packet = sequencer.wrap(protocol.cmd_frame_rgbw16([(1.0, 0, 0, 0)]),
+                            t=3.0)
+    server.receive("a", memoryview(packet))
+    assert server.slot.take() is not None
+    assert server.slot.time == 3.0
+
+    server.receive("a", memoryview(packet))
+    server.receive("a", packet[:8])
+    assert server.slot.take() is None
+
+    tracker = server.stats.sources["a"]
+    assert (tracker.accepted, tracker.duplicated) == (1, 1)
+
+
+def test_server_read():
+    """Queued datagrams are drained and the latest frame is kept"""
+    rx, tx = _udp_pair()
+    server = _server({"a": (0, 0.0)})
+    receiver = protocol.Receiver({"a": rx}, latest_only=True,
+                                 trackers=server.stats.sources)
+
+    sequencer = protocol.Sequencer()
+    for i in range(5):
+        frame = [(i / 10.0, 0.0, 0.0, 0.0)]
+        tx.send(sequencer.wrap(protocol.cmd_frame_rgbw16(frame)))
+
+    server.read(receiver, "a")
+    frame = server.slot.take()
+    assert round(frame.to_list()[0][0], 3) == 0.4
+    assert server.slot.received == 1
+
+    tracker = server.stats.sources["a"]
+    assert (tracker.accepted, tracker.superseded, tracker.lost) == (1, 4, 0)
+    assert receiver.superseded == {"a": 4}
+
+    rx.close()
+    tx.close()
+
+
+def test_shm_source(tmp_path):
+    """Frames are copied out of the ring"""
+    path = str(tmp_path / "treppe")
+    source = trepped.ShmSource(path)
+    assert source.poll() is None
+
+    writer = shm.Writer(path, slots=4)
+    assert source.poll() is None
+
+    writer.write([(1.0, 0.0, 0.0, 0.0)], t=1.5)
+    first = source.poll()
+    assert first.values[0].tolist() == [0xffff, 0, 0, 0]
+    assert first.time == 1.5
+    assert source.poll() is None
+
+    # Wrapping around the ring leaves the copy intact
+    for i in range(5):
+        writer.write([(0.0, 1.0, 0.0, 0.0)])
+    second = source.poll()
+    assert second is not first
+    assert first.values[0].tolist() == [0xffff, 0, 0, 0]
+    assert second.values[0].tolist() == [0, 0xffff, 0, 0]
+
+    # The producer restarts with fewer channels
+    writer.close()
+    writer = shm.Writer(path, slots=4, channels=8)
+    writer.write([(0.0, 0.0, 1.0, 0.0)])
+    frame = source.poll()
+    assert len(frame) == 8
+    assert frame.values[0].tolist() == [0, 0, 0xffff, 0]
+
+    del first, second, frame
+    writer.close()
+
+
+def test_shm_source_torn(tmp_path, monkeypatch):
+    """A frame overwritten while copying is dropped"""
+    path = str(tmp_path / "treppe")
+    writer = shm.Writer(path, slots=4)
+    source = trepped.ShmSource(path)
+    source.poll()
+
+    reader = source._reader
+    latest = reader.latest
+
+    def overwrite():
+        frame = latest()
+        for _ in range(4):
+            writer.write([(0.5, 0.0, 0.0, 0.0)])
+        return frame
+
+    monkeypatch.setattr(reader, "latest", overwrite)
+    writer.write([(1.0, 0.0, 0.0, 0.0)])
+    assert source.poll() is None
+    assert source.torn == 1
+
+    writer.close()
+
+
+def _frame(values):
+    """Make a frame of 16 bit rgbw values"""
+    frame = protocol.Frame()
+    frame.values[:len(values)] = values
+    frame.channels = len(values)
+    return frame
+
+
+def test_channel_map():
+    """Frame channels are packed into wrgb framebuffers per board"""
+    channel_map = trepped.ChannelMap([2, 0, 1, 1], 2)
+    assert channel_map.channels == 3
+
+    frame = _frame([(1, 2, 3, 4), (5, 6, 7, 8), (9, 10, 11, 12)])
+    framebufs = channel_map.map(frame)
+    assert framebufs.tolist() == [[12, 9, 10, 11, 4, 1, 2, 3],
+                                  [8, 5, 6, 7, 8, 5, 6, 7]]
+
+    curve = quantize.ResponseCurve(table=np.arange(65536)[::-1])
+    assert channel_map.map(frame, curve)[0][0] == 65535 - 12
+
+    # Too few channels
+    assert channel_map.map(_frame([(1, 2, 3, 4)] * 2)) is None
+
+    with pytest.raises(ValueError):
+        trepped.ChannelMap([0, 1, 2], 2)
+
+    boards = [olsndots.Olsndot(1), olsndots.Olsndot(2)]
+    for board in boards:
+        board.nchannels = 8
+    channel_map.check(boards)
+    boards[1].nchannels = 32
+    with pytest.raises(ValueError):
+        channel_map.check(boards)
+
+
+def test_change_suppressor():
+    """Unchanged boards are written once per refresh interval"""
+    suppressor = trepped.ChangeSuppressor(2, refresh=1.0)
+    a = np.array([[1, 2], [3, 4]], dtype=np.uint16)
+    b = np.array([[1, 2], [5, 6]], dtype=np.uint16)
+
+    assert [i for i, _ in suppressor.select(a, now=10.0)] == [0, 1]
+    assert [i for i, _ in suppressor.select(a, now=10.1)] == []
+    writes = suppressor.select(b, now=10.2)
+    assert [(i, buf.tolist()) for i, buf in writes] == [(1, [5, 6])]
+
+    # Without a new frame only stale boards are refreshed
+    assert suppressor.select(None, now=10.5) == []
+    writes = suppressor.select(None, now=11.1)
+    assert [(i, buf.tolist()) for i, buf in writes] == [(0, [1, 2])]
+    assert (suppressor.written, suppressor.skipped) == (4, 3)
+
+    # No refresh interval writes every frame
+    suppressor = trepped.ChangeSuppressor(2, refresh=0)
+    assert len(suppressor.select(a, now=1.0)) == 2
+    assert len(suppressor.select(a, now=1.0)) == 2
+    assert suppressor.select(None, now=5.0) == []
+
+
+def test_interpolator():
+    """Fades take as long as the interval between frames"""
+    interpolator = trepped.Interpolator("linear", max_interval=0.5)
+    black = np.zeros((1, 4), dtype=np.uint16)
+    white = np.full((1, 4), 1000, dtype=np.uint16)
+
+    # The first frame is shown at once
+    interpolator.push(black, 1.0)
+    assert interpolator.render(1.0).tolist() == [[0] * 4]
+    assert interpolator.render(1.01) is None
+    assert not interpolator.active
+
+    interpolator.push(white, 1.2)
+    assert interpolator.active
+    assert interpolator.render(1.2).tolist() == [[0] * 4]
+    assert interpolator.render(1.25).tolist() == [[250] * 4]
+    assert interpolator.render(1.4).tolist() == [[1000] * 4]
+    assert interpolator.render(1.45) is None
+
+    # A new frame fades from what was shown last
+    interpolator.push(black, 1.5)
+    assert interpolator.render(1.65).tolist() == [[500] * 4]
+    interpolator.push(white, 1.7)
+    assert interpolator.render(1.7).tolist() == [[500] * 4]
+    assert interpolator.render(1.75).tolist() == [[625] * 4]
+
+    # After a pause the frame is shown at once
+    interpolator.push(black, 3.0)
+    assert interpolator.render(3.0).tolist() == [[0] * 4]
+
+
+def test_interpolator_cosine():
+    interpolator = trepped.Interpolator("cosine")
+    interpolator.push(np.zeros((1, 1), dtype=np.uint16), 0.0)
+    interpolator.push(np.full((1, 1), 1000, dtype=np.uint16), 0.4)
+
+    assert interpolator.render(0.5).tolist() == [[146]]
+    assert interpolator.render(0.6).tolist() == [[500]]
+
+    with pytest.raises(ValueError):
+        trepped.Interpolator("cubic")
+
+
+def test_parse_board():
+    assert trepped._parse_board("0x23420001@/dev/ttyUSB0") == \
+        ("/dev/ttyUSB0", 0x23420001, None)
+    assert trepped._parse_board("0x23420003:0,1,14@/dev/ttyUSB1") == \
+        ("/dev/ttyUSB1", 0x23420003, [0, 1, 14])
+
+    for spec in ("0x23420001", "0x23420001@", "board@/dev/ttyUSB0",
+                 "0x23420001:a,b@/dev/ttyUSB0"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            trepped._parse_board(spec)
+
+
+def test_topology():
+    """Boards without channels share the stair mapping"""
+    mapping = trepped.CHANNEL_MAPPING
+
+    args = trepped._parse_args(["-p", "/dev/ttyS0"])
+    assert args.topology == [
+        ("/dev/ttyS0", trepped.BOARDS_DEFAULT[0], mapping[:8]),
+        ("/dev/ttyS0", trepped.BOARDS_DEFAULT[1], mapping[8:]),
+    ]
+
+    args = trepped._parse_args(["-B", "1@/dev/ttyUSB0",
+                                "-B", "2@/dev/ttyUSB1",
+                                "-B", "3@/dev/ttyUSB1",
+                                "-B", "4@/dev/ttyUSB1"])
+    assert [addr for _, addr, _ in args.topology] == [1, 2, 3, 4]
+    assert [channels for _, _, channels in args.topology] == \
+        [mapping[0:4], mapping[4:8], mapping[8:12], mapping[12:16]]
+
+    args = trepped._parse_args(["-B", "1:0,1@/dev/ttyUSB0",
+                                "-B", "2:2,3@/dev/ttyUSB1"])
+    assert args.topology == [("/dev/ttyUSB0", 1, [0, 1]),
+                             ("/dev/ttyUSB1", 2, [2, 3])]
+
+
+def test_topology_mixed(capsys):
+    """Channels must be given for all boards or none"""
+    with pytest.raises(SystemExit):
+        trepped._parse_args(["-B", "1:0,1@/dev/ttyUSB0",
+                             "-B", "2@/dev/ttyUSB0"])
+
+    assert "channels must be given" in capsys.readouterr().err
+
+
+def test_wire_scheduler():
+    """Writes keep the link busy for their wire time"""
+    scheduler = trepped.WireScheduler(500000)
+    assert scheduler.theoretical == pytest.approx(50000.0)
+    assert scheduler.wire_time(500) == pytest.approx(0.01)
+    assert scheduler.ready(now=0.0)
+
+    scheduler.sent(500, 10.0)
+    assert scheduler.t_idle == pytest.approx(10.01)
+    assert not scheduler.ready(now=10.005)
+    assert scheduler.ready(now=10.01)
+
+    # A write before the link is idle queues behind the last one
+    scheduler.sent(250, 10.005)
+    assert scheduler.t_idle == pytest.approx(10.015)
+
+    # After an idle period the wire time starts at the write
+    scheduler.sent(250, 20.0)
+    assert scheduler.t_idle == pytest.approx(20.005)
+
+    assert (scheduler.bytes, scheduler.writes) == (1000, 3)
+    rate = scheduler.write_rate(now=scheduler._t_start + 2.0)
+    assert rate == pytest.approx(500.0)
+    assert "ms/write" in repr(scheduler)
+
+    scheduler.reset()
+    assert (scheduler.bytes, scheduler.writes) == (0, 0)
+
+
+@pytest.fixture
+def sim_bus():
+    nodes = [olsndots_sim.VirtualOlsndot(0x23420001, processing_time=0.0),
+             olsndots_sim.VirtualOlsndot(0x23420002, nchannels=16,
+                                         processing_time=0.0)]
+    bus = olsndots_sim.Bus(nodes).start()
+    yield bus
+    bus.stop()
+
+
+def _restored_bus(path, addrs, nchannels=32):
+    """Make a bus of boards as if restored from the node table"""
+    driver = olsndots.Driver(path, baudrate=1000000)
+    boards = [olsndots.Olsndot(addr) for addr in addrs]
+    for board in boards:
+        board.nchannels = nchannels
+        board.attach(driver)
+    return trepped.Bus(path, driver, boards, range(len(boards)),
+                       restored=True)
+
+
+def test_bus_validate_backoff(sim_bus):
+    """Failed probes are retried with exponential backoff"""
+    bus = _restored_bus(sim_bus.path, [0x23420001, 0x23420009])
+    now = time.monotonic()
+    assert bus.validation_due(now)
+
+    for interval in (2.0, 4.0):
+        t_start = time.monotonic()
+        assert not asyncio.run(bus.validate(t_start + 0.03))
+        assert time.monotonic() - t_start < 0.25
+        assert bus.validate_interval == interval
+        assert bus.restored
+    assert not bus.validation_due(time.monotonic())
+    assert bus.validation_due(time.monotonic() + 4.0)
+
+    bus.validate_interval = 50.0
+    asyncio.run(bus.validate(time.monotonic() + 0.03))
+    assert bus.validate_interval == trepped.VALIDATE_INTERVAL_MAX
+
+
+def test_server_validate_remap(sim_bus, tmp_path):
+    """Boards that changed their channels are disabled"""
+    nodes = olsndots.NodeTable(str(tmp_path / "nodes.json")).load()
+    bus = _restored_bus(sim_bus.path, [0x23420001, 0x23420002], nchannels=16)
+    stats = trepped.Stats(slot=trepped.FrameSlot())
+    server = trepped.Server([bus], bus.boards, list(range(8)),
+                            protocol.Arbiter({}), trepped.JitterBuffer(),
+                            stats, nodes=nodes)
+    server.remap()
+    channel_map = server.channel_map
+
+    # The first board has 32 channels now, 16 are mapped to it
+    asyncio.run(server._validate(bus, time.monotonic() + 0.1))
+    assert not bus.restored
+    assert nodes.get(sim_bus.path, 0x23420001)["nchannels"] == 32
+    assert server.channel_map is channel_map
+    assert bus.indices == {1}
+    assert bus.telemetry.nodes == [bus.boards[1]]
+
+    # The other board is still written
+    framebufs = server.channel_map.map(_frame([(1, 2, 3, 4)] * 8))
+    writes = bus.select(server.suppressor.select(framebufs))
+    assert [i for i, _ in writes] == [1]
+    asyncio.run(bus.write(writes, time.monotonic()))
+    assert bus.telemetry.poll(timeout=0.1) is not None
+    assert sim_bus.nodes[0x23420002].framebuf == (4, 1, 2, 3) * 4
+    assert sim_bus.nodes[0x23420001].frames == 0
+
+    # Changed channels that match are remapped
+    bus = _restored_bus(sim_bus.path, [0x23420001], nchannels=16)
+    server = trepped.Server([bus], bus.boards, list(range(8)),
+                            protocol.Arbiter({}), trepped.JitterBuffer(),
+                            stats)
+    channel_map = server.channel_map
+    asyncio.run(server._validate(bus, time.monotonic() + 0.1))
+    assert server.channel_map is not channel_map
+    assert server.channel_map.index.shape == (1, 32)